@@ -0,0 +1,106 @@
+## Storage for the snapshots of the lattice taken during training.
+## The snapshots can be kept in memory (all of them or the last few), written to an HDF5 file,
+## or not kept at all; the U-matrices are only computed when a snapshot is read.
+
+import sys
+from collections import deque
+
+import numpy as np
+import h5py as h5
+
+history_modes = ("all", "last", "disk", "off")
+
+
+class LatticeHistory:
+    def __init__(self, mode: str = "all", size: int = None, path: str = None):
+        """Sequence of lattice snapshots.
+
+        Args:
+            mode (str, optional): "all" to keep every snapshot in memory, "last" to keep only the last size snapshots,
+                "disk" to append them to the HDF5 file at path, or "off". Defaults to "all".
+            size (int, optional): Number of snapshots kept with mode "last". Defaults to None.
+            path (str, optional): HDF5 file for mode "disk"; the snapshots are stored in its "lattice" dataset,
+                replacing any previous one. Defaults to None.
+        """
+        if mode not in history_modes:
+            sys.exit(f"history must be one of {history_modes}")
+        if mode == "last" and (size is None or size < 1):
+            sys.exit("history 'last' needs a positive history_size")
+        if mode == "disk" and path is None:
+            sys.exit("history 'disk' needs a history_path")
+
+        self.mode = mode
+        self.size = size
+        self.path = path
+        self.count = 0  # number of snapshots written to disk
+        if mode == "last":
+            self.snapshots = deque(maxlen=size)
+        else:
+            self.snapshots = []
+
+    def append(self, lattice: np.ndarray):
+        """Store a copy of the node weights.
+
+        Args:
+            lattice (np.ndarray): The node weights of shape [X*Y, F].
+        """
+        if self.mode == "off":
+            return
+        if self.mode != "disk":
+            self.snapshots.append(lattice.copy())
+            return
+
+        with h5.File(self.path, "a") as f5:
+            if self.count == 0:
+                if "lattice" in f5:
+                    del f5["lattice"]
+                f5.create_dataset(
+                    "lattice",
+                    shape=(0,) + lattice.shape,
+                    maxshape=(None,) + lattice.shape,
+                    chunks=(1,) + lattice.shape,
+                    dtype=lattice.dtype,
+                )
+            f5["lattice"].resize(self.count + 1, axis=0)
+            f5["lattice"][self.count] = lattice
+        self.count += 1
+
+    def __len__(self) -> int:
+        if self.mode == "disk":
+            return self.count
+        return len(self.snapshots)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        index = range(len(self))[index]  # resolves negative indices, raises IndexError
+        if self.mode == "disk":
+            with h5.File(self.path, "r") as f5:
+                return f5["lattice"][index]
+        return self.snapshots[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class UmatHistory:
+    def __init__(self, som):
+        """Sequence of the U-matrices of the lattice snapshots of som, each computed when it is read.
+
+        Args:
+            som (aweSOM.Lattice): The SOM whose lattice_history is read.
+        """
+        self.som = som
+
+    def __len__(self) -> int:
+        return len(self.som.lattice_history)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        return self.som.compute_umat(lattice=self.som.lattice_history[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -165,8 +165,47 @@ def get_sce_cluster_separation(gsum_deriv: np.ndarray, threshold: float):
     return cluster_ranges, minimas
 
 
+def get_gsum_mask(
+    instance: list,
+    dims: list[int],
+    file_path: str,
+    labels_path: str = None,
+    mask_files: bool = False,
+) -> np.ndarray:
+    """
+    Get the gsum mask of one cluster: its gsum value where the cluster is, and 0 elsewhere.
+
+    The mask is rebuilt from the label file of its run and the gsum value of instance. sce.py no longer writes nor
+    removes mask files, so the mask files in file_path are only read with mask_files.
+
+    Args:
+        instance (list): An entry of the map list from get_gsum_values, [gsum value, cluster id, run name].
+        dims (list[int]): The dimensions of the mask.
+        file_path (str): The file path of the multimap mapping file.
+        labels_path (str, optional): The folder of the label files of the runs. Defaults to None, for the parent of file_path, where sce.py reads them.
+        mask_files (bool, optional): Whether to read the mask file written by earlier versions of sce.py instead; it
+            must come from the same SCE run as the multimap mapping file. Defaults to False.
+
+    Returns:
+        np.ndarray: The gsum mask.
+    """
+    gsum_value, cid, run = instance
+    if mask_files:
+        return np.reshape(np.load(file_path + f"/mask-{run}-id{cid}.npy"), dims)
+
+    if labels_path is None:
+        labels_path = os.path.join(file_path, os.pardir)
+    labels = np.load(os.path.join(labels_path, f"{run}.npy"), mmap_mode="r")
+    return np.reshape(np.where(labels == cid, gsum_value, 0.0), dims)
+
+
 def combine_separated_clusters(
-    map_list: list, cluster_ranges: list[list[int]], dims: int, file_path: str
+    map_list: list,
+    cluster_ranges: list[list[int]],
+    dims: int,
+    file_path: str,
+    labels_path: str = None,
+    mask_files: bool = False,
 ) -> np.ndarray:
     """
     Combine separated clusters by summing their corresponding gsum masks.
@@ -175,7 +214,9 @@ def combine_separated_clusters(
         map_list (list): A list of instances representing the binary maps.
         cluster_ranges (list[list[int]]): A list of ranges indicating the start and end indices for each cluster.
         dims (int): The dimensions of the binary maps.
-        file_path (str): The file path where the binary maps are stored.
+        file_path (str): The file path of the multimap mapping file.
+        labels_path (str, optional): The folder of the label files of the runs, see get_gsum_mask. Defaults to None.
+        mask_files (bool, optional): Whether to read the mask files of earlier versions of sce.py, see get_gsum_mask. Defaults to False.
 
     Returns:
         np.ndarray: A numpy array containing the summed binary maps for each cluster.
@@ -206,19 +247,16 @@ def combine_separated_clusters(
             flush=True,
         )
 
-        # cannot use jax here because it uses too much memory; cannot use numba because it does not support np.load; loading all binary maps in each cluster at once will use more memory, but is also ~30% faster than loading them sequentially and adding to total every step.
-        this_cluster_signal_map = np.zeros(
-            ([len(remapped_clusters[cluster])] + dims), dtype=np.float32
-        )
+        # the masks are rebuilt (or read) one at a time and added in single precision, in order
+        this_cluster_signal_map = np.zeros(dims, dtype=np.float32)
         for i, instance in enumerate(remapped_clusters[cluster]):
             if i % 10 == 0:
                 print("Instance", i, flush=True)
-            this_cluster_signal_map[i] = np.reshape(
-                np.load(file_path + f"/mask-{instance[2]}-id{instance[1]}.npy"),
-                newshape=dims,
-            )
+            this_cluster_signal_map += get_gsum_mask(
+                instance, dims, file_path, labels_path, mask_files
+            ).astype(np.float32)
 
-        all_signals_map[cluster] = np.sum(this_cluster_signal_map, axis=0)
+        all_signals_map[cluster] = this_cluster_signal_map
 
     return all_signals_map
 
@@ -289,6 +327,19 @@ def parse_args():
         action="store_true",
         help="Save the combined map of all clusters",
     )
+    parser.add_argument(
+        "--labels_path",
+        type=str,
+        dest="labels_path",
+        default=None,
+        help="Folder of the label files of the runs, defaults to the parent of file_path",
+    )
+    parser.add_argument(
+        "--mask_files",
+        dest="mask_files",
+        action="store_true",
+        help="Read the mask files written by earlier versions of sce.py instead of rebuilding the masks from the labels",
+    )
     return parser.parse_args()
 
 
@@ -347,7 +398,12 @@ if __name__ == "__main__":
     # save the separated SCE clusters
     if args.save_combined_map:
         combined_sce_clusters = combine_separated_clusters(
-            map_list, cluster_ranges, args.dims, args.file_path
+            map_list,
+            cluster_ranges,
+            args.dims,
+            args.file_path,
+            args.labels_path,
+            args.mask_files,
         )
         # save the new binary map
         np.save(
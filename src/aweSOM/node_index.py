@@ -0,0 +1,296 @@
+## Spatial index over the lattice nodes for exact BMU queries on large maps.
+## The nodes are split recursively along the feature with the largest spread, and each
+## tree node keeps the bounding box of its nodes. Queries prune subtrees by the distance
+## to these boxes, so the index stays exact even when the nodes move after the split, as
+## long as the boxes are expanded (or refitted) to cover the new node weights.
+
+import numpy as np
+from numba import njit, prange
+
+# below these sizes a linear scan over the nodes is faster than the index
+index_min_nodes = 1024
+index_max_features = 8
+
+
+def use_node_index(number_nodes: int, number_features: int) -> bool:
+    """Decide whether an index query is expected to beat a linear scan over the nodes.
+
+    Box pruning is effective for many nodes in few dimensions; in high dimensions most
+    boxes overlap the search sphere and the index degrades to a slower linear scan.
+
+    Args:
+        number_nodes (int): Number of nodes in the lattice.
+        number_features (int): Number of features per node.
+
+    Returns:
+        bool: True if the index should be used.
+    """
+    return number_nodes >= index_min_nodes and number_features <= index_max_features
+
+
+def build_node_index(lattice: np.ndarray, leaf_size: int = 16) -> tuple:
+    """Build a bounding-box tree over the nodes of a lattice.
+
+    Args:
+        lattice (np.ndarray): Node weights of shape [X*Y, F].
+        leaf_size (int, optional): Maximum number of nodes per leaf. Defaults to 16.
+
+    Returns:
+        tuple: (order, start, stop, left, right, parent, leaf_of, lower, upper). The nodes
+        of tree node t are order[start[t]:stop[t]]; left/right are -1 for leaves; leaf_of
+        maps each lattice node to its leaf; lower/upper are the bounding boxes. Children
+        always come after their parent.
+    """
+    number_nodes, number_features = lattice.shape
+    order = np.arange(number_nodes)
+    start, stop, left, right, parent = [], [], [], [], []
+
+    # depth-first split, so that every child gets a larger index than its parent
+    stack = [(0, number_nodes, -1, 0)]
+    while stack:
+        lo, hi, up, side = stack.pop()
+        t = len(start)
+        start.append(lo)
+        stop.append(hi)
+        left.append(-1)
+        right.append(-1)
+        parent.append(up)
+        if up >= 0:
+            if side == 0:
+                left[up] = t
+            else:
+                right[up] = t
+
+        if hi - lo > leaf_size:
+            points = lattice[order[lo:hi]]
+            axis = np.argmax(np.max(points, axis=0) - np.min(points, axis=0))
+            half = (hi - lo) // 2
+            split = np.argpartition(points[:, axis], half)
+            order[lo:hi] = order[lo:hi][split]
+            stack.append((lo + half, hi, t, 1))
+            stack.append((lo, lo + half, t, 0))
+
+    start = np.array(start, dtype=np.int64)
+    stop = np.array(stop, dtype=np.int64)
+    left = np.array(left, dtype=np.int64)
+    right = np.array(right, dtype=np.int64)
+    parent = np.array(parent, dtype=np.int64)
+
+    leaf_of = np.empty(number_nodes, dtype=np.int64)
+    for t in np.flatnonzero(left == -1):
+        leaf_of[order[start[t] : stop[t]]] = t
+
+    lower = np.empty((len(start), number_features), dtype=lattice.dtype)
+    upper = np.empty((len(start), number_features), dtype=lattice.dtype)
+    refit_node_index(lattice, order, start, stop, left, right, lower, upper)
+
+    return order, start, stop, left, right, parent, leaf_of, lower, upper
+
+
+@njit()
+def refit_node_index(
+    lattice: np.ndarray,
+    order: np.ndarray,
+    start: np.ndarray,
+    stop: np.ndarray,
+    left: np.ndarray,
+    right: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+):
+    """Recompute the tight bounding boxes of every tree node, bottom-up.
+
+    Args:
+        lattice (np.ndarray): Node weights of shape [X*Y, F].
+        order, start, stop, left, right (np.ndarray): Tree structure from build_node_index.
+        lower (np.ndarray): Lower corner of each box, updated in place.
+        upper (np.ndarray): Upper corner of each box, updated in place.
+    """
+    number_features = lattice.shape[1]
+    for t in range(start.shape[0] - 1, -1, -1):
+        if left[t] == -1:
+            for f in range(number_features):
+                lower[t, f] = lattice[order[start[t]], f]
+                upper[t, f] = lattice[order[start[t]], f]
+            for k in range(start[t] + 1, stop[t]):
+                for f in range(number_features):
+                    lower[t, f] = min(lower[t, f], lattice[order[k], f])
+                    upper[t, f] = max(upper[t, f], lattice[order[k], f])
+        else:
+            for f in range(number_features):
+                lower[t, f] = min(lower[left[t], f], lower[right[t], f])
+                upper[t, f] = max(upper[left[t], f], upper[right[t], f])
+
+
+@njit()
+def expand_node_index(
+    lattice: np.ndarray,
+    node: int,
+    parent: np.ndarray,
+    leaf_of: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+):
+    """Grow the boxes containing one lattice node so that they cover its new weights.
+
+    Args:
+        lattice (np.ndarray): Node weights of shape [X*Y, F].
+        node (int): The lattice node that moved.
+        parent, leaf_of (np.ndarray): Tree structure from build_node_index.
+        lower (np.ndarray): Lower corner of each box, updated in place.
+        upper (np.ndarray): Upper corner of each box, updated in place.
+    """
+    number_features = lattice.shape[1]
+    t = leaf_of[node]
+    while t != -1:
+        grown = False
+        for f in range(number_features):
+            if lattice[node, f] < lower[t, f]:
+                lower[t, f] = lattice[node, f]
+                grown = True
+            if lattice[node, f] > upper[t, f]:
+                upper[t, f] = lattice[node, f]
+                grown = True
+        if not grown:
+            break  # the ancestors already contain this box
+        t = parent[t]
+
+
+@njit()
+def query_node_index(
+    lattice: np.ndarray,
+    x: np.ndarray,
+    order: np.ndarray,
+    start: np.ndarray,
+    stop: np.ndarray,
+    left: np.ndarray,
+    right: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    stack: np.ndarray,
+    full: bool = False,
+) -> tuple:
+    """Exact nearest (and second nearest if full) node to x.
+
+    Distances are accumulated in the same order as a linear scan, and ties go to the
+    lower node index, so the result is identical to np.argmin over all nodes.
+
+    Args:
+        lattice (np.ndarray): Node weights of shape [X*Y, F].
+        x (np.ndarray): The query observation.
+        order, start, stop, left, right, lower, upper (np.ndarray): The index from build_node_index.
+        stack (np.ndarray): Scratch space with at least as many entries as tree nodes.
+        full (bool, optional): Whether to also search for the second nearest node. Defaults to False.
+
+    Returns:
+        tuple: (best_node, best_dist, second_node, second_dist), with squared distances.
+    """
+    number_features = lattice.shape[1]
+    best = np.inf
+    second = np.inf
+    best_node = 0
+    second_node = 0
+
+    stack[0] = 0
+    depth = 1
+    while depth > 0:
+        depth -= 1
+        t = stack[depth]
+
+        bound = 0.0
+        for f in range(number_features):
+            if x[f] < lower[t, f]:
+                gap = lower[t, f] - x[f]
+                bound += gap * gap
+            elif x[f] > upper[t, f]:
+                gap = x[f] - upper[t, f]
+                bound += gap * gap
+        if bound > (second if full else best):
+            continue
+
+        if left[t] == -1:
+            for k in range(start[t], stop[t]):
+                i = order[k]
+                s = 0.0
+                for f in range(number_features):
+                    diff = lattice[i, f] - x[f]
+                    s += diff * diff
+                if s < best or (s == best and i < best_node):
+                    second = best
+                    second_node = best_node
+                    best = s
+                    best_node = i
+                elif s < second or (s == second and i < second_node):
+                    second = s
+                    second_node = i
+        else:
+            # visit the child on the side of x first
+            a = left[t]
+            b = right[t]
+            gap_a = 0.0
+            gap_b = 0.0
+            for f in range(number_features):
+                gap_a += max(lower[a, f] - x[f], 0.0, x[f] - upper[a, f])
+                gap_b += max(lower[b, f] - x[f], 0.0, x[f] - upper[b, f])
+            if gap_a <= gap_b:
+                stack[depth] = b
+                stack[depth + 1] = a
+            else:
+                stack[depth] = a
+                stack[depth + 1] = b
+            depth += 2
+
+    return best_node, best, second_node, second
+
+
+@njit(parallel=True)
+def best_match_index_kernel(
+    lattice: np.ndarray,
+    obs: np.ndarray,
+    best_match_node: np.ndarray,
+    order: np.ndarray,
+    start: np.ndarray,
+    stop: np.ndarray,
+    left: np.ndarray,
+    right: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    full: bool = False,
+    node_clusters=None,
+):
+    """Fill best_match_node with the best (and second best if full) matching node of each observation, using the index.
+
+    Args:
+        lattice (np.ndarray): Node weights of shape [X*Y, F].
+        obs (np.ndarray): Observations (input vectors).
+        best_match_node (np.ndarray): n x 1 (or n x 2 if full) output array.
+        order, start, stop, left, right, lower, upper (np.ndarray): The index from build_node_index.
+        full (bool, optional): Whether to return the first and second best match. Defaults to False.
+        node_clusters (np.ndarray, optional): Cluster id of each node; if given, the cluster id of the best match is
+            written instead of its index. Defaults to None.
+    """
+    number_obs = obs.shape[0]
+    number_blocks = min(number_obs, 1024)
+    block_size = (number_obs + number_blocks - 1) // number_blocks if number_obs else 0
+    for b in prange(number_blocks):
+        stack = np.empty(start.shape[0] + 1, dtype=np.int64)
+        for k in range(b * block_size, min((b + 1) * block_size, number_obs)):
+            best_node, _, second_node, _ = query_node_index(
+                lattice,
+                obs[k],
+                order,
+                start,
+                stop,
+                left,
+                right,
+                lower,
+                upper,
+                stack,
+                full,
+            )
+            if node_clusters is not None:
+                best_match_node[k, 0] = node_clusters[best_node]
+            else:
+                best_match_node[k, 0] = best_node
+                if full:
+                    best_match_node[k, 1] = second_node
@@ -8,6 +8,7 @@ from sklearn.preprocessing import MinMaxScaler
 import numpy as np
 
 import pickle
+from functools import partial
 from pathlib import Path
 
 def batch_separator(data: np.ndarray, number_of_batches: int) -> np.ndarray:
@@ -25,7 +26,7 @@ def batch_separator(data: np.ndarray, number_of_batches: int) -> np.ndarray:
     f = data.shape[1]
     batch_size = N // number_of_batches
 
-    batches = np.zeros((number_of_batches, batch_size, f))
+    batches = np.zeros((number_of_batches, batch_size, f), dtype=data.dtype)
     for i in range(number_of_batches):
         batches[i] = data[i * batch_size : (i + 1) * batch_size]
 
@@ -64,18 +65,60 @@ def initialize_lattice(data: np.ndarray, ratio: float) -> list[int]:
     return [xdim, ydim]
 
 
-def manual_scaling(data: np.ndarray, bulk_range: float = 1.0) -> np.ndarray:
+def scaling_statistics(data, chunk_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """Mean and standard deviation of each feature, read chunk by chunk in two passes over the data.
+
+    Args:
+        data (array-like): N x f data read with row slices, e.g. an h5py dataset or a memory-mapped .npy file
+        chunk_size (int): number of data points read at once
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: (mean, std) of each feature, in float64
+    """
+    N = data.shape[0]
+    total = np.zeros(data.shape[1])
+    for start in range(0, N, chunk_size):
+        total += np.sum(data[start : start + chunk_size], axis=0, dtype=np.float64)
+    mean = total / N
+
+    squares = np.zeros(data.shape[1])
+    for start in range(0, N, chunk_size):
+        deviation = data[start : start + chunk_size] - mean
+        squares += np.sum(deviation * deviation, axis=0)
+    return mean, np.sqrt(squares / N)
+
+
+def manual_scaling(
+    data: np.ndarray,
+    bulk_range: float = 1.0,
+    dtype: np.dtype = None,
+    statistics: tuple[np.ndarray, np.ndarray] = None,
+) -> np.ndarray:
     """Scale data to a range that centers on 0. and contains 95% of the data within the range.
 
     Args:
         data (np.ndarray): 2d array of data (N x f)
         bulk_range (float, optional): The extent to which 95% of the data resides in. Defaults to 1..
+        dtype (np.dtype, optional): Floating point type of the scaled data. Defaults to the type of data if it is floating point, float64 otherwise.
+        statistics (tuple[np.ndarray, np.ndarray], optional): (mean, std) of each feature of the full dataset, see
+            scaling_statistics, to scale one chunk of it. Defaults to None, for the statistics of data.
 
     Returns:
         np.ndarray: scaled data
     """
-    two_sigma = 2.0 * np.std(data, axis=0)
-    return (data - np.mean(data, axis=0)) / two_sigma * bulk_range
+    if dtype is None:
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+    dtype = np.dtype(dtype)
+
+    # the statistics are accumulated in float64, the scaling is done in the requested precision
+    if statistics is None:
+        statistics = (
+            np.mean(data, axis=0, dtype=np.float64),
+            np.std(data, axis=0, dtype=np.float64),
+        )
+    mean = statistics[0].astype(dtype)
+    two_sigma = (2.0 * statistics[1]).astype(dtype)
+    return (data.astype(dtype, copy=False) - mean) / two_sigma * dtype.type(bulk_range)
 
 
 def save_som_object(
@@ -147,6 +190,48 @@ def save_cluster_labels(
     )
 
 
+def open_cluster_labels(
+    number_of_points: int,
+    dtype: np.dtype,
+    xdim: int,
+    ydim: int,
+    alpha_0: float,
+    train: int,
+    batch: int = 1,
+    initial: str = "s",
+    name_of_dataset: str = "",
+    direct="./",
+) -> np.memmap:
+    """
+    Preallocate the cluster labels file as a memory-mapped numpy array, so that the labels can be written in chunks.
+
+    The file has the same name and format as the one written by save_cluster_labels.
+
+    Args:
+        number_of_points (int): The number of data points.
+        dtype (np.dtype): The integer type of the cluster labels.
+        xdim (int): The x-dimension of the SOM grid.
+        ydim (int): The y-dimension of the SOM grid.
+        alpha_0 (float): The initial learning rate.
+        train (int): The number of training iterations.
+        batch (int, optional): The batch size. Defaults to 1.
+        initial (str, optional): The type of initialization. Defaults to "s".
+        name_of_dataset (str, optional): The name of the dataset. Defaults to "".
+
+    Returns:
+        np.memmap: Writable array of length number_of_points backed by the labels file.
+    """
+
+    return np.lib.format.open_memmap(
+        direct
+        + "/"
+        + f"labels.{name_of_dataset}-{xdim}-{ydim}-{alpha_0}-{train}-{batch}{initial}.npy",
+        mode="w+",
+        dtype=dtype,
+        shape=(number_of_points,),
+    )
+
+
 def parse_args():
     """CLI argument parser for run_som.py script."""
     parser = argparse.ArgumentParser(description="SOM code")
@@ -223,6 +308,49 @@ def parse_args():
         help="Path to file containing lattice values",
         required=False,
     )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        dest="dtype",
+        default="float64",
+        choices=["float32", "float64"],
+        help="Floating point precision of the data and lattice",
+        required=False,
+    )
+    parser.add_argument(
+        "--grid_shape",
+        type=int,
+        nargs="+",
+        dest="grid_shape",
+        default=None,
+        help="Shape of the simulation grid the features were flattened from (C order), e.g. nx ny nz; enables the warm-start mapping",
+        required=False,
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        dest="chunk_size",
+        default=None,
+        help="Read, scale and map the data in chunks of this many points and write the labels straight to disk; the training data are read one batch at a time (see --batch)",
+        required=False,
+    )
+    parser.add_argument(
+        "--history",
+        type=str,
+        dest="history",
+        default="all",
+        choices=["all", "last", "disk", "off"],
+        help="Lattice snapshots kept during training: all, the last history_size, on disk in an HDF5 file, or off",
+        required=False,
+    )
+    parser.add_argument(
+        "--history_size",
+        type=int,
+        dest="history_size",
+        default=None,
+        help="Number of snapshots kept with --history last",
+        required=False,
+    )
     parser.add_argument(
         "--threshold",
         type=float,
@@ -257,16 +385,28 @@ if __name__ == "__main__":
     pretrained = args.pretrained
     neurons_path = args.neurons_path
     threshold = args.threshold
+    grid_shape = args.grid_shape
+    chunk_size = args.chunk_size
+    history = args.history
+    history_size = args.history_size
+    dtype = np.dtype(args.dtype)
 
     name_of_dataset = file_name.split("_")[2].split(".h5")[
         0
     ]  # all the data laps to process
 
-    # load data
-    with h5.File(features_path + file_name, "r") as f5:
+    # load data; with --chunk_size the features stay in the file and are read with row slices
+    f5 = h5.File(features_path + file_name, "r")
+    feature_list = [n.decode("utf-8") for n in f5["names"][()]]
+    if chunk_size is None:
         x = f5["features"][()]
-        feature_list = f5["names"][()]
-    feature_list = [n.decode("utf-8") for n in feature_list]
+        f5.close()
+    else:
+        if grid_shape is not None:
+            sys.exit(
+                "--grid_shape can not be combined with --chunk_size: the warm-start mapping needs all the data in memory"
+            )
+        x = f5["features"]
 
     # figure out the number of training steps
     if train is None:
@@ -293,64 +433,112 @@ if __name__ == "__main__":
 
     # normalize data
     scale_method = "manual"
-    if scale_method == "manual":
-        data_transformed = manual_scaling(x)
+    if chunk_size is not None:
+        # statistics of the whole file; each batch and chunk is scaled when it is read
+        statistics = scaling_statistics(x, chunk_size)
+        scale = partial(manual_scaling, dtype=dtype, statistics=statistics)
+        data_transformed = None
+    elif scale_method == "manual":
+        data_transformed = manual_scaling(x, dtype=dtype)
     else:
         scaler = MinMaxScaler()
-        data_transformed = scaler.fit_transform(x)
+        data_transformed = scaler.fit_transform(x).astype(dtype, copy=False)
         scale_method = "MinMaxScaler"
     print(f"Data scaled with {scale_method}", flush=True)
 
+    if init_lattice == "sampling":
+        initial = "s"
+    else:
+        initial = "u"
+
     # initialize SOM lattice
     som = Lattice(
-        xdim, ydim, alpha_0, train, alpha_type="decay", sampling_type=init_lattice
+        xdim,
+        ydim,
+        alpha_0,
+        train,
+        alpha_type="decay",
+        sampling_type=init_lattice,
+        dtype=dtype,
+        history=history,
+        history_size=history_size,
+        history_path=f"lattice_history.{name_of_dataset}-{xdim}-{ydim}-{alpha_0}-{train}-{batch}{initial}.h5",
     )
 
     # train SOM
+    if chunk_size is not None:
+        # only one batch is read from the file and kept in memory at a time
+        batch_size = len(x) // batch
+        data_by_batch = (
+            scale(x[i * batch_size : (i + 1) * batch_size]) for i in range(batch)
+        )
+    elif batch > 1:
+        data_by_batch = iter(batch_separator(data_transformed, batch))
+    else:
+        data_by_batch = iter([data_transformed])
+
     if batch == 1:
         som.train_lattice(
-            data_transformed,
+            next(data_by_batch),
             feature_list,
         )
     else:
         print(f"Training batch 1/{batch}", flush=True)
-        data_by_batch = batch_separator(data_transformed, batch)
-        som.train_lattice(
-            data_by_batch[0], feature_list, number_of_steps=data_by_batch[0].shape[0]
-        )
+        data_batch = next(data_by_batch)
+        som.train_lattice(data_batch, feature_list, number_of_steps=data_batch.shape[0])
         lattice_weights = som.lattice
 
         for i in range(1, batch):
             print(f"Training batch {i+1}/{batch}", flush=True)
+            data_batch = next(data_by_batch)
             som.train_lattice(
-                data_by_batch[i],
+                data_batch,
                 feature_list,
-                number_of_steps=data_by_batch[i].shape[0],
+                number_of_steps=data_batch.shape[0],
                 restart_lattice=lattice_weights,
             )
             lattice_weights = som.lattice
 
     print(f"Random seed: {som.seed}", flush=True)
 
-    # map data to lattice
-    som.data_array = data_transformed  # recover the full dataset instead of the batch
-    projection_2d = som.map_data_to_lattice()
+    if chunk_size is None:
+        # map data to lattice
+        # recover the full dataset instead of the batch
+        som.data_array = data_transformed
+        projection_2d = som.map_data_to_lattice(grid_shape=grid_shape)
 
-    # assign cluster ids to the lattice
-    clusters = som.assign_cluster_to_lattice(smoothing=None, merge_cost=threshold)
+        # assign cluster ids to the lattice
+        clusters = som.assign_cluster_to_lattice(smoothing=None, merge_cost=threshold)
 
-    # assign cluster ids to the data
-    som_labels = som.assign_cluster_to_data(projection_2d, clusters)
+        # assign cluster ids to the data
+        som_labels = som.assign_cluster_to_data(projection_2d, clusters)
 
-    if init_lattice == "sampling":
-        initial = "s"
+        # save cluster ids
+        save_cluster_labels(
+            som_labels, xdim, ydim, alpha_0, train, batch, initial, name_of_dataset
+        )
     else:
-        initial = "u"
-
-    # save cluster ids
-    save_cluster_labels(
-        som_labels, xdim, ydim, alpha_0, train, batch, initial, name_of_dataset
-    )
+        # assign cluster ids to the lattice, then map the data chunk by chunk straight into the labels file
+        clusters = som.assign_cluster_to_lattice(smoothing=None, merge_cost=threshold)
+        som_labels = open_cluster_labels(
+            len(x),
+            clusters.dtype,
+            xdim,
+            ydim,
+            alpha_0,
+            train,
+            batch,
+            initial,
+            name_of_dataset,
+        )
+        som.map_data_chunked(
+            x, labels=som_labels, chunk_size=chunk_size, transform=scale
+        )
+        som_labels.flush()
+        f5.close()
+        print(
+            f"Cluster labels saved to labels.{name_of_dataset}-{xdim}-{ydim}-{alpha_0}-{train}-{batch}{initial}.npy"
+        )
 
     # save som object
     save_som_object(som, xdim, ydim, alpha_0, train, batch, initial, name_of_dataset)
@@ -6,8 +6,11 @@
 
 import os
 import glob
+import json
 import argparse
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit, prange, config, get_num_threads, get_thread_id, set_num_threads
 
 # Use JAX if GPU and the jax package is installed, otherwise use NumPy
 # added support for experimental JAX backend with METAL on Apple silicon
@@ -47,6 +50,115 @@ def load_som_npy(path: str) -> array_lib.ndarray:
     return array_lib.load(path, "r")
 
 
+class RunCache:
+    def __init__(
+        self,
+        all_files: list[str],
+        index_file: str = None,
+        device_bytes: int = None,
+        device: bool = False,
+        runs: list[int] = None,
+    ):
+        """Label files of the runs, each opened once as a memory map, with their number of clusters.
+
+        The number of clusters, largest id, dtype and shape of each file are recorded in a JSON sidecar index, so
+        that they are only computed again for files that changed (different size or modification time).
+        With runs, only those runs are opened and indexed, e.g. the runs compared by one shard; the others are
+        None, with -1 clusters.
+
+        Args:
+            all_files (list[str]): A list of data files saved in '.npy' format.
+            index_file (str, optional): The sidecar index file, read and updated. Defaults to None, for no index.
+            device_bytes (int, optional): With device, the runs are copied to the device as long as their total size
+                stays below this number of bytes. Defaults to None, for half of the device memory if it is known.
+            device (bool, optional): Whether to copy the runs to the JAX device, for the masks engine; the contingency
+                engine reads them on the CPU. Ignored without JAX. Defaults to False.
+            runs (list[int], optional): The indices of the runs to open. Defaults to None, for all of them.
+        """
+        self.files = list(all_files)
+        self.index_file = index_file
+
+        index = {}
+        if index_file is not None and os.path.exists(index_file):
+            with open(index_file, "r") as f:
+                index = json.load(f)
+
+        self.handles = [None] * len(self.files)
+        self.entries = [None] * len(self.files)
+        changed = {}
+        for r in range(len(self.files)) if runs is None else sorted(set(runs)):
+            path = self.files[r]
+            labels = np.load(path, mmap_mode="r")
+            stat = os.stat(path)
+            entry = index.get(path)
+            if (
+                entry is None
+                or entry["size"] != stat.st_size
+                or entry["mtime"] != stat.st_mtime
+            ):
+                counts = np.bincount(np.ravel(labels))  # cluster ids are non-negative
+                entry = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                    "dtype": str(labels.dtype),
+                    "shape": list(labels.shape),
+                    "number_of_clusters": int(np.count_nonzero(counts)),
+                    "max_id": len(counts) - 1,
+                }
+                changed[path] = entry
+            self.handles[r] = labels
+            self.entries[r] = entry
+
+        if changed and index_file is not None:
+            # several shards may update the index at the same time: the entries of the others are read again just
+            # before, and it is written under another name first
+            if os.path.exists(index_file):
+                with open(index_file, "r") as f:
+                    index = json.load(f)
+            index.update(changed)
+            temporary_file = "{}.{}".format(index_file, os.getpid())
+            with open(temporary_file, "w") as f:
+                json.dump(index, f, indent=1)
+            os.replace(temporary_file, index_file)
+
+        if USE_JAX and device:
+            if device_bytes is None:
+                stats = jax.devices()[0].memory_stats() or {}
+                device_bytes = stats.get("bytes_limit", 0) // 2
+            used = 0
+            for i, labels in enumerate(self.handles):
+                if labels is None:
+                    continue
+                if used + labels.nbytes > device_bytes:
+                    break
+                self.handles[i] = jnp.asarray(labels)
+                used += labels.nbytes
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __getitem__(self, i: int):
+        """The cluster ids of run i, as a memory map or a device array, or None if it was not opened"""
+        return self.handles[i]
+
+    @property
+    def number_of_clusters(self) -> np.ndarray:
+        """The number of cluster ids in each run, -1 for the runs not opened"""
+        return np.array(
+            [
+                -1 if entry is None else entry["number_of_clusters"]
+                for entry in self.entries
+            ]
+        )
+
+    @property
+    def max_ids(self) -> np.ndarray:
+        """The largest cluster id in each run, -1 for the runs not opened"""
+        return np.array(
+            [-1 if entry is None else entry["max_id"] for entry in self.entries]
+        )
+
+
 @conditional_jit
 def create_mask(img: array_lib.ndarray, cid: int) -> array_lib.ndarray:
     """Create a mask for a given cluster id
@@ -106,96 +218,427 @@ def compute_SQ(mask: array_lib.ndarray, maskC: array_lib.ndarray):
     return SQ, SQ_matrix
 
 
+def SQ_from_masks(
+    clusters: array_lib.ndarray, clustersC: array_lib.ndarray, nids: int, nidsC: int
+) -> np.ndarray:
+    """Quality index of each pair of clusters of two runs, from their masks
+
+    Args:
+        clusters ((j)np.ndarray): cluster ids of run i
+        clustersC ((j)np.ndarray): cluster ids of run j, same shape as clusters
+        nids (int): number of cluster ids of run i; ids 0 to nids - 1 are compared
+        nidsC (int): number of cluster ids of run j; ids 0 to nidsC - 1 are compared
+
+    Returns:
+        np.ndarray: nids x nidsC array of S/Q, see compute_SQ
+    """
+    SQ_table = np.zeros((nids, nidsC))
+    for cid in range(nids):
+        # create masked array where only id == cid are visible
+        mask = create_mask(clusters, cid)
+        for cidC in range(nidsC):
+            maskC = create_mask(clustersC, cidC)
+            SQ, _ = compute_SQ(mask, maskC)
+            SQ_table[cid, cidC] = SQ
+    return SQ_table
+
+
 def loop_over_all_clusters(
     all_files: list[str],
     number_of_clusters: array_lib.ndarray,
     dimensions: np.ndarray,
     subfolder: str = "SCE",
+    cache: RunCache = None,
+    workers: int = None,
 ) -> int:
     """
     Loops over all clusters in the given data, compute goodness-of-fit, then save Gsum values to file.
 
+    Only the Gsum values are saved: the total mask of a cluster is its mask times its Gsum value, and is rebuilt
+    from the run files when needed (see make_sce_clusters.get_gsum_mask).
+
     Args:
         all_files (list[str]): A list of data files saved in '.npy' format.
         number_of_clusters ((j)np.ndarray): An array of the number of cluster ids in each run.
         dimensions (np.ndarray): A 1d array representing the dimensions of the clusters (can be any dimension but nx*ny*nz has to be equal to number of data points).
         subfolder (str): The name of the subfolder to save the results to.
+        cache (RunCache, optional): The opened runs of all_files. Defaults to None, which opens them.
+        workers (int, optional): Number of pairs of runs compared at the same time. Defaults to None, one at a time.
 
     Returns:
         Save Gsum value of each cluster C to a file.
     """
-    pass
+    if cache is None:
+        cache = RunCache(all_files, device=True)
+    SQ_tables = compute_SQ_tables(
+        cache,
+        number_of_clusters,
+        dimensions,
+        run_pairs(len(all_files)),
+        "masks",
+        workers,
+    )
+    write_gsum(all_files, gsum_from_SQ_tables(SQ_tables, number_of_clusters), subfolder)
 
-    runs = all_files  # [file.strip('.npy') for file in all_files]
+    return 0
 
-    # loop over data files reading image by image
-    for i in range(len(runs)):
-        run = runs[i]
 
-        clusters_1d = load_som_npy(run)
-        print("-----------------------")
-        print("Run : ", run, flush=True)
+@njit(parallel=True)
+def contingency_kernel(labels: np.ndarray, labelsC: np.ndarray, table: np.ndarray):
+    """Count the points of each pair of cluster ids of two runs, with a table per thread
 
-        with open(subfolder + "/multimap_mappings.txt", "a") as f:
-            f.write("{}\n".format(run.strip(".npy")))
+    Args:
+        labels (np.ndarray): 1d array of cluster ids of run i
+        labelsC (np.ndarray): 1d array of cluster ids of run j, same length as labels
+        table (np.ndarray): table[c, c'] is incremented by the number of points with id c in run i and c' in run j
+    """
+    number_points = labels.shape[0]
+    number_threads = get_num_threads()
+    thread_tables = np.zeros((number_threads,) + table.shape, dtype=np.int64)
 
-        # nx x ny x nz size maps
-        # nz,ny,nx = array_lib.cbrt(clusters_1d.shape[0]).astype(int), array_lib.cbrt(clusters_1d.shape[0]).astype(int), array_lib.cbrt(clusters_1d.shape[0]).astype(int)
-        # clusters = clusters_1d.reshape(nz,ny,nx)
-        clusters = clusters_1d.reshape(dimensions)
+    number_blocks = min(number_points, 4096)
+    block_size = (
+        (number_points + number_blocks - 1) // number_blocks if number_points else 0
+    )
+    for b in prange(number_blocks):
+        thread = get_thread_id()
+        for k in range(b * block_size, min((b + 1) * block_size, number_points)):
+            thread_tables[thread, labels[k], labelsC[k]] += 1
 
-        # unique ids
-        nids = number_of_clusters[i]  # number of cluster ids in this run
-        # ids = np.arange(nids)
-        print("nids : ", nids)
+    for thread in range(number_threads):
+        table += thread_tables[thread]
 
-        for cid in range(nids):
-            # print('  -----------------------')
-            # print('  cid : ', cid, flush=True)
 
-            # create masked array where only id == cid are visible
-            mask = create_mask(clusters, cid)
+def contingency_table(
+    labels: np.ndarray, labelsC: np.ndarray, shape: tuple = None
+) -> np.ndarray:
+    """Contingency table of the cluster ids of two runs
 
-            total_mask = array_lib.zeros(dimensions, dtype=float)
+    Args:
+        labels (np.ndarray): cluster ids of run i
+        labelsC (np.ndarray): cluster ids of run j, same number of points as labels
+        shape (tuple, optional): largest id of each run plus one, if known. Defaults to None, which finds them.
 
-            total_SQ_scalar = 0.0
+    Returns:
+        np.ndarray: table[c, c'] = |C ∩ C'|, the number of points with id c in run i and c' in run j
+    """
+    labels = np.ravel(labels)
+    labelsC = np.ravel(labelsC)
+    if labels.shape != labelsC.shape:
+        raise ValueError("contingency_table: runs have different numbers of points")
+    if shape is None:
+        shape = (
+            int(np.max(labels, initial=0)) + 1,
+            int(np.max(labelsC, initial=0)) + 1,
+        )
+    table = np.zeros(shape, dtype=np.int64)
+    contingency_kernel(labels, labelsC, table)
+    return table
+
+
+def SQ_from_contingency(table: np.ndarray, nids: int, nidsC: int) -> np.ndarray:
+    """Quality index of each pair of clusters of two runs, from their contingency table
+
+    The sizes of the clusters are the row and column sums of the table, so the intersection and union of every pair
+    of masks are known without building the masks. The expressions are those of compute_SQ, so the values are the same.
 
-            for j in range(len(runs)):
-                runC = runs[j]
+    Args:
+        table (np.ndarray): contingency table of the two runs, see contingency_table
+        nids (int): number of cluster ids of run i; ids 0 to nids - 1 are compared
+        nidsC (int): number of cluster ids of run j; ids 0 to nidsC - 1 are compared
 
-                if j == i:  # don't compare to itself
-                    continue
+    Returns:
+        np.ndarray: nids x nidsC array of S/Q, 0 where compute_SQ returns 0
+    """
+    padded = np.zeros(
+        (max(nids, table.shape[0]), max(nidsC, table.shape[1])), dtype=np.int64
+    )
+    padded[: table.shape[0], : table.shape[1]] = table
+    size = np.sum(padded, axis=1)[:nids, np.newaxis]  # |C|
+    sizeC = np.sum(padded, axis=0)[np.newaxis, :nidsC]  # |C'|
+    intersection = padded[:nids, :nidsC]  # |C ∩ C'|
+    union = (size + sizeC - intersection).astype(float)  # |C ∪ C'|
 
-                clustersC_1d = load_som_npy(runC)
-                clustersC = clustersC_1d.reshape(dimensions)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        S = intersection / union
+        Q = union / (size + sizeC) - intersection / (size + sizeC)
+        SQ = S / Q
+    return np.where((size == 0) | (sizeC == 0) | (Q == 0.0), 0.0, SQ)
 
-                # print('    -----------------------')
-                # print('   ',runC, flush=True)
 
-                nidsC = number_of_clusters[j]  # number of cluster ids in this run
-                # print('    nidsC : ', nidsC)
+def run_pairs(number_of_runs: int) -> list[tuple]:
+    """The pairs (i, j) of runs with i < j, in order
 
-                for cidC in range(nidsC):
-                    maskC = create_mask(clustersC, cidC)
+    The quality index is symmetric, so the pair (j, i) is the transpose of the pair (i, j) and is not computed.
 
-                    SQ, SQ_matrix = compute_SQ(mask, maskC)
+    Args:
+        number_of_runs (int): number of runs
 
-                    # pixelwise stacking of 2 masks
-                    total_mask += SQ_matrix  # for numpy array
+    Returns:
+        list[tuple]: the pairs of run indices
+    """
+    return [(i, j) for i in range(number_of_runs) for j in range(i + 1, number_of_runs)]
 
-                    total_SQ_scalar += SQ
 
-            # save total mask to file
-            # print("Saving total mask to file", flush=True)
-            array_lib.save(
-                subfolder + "/mask-{}-id{}.npy".format(run.strip(".npy"), cid),
-                total_mask,
+def compute_SQ_tables(
+    cache: RunCache,
+    number_of_clusters: np.ndarray,
+    dimensions: np.ndarray,
+    pairs: list[tuple],
+    engine: str = "contingency",
+    workers: int = None,
+) -> dict:
+    """Quality index of each pair of clusters, for the given pairs of runs
+
+    With the contingency engine, the pairs are counted one after the other, each by all the numba threads over blocks
+    of points with a table per thread (workers threads, defaults to the numba default). With the masks engine, workers
+    pairs are compared at the same time in a thread pool (defaults to one). The tables do not depend on workers.
+
+    Args:
+        cache (RunCache): the opened runs
+        number_of_clusters (np.ndarray): An array of the number of cluster ids in each run.
+        dimensions (np.ndarray): A 1d array representing the dimensions of the clusters.
+        pairs (list[tuple]): the pairs (i, j) of runs to compare, see run_pairs
+        engine (str, optional): "contingency" or "masks". Defaults to "contingency".
+        workers (int, optional): number of threads. Defaults to None.
+
+    Returns:
+        dict: SQ_tables[i, j] is the nids_i x nids_j array of S/Q, for each pair (i, j) and its transpose (j, i)
+    """
+    max_ids = cache.max_ids
+
+    def compare(pair):
+        i, j = pair
+        if engine == "contingency":
+            table = contingency_table(
+                np.asarray(cache[i]),
+                np.asarray(cache[j]),
+                (max_ids[i] + 1, max_ids[j] + 1),
+            )
+            return SQ_from_contingency(
+                table, number_of_clusters[i], number_of_clusters[j]
             )
+        return SQ_from_masks(
+            cache[i].reshape(dimensions),
+            cache[j].reshape(dimensions),
+            number_of_clusters[i],
+            number_of_clusters[j],
+        )
+
+    if engine == "contingency":
+        previous_threads = get_num_threads()
+        if workers is not None:
+            set_num_threads(min(workers, config.NUMBA_NUM_THREADS))
+        try:
+            tables = [compare(pair) for pair in pairs]
+        finally:
+            set_num_threads(previous_threads)
+    else:
+        with ThreadPoolExecutor(max_workers=workers or 1) as pool:
+            tables = list(pool.map(compare, pairs))
+
+    SQ_tables = {}
+    for (i, j), table in zip(pairs, tables):
+        SQ_tables[i, j] = table
+        SQ_tables[j, i] = table.T
+    return SQ_tables
+
 
-            # print("Saving total SQ scalar to multimap_mapping", flush=True)
-            with open(subfolder + "/multimap_mappings.txt", "a") as f:
+def gsum_from_SQ_tables(SQ_tables: dict, number_of_clusters: np.ndarray) -> list:
+    """Gsum value of each cluster, the sum of its quality indices with the clusters of all other runs
+
+    The values are summed one by one, over the runs j then the clusters of run j, so the result does not depend on
+    how the tables were computed.
+
+    Args:
+        SQ_tables (dict): tables of quality indices of all pairs of runs, see compute_SQ_tables
+        number_of_clusters (np.ndarray): An array of the number of cluster ids in each run.
+
+    Returns:
+        list: gsum[i][cid] is the Gsum value of cluster cid of run i
+    """
+    number_of_runs = len(number_of_clusters)
+    gsum = []
+    for i in range(number_of_runs):
+        totals = []
+        for cid in range(number_of_clusters[i]):
+            total_SQ_scalar = 0.0
+            for j in range(number_of_runs):
+                if j == i:  # don't compare to itself
+                    continue
+                for SQ in SQ_tables[i, j][cid].tolist():
+                    total_SQ_scalar += SQ
+            totals.append(total_SQ_scalar)
+        gsum.append(totals)
+    return gsum
+
+
+def write_gsum(all_files: list[str], gsum: list, subfolder: str = "SCE"):
+    """Append the Gsum values to multimap_mappings.txt: the name of each run, then a line 'cid Gsum' per cluster
+
+    Args:
+        all_files (list[str]): A list of data files saved in '.npy' format.
+        gsum (list): Gsum values of the clusters of each run, see gsum_from_SQ_tables
+        subfolder (str): The name of the subfolder to save the results to.
+    """
+    with open(subfolder + "/multimap_mappings.txt", "a") as f:
+        for run, totals in zip(all_files, gsum):
+            print("-----------------------")
+            print("Run : ", run, flush=True)
+            print("nids : ", len(totals))
+            f.write("{}\n".format(run.removesuffix(".npy")))
+            for cid, total_SQ_scalar in enumerate(totals):
                 f.write("{} {}\n".format(cid, total_SQ_scalar))
 
+
+def shard_pairs(number_of_runs: int, shard: int, number_of_shards: int) -> list[tuple]:
+    """The pairs of runs compared by shard k of n: every n-th pair of run_pairs, starting from the k-th
+
+    The split only depends on the number of runs, so the shards can be run in any order, by any scheduler.
+
+    Args:
+        number_of_runs (int): number of runs
+        shard (int): index k of the shard, from 0 to n - 1
+        number_of_shards (int): number n of shards
+
+    Returns:
+        list[tuple]: the pairs of run indices of this shard
+    """
+    return run_pairs(number_of_runs)[shard::number_of_shards]
+
+
+def write_shard(
+    path: str,
+    all_files: list[str],
+    number_of_clusters: np.ndarray,
+    SQ_tables: dict,
+    pairs: list[tuple],
+):
+    """Save the tables of quality indices of the pairs of runs of one shard, see merge_shards
+
+    Args:
+        path (str): the shard file, in '.npz' format
+        all_files (list[str]): A list of data files saved in '.npy' format.
+        number_of_clusters (np.ndarray): An array of the number of cluster ids in each run, -1 for the runs that
+            the shard did not open.
+        SQ_tables (dict): tables of quality indices, see compute_SQ_tables
+        pairs (list[tuple]): the pairs (i, j) of runs of this shard
+    """
+    tables = {"SQ_{}_{}".format(i, j): SQ_tables[i, j] for i, j in pairs}
+    # written under another name first, so that merge_shards never reads a partial shard
+    temporary_file = path + ".tmp"
+    with open(temporary_file, "wb") as f:
+        np.savez(
+            f,
+            files=np.array(all_files),
+            number_of_clusters=np.asarray(number_of_clusters),
+            pairs=np.array(pairs, dtype=np.int64).reshape(-1, 2),
+            **tables,
+        )
+    os.replace(temporary_file, path)
+
+
+def merge_shards(subfolder: str = "SCE") -> int:
+    """Combine the shard files of subfolder into multimap_mappings.txt
+
+    The Gsum values are summed in the same order as loop_over_all_clusters, so the output is identical to a run
+    without shards. Each shard only knows the number of clusters of the runs it opened; they are combined here.
+
+    Args:
+        subfolder (str): The subfolder with the shard files, where the results are saved.
+
+    Returns:
+        Save Gsum value of each cluster C to a file.
+    """
+    paths = sorted(glob.glob(subfolder + "/shard-*-of-*.npz"))
+    if not paths:
+        raise ValueError("merge_shards: no shard files in {}".format(subfolder))
+
+    all_files = None
+    shards = set()
+    SQ_tables = {}
+    for path in paths:
+        name = os.path.basename(path)[len("shard-") : -len(".npz")]
+        shard, number = (int(part) for part in name.split("-of-"))
+        with np.load(path) as data:
+            files = data["files"].tolist()
+            shard_clusters = data["number_of_clusters"]
+            if all_files is None:
+                all_files = files
+                number_of_clusters = np.full(len(files), -1, dtype=np.int64)
+                number_of_shards = number
+            if (
+                files != all_files
+                or number != number_of_shards
+                or np.any(
+                    (shard_clusters != number_of_clusters)
+                    & (shard_clusters >= 0)
+                    & (number_of_clusters >= 0)
+                )
+            ):
+                raise ValueError(
+                    "merge_shards: {} comes from a different set of runs or shards".format(
+                        path
+                    )
+                )
+            number_of_clusters = np.maximum(number_of_clusters, shard_clusters)
+            for i, j in data["pairs"].tolist():
+                SQ_tables[i, j] = data["SQ_{}_{}".format(i, j)]
+                SQ_tables[j, i] = SQ_tables[i, j].T
+        shards.add(shard)
+
+    missing = sorted(set(range(number_of_shards)) - shards)
+    if missing:
+        raise ValueError(
+            "merge_shards: missing shards {} of {}".format(missing, number_of_shards)
+        )
+
+    with open(subfolder + "/multimap_mappings.txt", "w") as f:
+        f.write("")
+    write_gsum(all_files, gsum_from_SQ_tables(SQ_tables, number_of_clusters), subfolder)
+
+    return 0
+
+
+def loop_over_all_clusters_contingency(
+    all_files: list[str],
+    number_of_clusters: np.ndarray,
+    dimensions: np.ndarray,
+    subfolder: str = "SCE",
+    cache: RunCache = None,
+    workers: int = None,
+) -> int:
+    """
+    Same as loop_over_all_clusters, with the quality indices read from the contingency tables of each pair of runs.
+
+    Each pair of runs is read once, and a single counting pass gives the quality index of all pairs of their
+    clusters, so the work is O(R^2 * N) instead of O(R^2 * C^2 * N) for R runs of N points with C clusters. The Gsum
+    values are summed in the same order as loop_over_all_clusters, and the output is identical. This engine always
+    runs on the CPU, with NumPy and numba.
+
+    Args:
+        all_files (list[str]): A list of data files saved in '.npy' format.
+        number_of_clusters (np.ndarray): An array of the number of cluster ids in each run.
+        dimensions (np.ndarray): A 1d array representing the dimensions of the clusters (can be any dimension but nx*ny*nz has to be equal to number of data points).
+        subfolder (str): The name of the subfolder to save the results to.
+        cache (RunCache, optional): The opened runs of all_files. Defaults to None, which opens them.
+        workers (int, optional): Number of numba threads counting the points. Defaults to None, the numba default.
+
+    Returns:
+        Save Gsum value of each cluster C to a file.
+    """
+    if cache is None:
+        cache = RunCache(all_files)
+    SQ_tables = compute_SQ_tables(
+        cache,
+        number_of_clusters,
+        dimensions,
+        run_pairs(len(all_files)),
+        "contingency",
+        workers,
+    )
+    write_gsum(all_files, gsum_from_SQ_tables(SQ_tables, number_of_clusters), subfolder)
+
     return 0
 
 
@@ -219,9 +662,29 @@ def find_number_of_clusters(cluster_files: list[str]) -> array_lib.ndarray:
     return number_of_clusters
 
 
+def parse_shard(shard: str) -> tuple:
+    """Parse the --shard argument 'k/n' into (k, n), with 0 <= k < n"""
+    try:
+        k, n = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be k/n, got {}".format(shard))
+    if not 0 <= k < n:
+        raise argparse.ArgumentTypeError(
+            "shard k/n needs 0 <= k < n, got {}".format(shard)
+        )
+    return k, n
+
+
 def parse_args():
     """argument parser for the sce.py script"""
     parser = argparse.ArgumentParser(description="SCE code")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=["run", "merge"],
+        help="Compare the runs (default), or merge the shard files of the subfolder into multimap_mappings.txt",
+    )
     parser.add_argument(
         "--folder", type=str, dest="folder", default=os.getcwd(), help="Folder name"
     )
@@ -237,82 +700,119 @@ def parse_args():
         default=[640, 640, 640],
         help="Dimensions of the data",
     )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        dest="engine",
+        default="contingency",
+        choices=["contingency", "masks"],
+        help="Compare the clusters with contingency tables (CPU) or with masks (JAX on GPU if available)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        dest="workers",
+        default=None,
+        help="Number of threads: counting threads for contingency (default: all cores), pairs of runs compared at once for masks (default: 1)",
+    )
+
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        dest="shard",
+        default=None,
+        help="Only compare the pairs of runs of shard k of n (k from 0 to n-1) and save them to a shard file",
+    )
 
     return parser.parse_args()
 
-def main(folder, subfolder, dims):
+
+def main(folder, subfolder, dims, engine="contingency", workers=None, shard=None):
     print("Starting SCE", flush=True)
     os.chdir(folder)
-    cluster_files = glob.glob("*.npy")
+    cluster_files = sorted(glob.glob("*.npy"))  # same order in every shard
 
     # --------------------------------------------------
     # data
     print(cluster_files)
 
-    # --------------------------------------------------
-    # calculate unique number of clusters per run
-    nids_array = find_number_of_clusters(cluster_files)
-    print("nids_array:", nids_array, flush=True)
-    print("There are {} runs".format(len(cluster_files)), flush=True)
-    print("There are {} clusters in total".format(np.sum(nids_array)), flush=True)
-
-    # --------------------------------------------------
-    # generate index for multimap_mapping as the loop runs. Avoid declaring a dict beforehand to avoid memory leaks
-
     try:  # try to create subfolder, if it exists, pass
         os.mkdir(subfolder)
     except FileExistsError:
         pass
 
-    with open(subfolder + "/multimap_mappings.txt", "w") as f:
-        f.write("")
-
     # --------------------------------------------------
-    # make shape of the data
-    data_dims = np.array(dims)
+    # a shard only opens the runs of its pairs, and every n-th run so that each run is counted by some shard
+    runs = None
+    if shard is not None:
+        k, n = shard
+        pairs = shard_pairs(len(cluster_files), k, n)
+        runs = set(range(k, len(cluster_files), n))
+        for pair in pairs:
+            runs.update(pair)
 
     # --------------------------------------------------
-    # loop over data files reading image by image and do pairwise comparisons
-    # all wrapped inside the loop_over_all_clusters function, which uses JAX for fast computation
-    loop_over_all_clusters(cluster_files, nids_array, data_dims, subfolder)
-
-if __name__ == "__main__":
-
-    args = parse_args()
-
-    print("Starting SCE", flush=True)
-    folder = args.folder
-    os.chdir(folder)
-    cluster_files = glob.glob("*.npy")
+    # open each run once; the unique number of clusters per run is kept in a sidecar index
+    # only the masks engine computes on the JAX device
+    cache = RunCache(
+        cluster_files,
+        subfolder + "/run_index.json",
+        device=engine == "masks",
+        runs=runs,
+    )
+    nids_array = cache.number_of_clusters
+    print("nids_array:", nids_array, flush=True)
+    print("There are {} runs".format(len(cluster_files)), flush=True)
+    print(
+        "There are {} clusters in total".format(np.sum(nids_array[nids_array >= 0])),
+        flush=True,
+    )
 
     # --------------------------------------------------
-    # data
-    subfolder = args.subfolder
-    print(cluster_files)
+    # make shape of the data
+    data_dims = np.array(dims)
 
-    # --------------------------------------------------
-    # calculate unique number of clusters per run
-    nids_array = find_number_of_clusters(cluster_files)
-    print("nids_array:", nids_array, flush=True)
-    print("There are {} runs".format(len(cluster_files)), flush=True)
-    print("There are {} clusters in total".format(np.sum(nids_array)), flush=True)
+    if shard is not None:
+        print("Shard {} of {}: {} pairs of runs".format(k, n, len(pairs)), flush=True)
+        SQ_tables = compute_SQ_tables(
+            cache, nids_array, data_dims, pairs, engine, workers
+        )
+        path = "{}/shard-{}-of-{}.npz".format(subfolder, k, n)
+        write_shard(path, cluster_files, nids_array, SQ_tables, pairs)
+        print("Saved", path, flush=True)
+        return  # the shards are combined with the merge command
 
     # --------------------------------------------------
     # generate index for multimap_mapping as the loop runs. Avoid declaring a dict beforehand to avoid memory leaks
 
-    try:  # try to create subfolder, if it exists, pass
-        os.mkdir(subfolder)
-    except FileExistsError:
-        pass
-
     with open(subfolder + "/multimap_mappings.txt", "w") as f:
         f.write("")
 
-    # --------------------------------------------------
-    # make shape of the data
-    data_dims = np.array(args.dims)
-
     # --------------------------------------------------
     # loop over data files reading image by image and do pairwise comparisons
     # all wrapped inside the loop_over_all_clusters function, which uses JAX for fast computation
-    loop_over_all_clusters(cluster_files, nids_array, data_dims, subfolder)
+    if engine == "contingency":
+        loop_over_all_clusters_contingency(
+            cluster_files, nids_array, data_dims, subfolder, cache, workers
+        )
+    else:
+        loop_over_all_clusters(
+            cluster_files, nids_array, data_dims, subfolder, cache, workers
+        )
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    if args.command == "merge":
+        os.chdir(args.folder)
+        merge_shards(args.subfolder)
+    else:
+        main(
+            args.folder,
+            args.subfolder,
+            args.dims,
+            args.engine,
+            args.workers,
+            args.shard,
+        )
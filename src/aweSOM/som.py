@@ -4,19 +4,921 @@
 ## with modifications by Trung Ha (2024) for aweSOM
 
 import sys
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 
 plt.rcParams.update({"font.size": 12})
-from sklearn.metrics.pairwise import euclidean_distances
 
-from numba import njit, prange
+from numba import njit, prange, get_num_threads, get_thread_id
 from scipy.ndimage import map_coordinates
+from scipy import stats
+
+from .node_index import (
+    use_node_index,
+    build_node_index,
+    refit_node_index,
+    expand_node_index,
+    query_node_index,
+    best_match_index_kernel,
+)
+from .history import LatticeHistory, UmatHistory
 
 seed = 42
 np.random.seed(seed)
 
 
+# largest number of observations per tile in the blocked BMU search
+bmu_tile_size = 256
+
+# bytes of the products of a tile with the lattice, per thread; the tile is shortened to fit large lattices
+bmu_tile_bytes = 1 << 21
+
+# scratch buffers of the blocked BMU search, reused by the calls of each Python thread, see bmu_search_buffers
+bmu_buffer_cache = threading.local()
+
+# neighborhood windows with at least this many weights are updated in parallel over the lattice rows
+parallel_window_size = 4096
+
+neighborhood_shapes = ("gaussian", "bubble", "triangle", "epanechnikov")
+
+bmu_search_methods = ("auto", "linear", "index")
+
+# offsets (dx, dy) of the 8 neighbors of a node, in the order compute_heat and compute_centroids visit them
+umat_neighbors = ((-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0))
+
+# number of bootstrap replicas drawn by each task of the bootstrap pool
+bootstrap_block_size = 25
+
+
+def smallest_int_dtype(max_value: int) -> np.dtype:
+    """Return the smallest integer type that can hold the values 0, 1, ..., max_value.
+
+    Args:
+            max_value (int): The largest value to be stored.
+
+    Returns:
+            np.dtype: An unsigned integer type.
+    """
+    return np.min_scalar_type(max(int(max_value), 0))
+
+
+@njit()
+def neighborhood_table(nsize: int, shape: str = "gaussian") -> np.ndarray:
+    """Tabulate the neighborhood function against the Chebyshev distance on the lattice, for a unit learning rate.
+
+    The Gaussian and bubble shapes are the same as Lattice.Gamma with gaussian=True/False; the triangle and
+    Epanechnikov shapes decay linearly and quadratically to 0 at a distance of nsize + 1.
+
+    Args:
+            nsize (int): The neighborhood size; the function is 0 beyond this distance.
+            shape (str, optional): One of "gaussian", "bubble", "triangle", or "epanechnikov". Defaults to "gaussian".
+
+    Returns:
+            np.ndarray: The neighborhood function at the distances 0, 1, ..., nsize.
+    """
+    sigma = nsize / 3
+    table = np.ones(nsize + 1)
+    for dist in range(nsize + 1):
+        if shape == "gaussian":
+            table[dist] = np.exp(-(dist**2) / (2 * sigma**2))
+        elif shape == "triangle":
+            table[dist] = 1.0 - dist / (nsize + 1)
+        elif shape == "epanechnikov":
+            table[dist] = 1.0 - (dist / (nsize + 1)) ** 2
+    return table
+
+
+@njit()
+def find_bmu(lattice: np.ndarray, x: np.ndarray) -> int:
+    """Return the index of the node closest to x; the first node wins ties, same as np.argmin.
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F].
+            x (np.ndarray): One observation.
+
+    Returns:
+            int: 1d index of the best matching node.
+    """
+    number_nodes, number_features = lattice.shape
+    c = 0
+    min_dist = np.inf
+    for i in range(number_nodes):
+        s = 0.0
+        for f in range(number_features):
+            diff = lattice[i, f] - x[f]
+            s += diff * diff
+        if s < min_dist:
+            min_dist = s
+            c = i
+    return c
+
+
+@njit()
+def update_window_row(
+    lattice: np.ndarray,
+    x: np.ndarray,
+    jy: int,
+    x_start: int,
+    x_stop: int,
+    cx: int,
+    cy: int,
+    xdim: int,
+    kernel: np.ndarray,
+):
+    """Move the nodes [x_start, x_stop) of lattice row jy towards x, weighted by the neighborhood of (cx, cy).
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F], updated in place.
+            x (np.ndarray): The training observation.
+            jy (int): Row of the lattice to update.
+            x_start (int): First column of the window.
+            x_stop (int): One past the last column of the window.
+            cx (int): x coordinate of the BMU.
+            cy (int): y coordinate of the BMU.
+            xdim (int): x dimension of the lattice.
+            kernel (np.ndarray): The neighborhood function times the learning rate, indexed by Chebyshev distance.
+    """
+    number_features = lattice.shape[1]
+    for jx in range(x_start, x_stop):
+        h = kernel[max(abs(jx - cx), abs(jy - cy))]
+        j = jx + jy * xdim
+        for f in range(number_features):
+            lattice[j, f] -= (lattice[j, f] - x[f]) * h
+
+
+@njit()
+def train_chunk(
+    lattice: np.ndarray,
+    data: np.ndarray,
+    indices: np.ndarray,
+    start: int,
+    stop: int,
+    xdim: int,
+    kernel: np.ndarray,
+):
+    """Run the online SOM update in place for the training steps [start, stop).
+
+    The learning rate and neighborhood size are constant within the chunk, so the neighborhood function is read from a
+    precomputed table; with the Gaussian table, the update is the same as one step of Lattice.fast_som with
+    Lattice.Gamma. Since the neighborhood is 0 beyond a Chebyshev distance of nsize, only the (2*nsize+1)^2 window
+    around the BMU (clipped at the edges) is updated.
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F], updated in place.
+            data (np.ndarray): The training data of shape [N, F].
+            indices (np.ndarray): Row of data used at each training step.
+            start (int): First training step of the chunk.
+            stop (int): One past the last training step of the chunk.
+            xdim (int): x dimension of the lattice.
+            kernel (np.ndarray): The neighborhood function times the learning rate at the distances 0, 1, ..., nsize.
+    """
+    ydim = lattice.shape[0] // xdim
+    nsize = kernel.shape[0] - 1
+
+    for step in range(start, stop):
+        xk_m = data[indices[step]]
+        c = find_bmu(lattice, xk_m)
+        cx = c % xdim
+        cy = c // xdim
+        x_start = max(cx - nsize, 0)
+        x_stop = min(cx + nsize + 1, xdim)
+        for jy in range(max(cy - nsize, 0), min(cy + nsize + 1, ydim)):
+            update_window_row(lattice, xk_m, jy, x_start, x_stop, cx, cy, xdim, kernel)
+
+
+@njit(parallel=True)
+def train_chunk_parallel(
+    lattice: np.ndarray,
+    data: np.ndarray,
+    indices: np.ndarray,
+    start: int,
+    stop: int,
+    xdim: int,
+    kernel: np.ndarray,
+):
+    """Same as train_chunk, but the rows of the neighborhood window are updated in parallel at each step.
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F], updated in place.
+            data (np.ndarray): The training data of shape [N, F].
+            indices (np.ndarray): Row of data used at each training step.
+            start (int): First training step of the chunk.
+            stop (int): One past the last training step of the chunk.
+            xdim (int): x dimension of the lattice.
+            kernel (np.ndarray): The neighborhood function times the learning rate at the distances 0, 1, ..., nsize.
+    """
+    ydim = lattice.shape[0] // xdim
+    nsize = kernel.shape[0] - 1
+
+    for step in range(start, stop):
+        xk_m = data[indices[step]]
+        c = find_bmu(lattice, xk_m)
+        cx = c % xdim
+        cy = c // xdim
+        x_start = max(cx - nsize, 0)
+        x_stop = min(cx + nsize + 1, xdim)
+        y_start = max(cy - nsize, 0)
+        for row in prange(min(cy + nsize + 1, ydim) - y_start):
+            update_window_row(
+                lattice,
+                xk_m,
+                y_start + row,
+                x_start,
+                x_stop,
+                cx,
+                cy,
+                xdim,
+                kernel,
+            )
+
+
+@njit()
+def train_chunk_indexed(
+    lattice: np.ndarray,
+    data: np.ndarray,
+    indices: np.ndarray,
+    start: int,
+    stop: int,
+    xdim: int,
+    kernel: np.ndarray,
+    node_index: tuple,
+    refit_freq: int,
+):
+    """Same as train_chunk, but the BMU is found with a node index (see node_index.build_node_index).
+
+    After each update, the boxes of the moved nodes are expanded so that the queries stay exact, and every refit_freq
+    steps the boxes are tightened again. The BMUs, and therefore the trained lattice, are the same as with train_chunk.
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F], updated in place.
+            data (np.ndarray): The training data of shape [N, F].
+            indices (np.ndarray): Row of data used at each training step.
+            start (int): First training step of the chunk.
+            stop (int): One past the last training step of the chunk.
+            xdim (int): x dimension of the lattice.
+            kernel (np.ndarray): The neighborhood function times the learning rate at the distances 0, 1, ..., nsize.
+            node_index (tuple): The index built on the lattice by node_index.build_node_index.
+            refit_freq (int): Number of steps between two refits of the index boxes.
+    """
+    ydim = lattice.shape[0] // xdim
+    nsize = kernel.shape[0] - 1
+    order, node_start, node_stop, left, right, parent, leaf_of, lower, upper = (
+        node_index
+    )
+    stack = np.empty(node_start.shape[0] + 1, dtype=np.int64)
+
+    for step in range(start, stop):
+        if step > start and (step - start) % refit_freq == 0:
+            refit_node_index(
+                lattice, order, node_start, node_stop, left, right, lower, upper
+            )
+        xk_m = data[indices[step]]
+        c = query_node_index(
+            lattice,
+            xk_m,
+            order,
+            node_start,
+            node_stop,
+            left,
+            right,
+            lower,
+            upper,
+            stack,
+        )[0]
+        cx = c % xdim
+        cy = c // xdim
+        x_start = max(cx - nsize, 0)
+        x_stop = min(cx + nsize + 1, xdim)
+        for jy in range(max(cy - nsize, 0), min(cy + nsize + 1, ydim)):
+            update_window_row(lattice, xk_m, jy, x_start, x_stop, cx, cy, xdim, kernel)
+            for jx in range(x_start, x_stop):
+                expand_node_index(
+                    lattice, jx + jy * xdim, parent, leaf_of, lower, upper
+                )
+
+
+@njit(parallel=True)
+def coordinate_kernel(rowix: np.ndarray, xdim: int, coords: np.ndarray):
+    """Fill coords with the x and y coordinates of the 1d node indices rowix (n x 1), see Lattice.coordinate"""
+    for k in prange(rowix.shape[0]):
+        coords[k, 0] = rowix[k, 0] % xdim
+        coords[k, 1] = rowix[k, 0] // xdim
+
+
+def bmu_search_buffers(lattice: np.ndarray) -> tuple:
+    """Per-thread scratch buffers of the tiled BMU search of lattice, see top_two_nodes.
+
+    The tile has at most bmu_tile_size rows, and fewer on large lattices so that its products with the lattice take at
+    most bmu_tile_bytes per thread. The buffers are kept and reused by the next calls from the same Python thread with
+    the same lattice shape, type and number of threads, e.g. over the chunks of map_data_chunked.
+
+    Args:
+            lattice (np.ndarray): weight values of the lattice
+
+    Returns:
+            tuple: (tile_buffer, dot_buffer, node_buffer), each of number of threads x tile size x (features, nodes, 2)
+    """
+    number_nodes, number_features = lattice.shape
+    number_threads = get_num_threads()
+    tile_size = max(
+        1, min(bmu_tile_size, bmu_tile_bytes // (number_nodes * lattice.itemsize))
+    )
+    key = (number_threads, tile_size, number_features, number_nodes, lattice.dtype)
+    if getattr(bmu_buffer_cache, "key", None) != key:
+        bmu_buffer_cache.key = key
+        bmu_buffer_cache.buffers = (
+            np.empty((number_threads, tile_size, number_features), dtype=lattice.dtype),
+            np.empty((number_threads, tile_size, number_nodes), dtype=lattice.dtype),
+            np.empty((number_threads, tile_size, 2), dtype=np.int64),
+        )
+    return bmu_buffer_cache.buffers
+
+
+@njit()
+def bmu_search_lattice(lattice: np.ndarray) -> tuple:
+    """Transposed lattice and node norms of the tiled BMU search, see top_two_nodes.
+
+    Args:
+            lattice (np.ndarray): weight values of the lattice
+
+    Returns:
+            tuple: (lattice_t, node_norms)
+    """
+    number_nodes, number_features = lattice.shape
+    lattice_t = np.ascontiguousarray(lattice.T)
+    node_norms = np.zeros(number_nodes, dtype=lattice.dtype)
+    for i in range(number_nodes):
+        for f in range(number_features):
+            node_norms[i] += lattice[i, f] * lattice[i, f]
+    return lattice_t, node_norms
+
+
+@njit()
+def top_two_nodes(
+    obs_tile: np.ndarray,
+    lattice_t: np.ndarray,
+    node_norms: np.ndarray,
+    tile: np.ndarray,
+    dots: np.ndarray,
+    nodes: np.ndarray,
+):
+    """Find the best and second best matching node of each observation of a tile of the scratch buffers.
+
+    The squared distances to all nodes are computed as ||w||^2 - 2 x.W^T (||x||^2 is the same for every node, so it
+    does not change the ranking), with the product done by BLAS into a scratch buffer.
+
+    Args:
+            obs_tile (np.ndarray): the observations of the tile
+            lattice_t, node_norms (np.ndarray): the transposed lattice and node norms from bmu_search_lattice
+            tile (np.ndarray): scratch buffer of the shape of obs_tile, in the lattice type
+            dots (np.ndarray): scratch buffer of the number of observations x number of nodes
+            nodes (np.ndarray): output array of the best and second best node of each observation
+    """
+    tile[:, :] = obs_tile
+    np.dot(tile, lattice_t, dots)
+
+    for r in range(tile.shape[0]):
+        best = np.inf
+        second = np.inf
+        best_node = 0
+        second_node = 0
+        for i in range(node_norms.shape[0]):
+            d = node_norms[i] - 2 * dots[r, i]
+            if d < best:
+                second = best
+                second_node = best_node
+                best = d
+                best_node = i
+            elif d < second:
+                second = d
+                second_node = i
+        nodes[r, 0] = best_node
+        nodes[r, 1] = second_node
+
+
+@njit(parallel=True)
+def best_match_kernel(
+    lattice: np.ndarray,
+    obs: np.ndarray,
+    best_match_node: np.ndarray,
+    buffers: tuple,
+    full=False,
+    node_clusters=None,
+):
+    """Fill best_match_node with the best (and second best if full) matching node of each observation.
+
+    The observations are processed in parallel in tiles of the size of the scratch buffers, see top_two_nodes.
+
+    Args:
+            lattice (np.ndarray): weight values of the lattice
+            obs (np.ndarray): observations (input vectors), same type as lattice
+            best_match_node (np.ndarray): n x 1 (or n x 2 if full) output array
+            buffers (tuple): scratch buffers from bmu_search_buffers
+            full (bool, optional): indicate whether to return first and second best match. Defaults to False.
+            node_clusters (np.ndarray, optional): cluster id of each node; if given, the cluster id of the best match is written instead of its index. Defaults to None.
+    """
+    number_obs = obs.shape[0]
+    lattice_t, node_norms = bmu_search_lattice(lattice)
+    tile_buffer, dot_buffer, node_buffer = buffers
+    tile_size = dot_buffer.shape[1]
+
+    number_tiles = (number_obs + tile_size - 1) // tile_size
+    for t in prange(number_tiles):
+        thread = get_thread_id()
+        start = t * tile_size
+        rows = min(tile_size, number_obs - start)
+        nodes = node_buffer[thread, :rows]
+        top_two_nodes(
+            obs[start : start + rows],
+            lattice_t,
+            node_norms,
+            tile_buffer[thread, :rows],
+            dot_buffer[thread, :rows],
+            nodes,
+        )
+
+        for r in range(rows):
+            if node_clusters is not None:
+                best_match_node[start + r, 0] = node_clusters[nodes[r, 0]]
+            else:
+                best_match_node[start + r, 0] = nodes[r, 0]
+                if full:
+                    best_match_node[start + r, 1] = nodes[r, 1]
+
+
+@njit(parallel=True)
+def quality_kernel(
+    lattice: np.ndarray,
+    obs: np.ndarray,
+    xdim: int,
+    best_match_node: np.ndarray,
+    distance: np.ndarray,
+    hits: np.ndarray,
+    histogram: np.ndarray,
+    max_distance: float,
+    totals: np.ndarray,
+    buffers: tuple,
+):
+    """Map the observations to the lattice and accumulate the quality metrics of the lattice in the same pass.
+
+    The first and second best matching nodes are found by the same tiled search as best_match_kernel. Each thread then
+    adds, to its own accumulators, the distance of the observation to its best matching node (quantization error),
+    whether the two nodes are not neighbors on the lattice (topographic error), the hit of the best matching node and
+    the bin of the distance. The accumulators are added to the outputs at the end, so that the outputs can be
+    accumulated over chunks.
+
+    Args:
+            lattice (np.ndarray): weight values of the lattice
+            obs (np.ndarray): observations (input vectors), same type as lattice
+            xdim (int): x dimension of the lattice
+            best_match_node (np.ndarray): n x 2 output array of the first and second best matching nodes
+            distance (np.ndarray): n output array of the distance of each observation to its best matching node
+            hits (np.ndarray): number of observations matched to each node, accumulated
+            histogram (np.ndarray): number of distances in each of the bins of width max_distance / len(histogram),
+                    accumulated; larger distances are counted in the last bin
+            max_distance (float): upper edge of the histogram
+            totals (np.ndarray): sum of the distances and number of topographic errors, accumulated
+            buffers (tuple): scratch buffers from bmu_search_buffers
+    """
+    number_obs, number_features = obs.shape
+    number_nodes = lattice.shape[0]
+    number_bins = histogram.shape[0]
+    lattice_t, node_norms = bmu_search_lattice(lattice)
+    tile_buffer, dot_buffer, node_buffer = buffers
+    tile_size = dot_buffer.shape[1]
+
+    number_threads = get_num_threads()
+    thread_hits = np.zeros((number_threads, number_nodes), dtype=hits.dtype)
+    thread_histogram = np.zeros((number_threads, number_bins), dtype=histogram.dtype)
+    thread_totals = np.zeros((number_threads, 2))
+
+    number_tiles = (number_obs + tile_size - 1) // tile_size
+    for t in prange(number_tiles):
+        thread = get_thread_id()
+        start = t * tile_size
+        rows = min(tile_size, number_obs - start)
+        nodes = node_buffer[thread, :rows]
+        top_two_nodes(
+            obs[start : start + rows],
+            lattice_t,
+            node_norms,
+            tile_buffer[thread, :rows],
+            dot_buffer[thread, :rows],
+            nodes,
+        )
+
+        for r in range(rows):
+            best_node = nodes[r, 0]
+            second_node = nodes[r, 1]
+            best_match_node[start + r, 0] = best_node
+            best_match_node[start + r, 1] = second_node
+
+            # the exact distance, without the cancellation of the expanded form
+            s = 0.0
+            for f in range(number_features):
+                diff = tile_buffer[thread, r, f] - lattice[best_node, f]
+                s += diff * diff
+            dist = np.sqrt(s)
+            distance[start + r] = dist
+
+            thread_hits[thread, best_node] += 1
+            b = number_bins - 1
+            if dist < max_distance:
+                b = min(int(dist / max_distance * number_bins), number_bins - 1)
+            thread_histogram[thread, b] += 1
+            thread_totals[thread, 0] += dist
+            if (
+                abs(best_node % xdim - second_node % xdim) > 1
+                or abs(best_node // xdim - second_node // xdim) > 1
+            ):
+                thread_totals[thread, 1] += 1
+
+    for thread in range(number_threads):
+        for i in range(number_nodes):
+            hits[i] += thread_hits[thread, i]
+        for b in range(number_bins):
+            histogram[b] += thread_histogram[thread, b]
+        totals[0] += thread_totals[thread, 0]
+        totals[1] += thread_totals[thread, 1]
+
+
+@njit()
+def squared_distance(lattice: np.ndarray, i: int, x: np.ndarray) -> float:
+    """Squared distance between node i and x, summed in the same order as find_bmu."""
+    s = 0.0
+    for f in range(lattice.shape[1]):
+        diff = lattice[i, f] - x[f]
+        s += diff * diff
+    return s
+
+
+@njit()
+def descend_lattice(
+    lattice: np.ndarray, x: np.ndarray, c: int, xdim: int, max_steps: int
+) -> tuple:
+    """Walk from node c to the closest of its 8 lattice neighbors until no neighbor is closer to x.
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F].
+            x (np.ndarray): One observation.
+            c (int): 1d index of the starting node.
+            xdim (int): x dimension of the lattice.
+            max_steps (int): Maximum number of moves.
+
+    Returns:
+            tuple: (node, squared distance, converged), where converged is False if max_steps was reached first.
+    """
+    ydim = lattice.shape[0] // xdim
+    d = squared_distance(lattice, c, x)
+    for _ in range(max_steps):
+        cx = c % xdim
+        cy = c // xdim
+        best = c
+        best_dist = d
+        for jy in range(max(cy - 1, 0), min(cy + 2, ydim)):
+            for jx in range(max(cx - 1, 0), min(cx + 2, xdim)):
+                j = jx + jy * xdim
+                dj = squared_distance(lattice, j, x)
+                if dj < best_dist or (dj == best_dist and j < best):
+                    best = j
+                    best_dist = dj
+        if best == c:
+            return c, d, True
+        c = best
+        d = best_dist
+    return c, d, False
+
+
+@njit()
+def warm_start_plane(
+    lattice: np.ndarray,
+    obs: np.ndarray,
+    best_match_node: np.ndarray,
+    offset: int,
+    ny: int,
+    nz: int,
+    xdim: int,
+    tolerance: float,
+) -> int:
+    """Warm-start BMU search over one ny x nz plane of grid voxels starting at row offset; see warm_start_kernel.
+
+    Returns:
+            int: Number of voxels that fell back to the exact search.
+    """
+    max_steps = xdim + lattice.shape[0] // xdim
+    fallbacks = 0
+    c = find_bmu(lattice, obs[offset])
+    d = squared_distance(lattice, c, obs[offset])
+    line_node, line_dist = c, d
+    for j in range(ny):
+        for i in range(nz):
+            k = offset + j * nz + i
+            if k > offset:
+                if i == 0:
+                    seed_node, seed_dist = line_node, line_dist
+                else:
+                    seed_node, seed_dist = c, d
+                c, d, converged = descend_lattice(
+                    lattice, obs[k], seed_node, xdim, max_steps
+                )
+                if not converged or d > tolerance * seed_dist:
+                    c = find_bmu(lattice, obs[k])
+                    d = squared_distance(lattice, c, obs[k])
+                    fallbacks += 1
+                if i == 0:
+                    line_node, line_dist = c, d
+            best_match_node[k, 0] = c
+    return fallbacks
+
+
+@njit(parallel=True)
+def warm_start_kernel(
+    lattice: np.ndarray,
+    obs: np.ndarray,
+    best_match_node: np.ndarray,
+    ny: int,
+    nz: int,
+    xdim: int,
+    tolerance: float,
+) -> int:
+    """Fill best_match_node for observations on a regular grid, seeding each search with the BMU of a grid neighbor.
+
+    The observations are the voxels of a grid flattened in C order, seen as planes of ny x nz voxels. Each voxel starts
+    from the BMU of the previous voxel along the last axis (or along the second to last axis at the start of a line) and
+    descends on the lattice to a local minimum. If that minimum is more than tolerance times the squared distance of the
+    neighbor to its own BMU, or the descent does not settle within xdim + ydim moves, the exact search is used instead.
+    The planes are processed in parallel, with one exact search at the first voxel of each plane.
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F].
+            obs (np.ndarray): Observations (input vectors), same type as lattice.
+            best_match_node (np.ndarray): n x 1 output array.
+            ny (int): Size of the second to last axis of the grid.
+            nz (int): Size of the last axis of the grid.
+            xdim (int): x dimension of the lattice.
+            tolerance (float): Largest accepted ratio of squared distances between a voxel and its seed.
+
+    Returns:
+            int: Number of voxels that fell back to the exact search.
+    """
+    plane_size = ny * nz
+    number_planes = obs.shape[0] // plane_size
+    fallbacks = np.zeros(number_planes, dtype=np.int64)
+    for p in prange(number_planes):
+        fallbacks[p] = warm_start_plane(
+            lattice, obs, best_match_node, p * plane_size, ny, nz, xdim, tolerance
+        )
+    return fallbacks.sum()
+
+
+@njit(parallel=True)
+def batch_accumulate(
+    lattice: np.ndarray,
+    data: np.ndarray,
+    bmu: np.ndarray,
+    upper: np.ndarray,
+    lower: np.ndarray,
+    drift: np.ndarray,
+    first: bool,
+):
+    """Find the BMU of every data point and accumulate the per-node sum of the data and hit count.
+
+    Unless this is the first epoch, the bounds from the previous epoch are loosened by how far the nodes moved, and the
+    BMU search is skipped for the points where the upper bound is still below the lower bound.
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F].
+            data (np.ndarray): The training data of shape [N, F].
+            bmu (np.ndarray): BMU of each data point, updated in place.
+            upper (np.ndarray): Upper bound on the distance to the BMU, updated in place.
+            lower (np.ndarray): Lower bound on the distance to any other node, updated in place.
+            drift (np.ndarray): Distance moved by each node in the last update.
+            first (bool): Whether the bounds are uninitialized, in which case every BMU is searched.
+
+    Returns:
+            tuple: (sums, counts, searched), the [X*Y, F] sum of the data mapped to each node, the hit count of each
+            node, and the number of full BMU searches.
+    """
+    number_input_vectors, number_features = data.shape
+    number_nodes = lattice.shape[0]
+
+    # the lower bound only needs the largest drift among the nodes other than the BMU
+    max_node = 0
+    max_drift = 0.0
+    second_drift = 0.0
+    for i in range(number_nodes):
+        if drift[i] > max_drift:
+            second_drift = max_drift
+            max_drift = drift[i]
+            max_node = i
+        elif drift[i] > second_drift:
+            second_drift = drift[i]
+
+    number_of_blocks = min(get_num_threads(), number_input_vectors)
+    block_size = (number_input_vectors + number_of_blocks - 1) // number_of_blocks
+    block_sums = np.zeros((number_of_blocks, number_nodes, number_features))
+    block_counts = np.zeros((number_of_blocks, number_nodes))
+    block_searched = np.zeros(number_of_blocks, dtype=np.int64)
+
+    for b in prange(number_of_blocks):
+        for k in range(b * block_size, min((b + 1) * block_size, number_input_vectors)):
+            x = data[k]
+            search = first
+            if not first:
+                upper[k] += drift[bmu[k]]
+                lower[k] -= second_drift if bmu[k] == max_node else max_drift
+                if upper[k] >= lower[k]:
+                    # tighten the upper bound before falling back to a full search
+                    s = 0.0
+                    for f in range(number_features):
+                        diff = lattice[bmu[k], f] - x[f]
+                        s += diff * diff
+                    upper[k] = np.sqrt(s)
+                    search = upper[k] >= lower[k]
+
+            if search:
+                block_searched[b] += 1
+                best = np.inf
+                second = np.inf
+                c = 0
+                for i in range(number_nodes):
+                    s = 0.0
+                    for f in range(number_features):
+                        diff = lattice[i, f] - x[f]
+                        s += diff * diff
+                    if s < best:
+                        second = best
+                        best = s
+                        c = i
+                    elif s < second:
+                        second = s
+                bmu[k] = c
+                upper[k] = np.sqrt(best)
+                lower[k] = np.sqrt(second)
+
+            block_counts[b, bmu[k]] += 1.0
+            for f in range(number_features):
+                block_sums[b, bmu[k], f] += x[f]
+
+    sums = np.zeros((number_nodes, number_features))
+    counts = np.zeros(number_nodes)
+    for b in range(number_of_blocks):
+        sums += block_sums[b]
+        counts += block_counts[b]
+
+    return sums, counts, np.sum(block_searched)
+
+
+@njit(parallel=True)
+def batch_update(
+    lattice: np.ndarray,
+    sums: np.ndarray,
+    counts: np.ndarray,
+    xdim: int,
+    weight: np.ndarray,
+) -> np.ndarray:
+    """Replace each node with the neighborhood-weighted mean of the data mapped around it.
+
+    Args:
+            lattice (np.ndarray): Node weights of shape [X*Y, F].
+            sums (np.ndarray): Sum of the data mapped to each node.
+            counts (np.ndarray): Number of data points mapped to each node.
+            xdim (int): x dimension of the lattice.
+            weight (np.ndarray): The neighborhood function at the Chebyshev distances 0, 1, ..., nsize.
+
+    Returns:
+            np.ndarray: The new node weights; nodes without any data in their neighborhood are unchanged.
+    """
+    number_nodes, number_features = lattice.shape
+    ydim = number_nodes // xdim
+    nsize = weight.shape[0] - 1
+    new_lattice = lattice.copy()
+
+    for i in prange(number_nodes):
+        ix = i % xdim
+        iy = i // xdim
+        numerator = np.zeros(number_features)
+        denominator = 0.0
+        for jy in range(max(iy - nsize, 0), min(iy + nsize + 1, ydim)):
+            for jx in range(max(ix - nsize, 0), min(ix + nsize + 1, xdim)):
+                j = jx + jy * xdim
+                if counts[j] == 0.0:
+                    continue
+                h = weight[max(abs(jx - ix), abs(jy - iy))]
+                denominator += h * counts[j]
+                for f in range(number_features):
+                    numerator[f] += h * sums[j, f]
+        if denominator > 0.0:
+            for f in range(number_features):
+                new_lattice[i, f] = numerator[f] / denominator
+
+    return new_lattice
+
+
+def label_ensemble(
+    lattices: list, data, labels=None, chunk_size: int = 65536
+) -> np.ndarray:
+    """Label the same data with an ensemble of trained lattices, reading the data only once.
+
+    Each chunk of data is read once and labeled by every lattice while it is still in cache, and the labels of the
+    chunk are written to the output as one block. This replaces R passes over the data (one per realization) by one.
+
+    Args:
+            lattices (list): Trained Lattice objects with assigned clusters, or (lattice weights [X*Y, F], clusters on
+                    the lattice [X, Y]) pairs, e.g. loaded from saved lattices and cluster tables.
+            data (array-like): N x F array of data points; can be an h5py dataset or a memory-mapped .npy file.
+            labels (array-like, optional): Preallocated N x R output, e.g. a memmap or an h5py dataset. Defaults to
+                    None, which allocates an array.
+            chunk_size (int, optional): Number of data points read at once. Defaults to 65536.
+
+    Returns:
+            np.ndarray: N x R array where column r holds the cluster id of each data point for realization r.
+    """
+    weights = []
+    node_clusters = []
+    for realization in lattices:
+        if isinstance(realization, Lattice):
+            weights.append(realization.lattice)
+            node_clusters.append(realization.node_clusters())
+        else:
+            lattice, clusters = realization
+            weights.append(np.asarray(lattice))
+            node_clusters.append(np.ascontiguousarray(np.asarray(clusters).T).ravel())
+
+    number_obs = data.shape[0]
+    number_realizations = len(weights)
+    dtype = np.result_type(*node_clusters)
+    node_clusters = [clusters.astype(dtype) for clusters in node_clusters]
+    if labels is None:
+        labels = np.zeros((number_obs, number_realizations), dtype=dtype)
+
+    for start in range(0, number_obs, chunk_size):
+        stop = min(start + chunk_size, number_obs)
+        chunk = np.asarray(data[start:stop])
+        chunk_labels = np.zeros((stop - start, number_realizations), dtype=dtype)
+        chunk_by_dtype = (
+            {}
+        )  # the chunk cast to the type of each lattice, done once per type
+        for r in range(number_realizations):
+            lattice = weights[r]
+            if lattice.dtype not in chunk_by_dtype:
+                chunk_by_dtype[lattice.dtype] = np.asarray(chunk, dtype=lattice.dtype)
+            best_match_kernel(
+                lattice,
+                chunk_by_dtype[lattice.dtype],
+                chunk_labels[:, r : r + 1],
+                bmu_search_buffers(lattice),
+                False,
+                node_clusters[r],
+            )
+        labels[start:stop] = chunk_labels
+        print(
+            f"Labeled {stop}/{number_obs} points with {number_realizations} lattices",
+            flush=True,
+        )
+
+    return labels
+
+
+def sample_rows(data, sample_size: int, rng: np.random.Generator) -> np.ndarray:
+    """Read a random subset of the rows of data, without replacement.
+
+    The rows are read in increasing order, so data can be an h5py dataset or a memory-mapped .npy file.
+
+    Args:
+            data (array-like): N x F array of data points.
+            sample_size (int): Number of rows to read; None or at least N reads all rows.
+            rng (np.random.Generator): Random number generator used to pick the rows.
+
+    Returns:
+            np.ndarray: sample_size x F array of data points.
+    """
+    number_rows = data.shape[0]
+    if sample_size is None or sample_size >= number_rows:
+        return np.asarray(data[:])
+    rows = np.sort(rng.choice(number_rows, sample_size, replace=False))
+    return np.asarray(data[rows])
+
+
+def bootstrap_means(values: np.ndarray, number_replicas: int, seed) -> np.ndarray:
+    """Means of bootstrap resamples of values, one task of the bootstrap pool.
+
+    Args:
+            values (np.ndarray): 1d array of sample values.
+            number_replicas (int): Number of resamples.
+            seed (np.random.SeedSequence): Seed of the resamples of this task.
+
+    Returns:
+            np.ndarray: The mean of each resample.
+    """
+    rng = np.random.default_rng(seed)
+    resamples = rng.integers(0, len(values), (number_replicas, len(values)))
+    return np.mean(values[resamples], axis=1)
+
+
 class Lattice:
     def __init__(
         self,
@@ -26,6 +928,12 @@ class Lattice:
         train: int = 1000,
         alpha_type: str = "decay",
         sampling_type: str = "sampling",
+        neighborhood: str = "gaussian",
+        dtype: np.dtype = np.float64,
+        bmu_search: str = "auto",
+        history: str = "all",
+        history_size: int = None,
+        history_path: str = None,
     ):
         """Initialize the SOM lattice.
 
@@ -36,6 +944,12 @@ class Lattice:
                 train (int): Number of total training iterations; include for all batches. Default is 1000.
                 alpha_type (str): A string that determines whether the learning rate is static or decaying. Default is "decay".
                 sampling_type (str): A string that determines whether the initial lattice is uniform or randomly sampled from the data. Default is "sampling".
+                neighborhood (str): Shape of the neighborhood function, one of "gaussian", "bubble", "triangle", or "epanechnikov". Default is "gaussian".
+                dtype (np.dtype): Floating point type of the data, lattice, distances and snapshots, either np.float32 or np.float64. Default is np.float64.
+                bmu_search (str): How the best matching nodes are searched, "linear" over all nodes, with a node "index", or "auto" to use the index on large lattices with few features. Default is "auto".
+                history (str): Which lattice snapshots are kept in lattice_history: "all" in memory, the "last" history_size ones, on "disk" in the HDF5 file history_path, or "off". Default is "all".
+                history_size (int): Number of snapshots kept with history="last". Default is None.
+                history_path (str): HDF5 file for the snapshots with history="disk". Default is None.
 
         """
         self.xdim = xdim
@@ -55,14 +969,29 @@ class Lattice:
         else:
             sys.exit("alpha_type must be either 'static' or 'decay'")
 
+        if neighborhood not in neighborhood_shapes:
+            sys.exit(f"neighborhood must be one of {neighborhood_shapes}")
+        self.neighborhood = neighborhood
+
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            sys.exit("dtype must be either float32 or float64")
+        self.dtype = np.dtype(dtype)
+        self.kernel_cache = {}  # neighborhood tables keyed on nsize
+        self.merge_hierarchy = None  # see build_merge_hierarchy
+        self.smoothing_cache = {}  # smoothing weights keyed on grid shape and theta
+
+        if bmu_search not in bmu_search_methods:
+            sys.exit(f"bmu_search must be one of {bmu_search_methods}")
+        self.bmu_search = bmu_search
+
         if self.train > 200:
             self.save_frequency = (
                 self.train // 200
             )  # how often to save the node weights
         else:
             self.save_frequency = 5
-        self.lattice_history = []
-        self.umat_history = []
+        self.lattice_history = LatticeHistory(history, history_size, history_path)
+        self.umat_history = UmatHistory(self)  # computed from lattice_history on read
 
     def train_lattice(
         self,
@@ -72,6 +1001,8 @@ class Lattice:
         number_of_steps: int = -1,
         save_lattice: bool = False,
         restart_lattice: np.ndarray = None,
+        training_mode: str = "online",
+        number_of_epochs: int = 20,
     ):
         """Train the Model with numba JIT acceleration.
 
@@ -82,13 +1013,15 @@ class Lattice:
                 number_of_steps (int): Number of steps taken this batch, used for keeping track of training restarts. Default is self.train.
                 save_lattice (bool, optional): A flag that determines whether the node weights are saved to a file at the end of training. Defaults to False.
                 restart_lattice (np.ndarray, optional): Vectors for the weights of the nodes from past realizations. Defaults to None.
+                training_mode (str, optional): "online" for the sequential Kohonen update, or "batch" for the batch algorithm. Defaults to "online".
+                number_of_epochs (int, optional): Number of passes over the data in batch mode. Defaults to 20.
 
         """
 
         self.restart_lattice = restart_lattice
         self.save_lattice = save_lattice
 
-        self.data_array = data
+        self.data_array = np.asarray(data, dtype=self.dtype)
         self.features_names = features_names
         self.labels = labels
         if number_of_steps == -1:
@@ -102,7 +1035,12 @@ class Lattice:
             sys.exit("build: map is too small.")
 
         # train SOM
-        self.fast_som()
+        if training_mode == "online":
+            self.fast_som()
+        elif training_mode == "batch":
+            self.batch_som(number_of_epochs)
+        else:
+            sys.exit("training_mode must be either 'online' or 'batch'")
 
     def fast_som(self):
         """Performs the self-organizing map (SOM) training.
@@ -111,35 +1049,22 @@ class Lattice:
         node weights based on the input vectors. The training process includes adjusting the learning rate, shrinking the
         neighborhood size, and saving the node weights and U-matrix periodically.
 
+        The learning rate and neighborhood schedules are precomputed, and the steps between two schedule changes (or two
+        snapshots) run in a single numba kernel, so the Python overhead is paid once per chunk instead of once per step.
+
         """
         # some constants
         number_input_vectors = self.data_array.shape[0]
-        number_features = self.data_array.shape[1]
-        number_nodes = self.xdim * self.ydim
         this_batch_train = (
             self.this_batch_train
         )  # only train for this number of steps; useful for restarting training
 
-        if self.restart_lattice is not None:
-            lattice = self.restart_lattice
-        else:
-            if self.init == "uniform":
-                # vector with small init values for all nodes
-                # NOTE: each row represents a node, each column represents a feature.
-                lattice = np.random.uniform(0.0, 1.0, (number_nodes, number_features))
-            else:
-                # sample a random subset of the data to initialize the lattice
-                ix = np.random.randint(0, number_input_vectors - 1, number_nodes)
-                lattice = self.data_array[ix, :]
-
-            self.lattice = lattice.copy()
-            self.lattice_history.append(lattice)  # save the initial lattice
-            self.umat_history.append(self.compute_umat())  # save the initial U-matrix
+        lattice = self.initial_lattice()
 
         alpha = self.alpha  # starting learning rate
         if self.alpha_type == 1:
-            alpha_freq = (
-                self.train // 25
+            alpha_freq = max(
+                self.train // 25, 1
             )  # how often to decay the learning rate; at 24 steps, alpha_f ~ 1e-3 alpha_0
         else:
             alpha_freq = 1
@@ -154,19 +1079,9 @@ class Lattice:
         nsize_step = (
             this_batch_train // 4
         )  # for the third quarter of the training steps, shrink the neighborhood
-        nsize_freq = nsize_step // (
-            nsize_max - nsize_min
-        )  # how often to shrink the neighborhood
-
-        # if self.epoch < 2 * nsize_step:
-        # 	nsize = nsize_max
-        # elif self.epoch >= 3 * nsize_step:
-        # 	nsize = nsize_min
-        # else:
-        # 	nsize = nsize_max - self.epoch // nsize_freq
-        nsize = (
-            nsize_max  # start with the largest neighborhood size at each training batch
-        )
+        nsize_freq = (
+            nsize_step // (nsize_max - nsize_min) if nsize_max > nsize_min else 0
+        )  # how often to shrink the neighborhood; 0 means the neighborhood never shrinks
 
         epoch = self.epoch  # counts the number of epochs per nsize_freq
         stop_epoch = epoch + this_batch_train
@@ -175,116 +1090,323 @@ class Lattice:
 
         print("Saving lattice every ", self.save_frequency, " epochs", flush=True)
 
-        # constants for the Gamma function
-        m = np.reshape(
-            list(range(number_nodes)), (number_nodes, 1)
-        )  # a vector with all node 1D addresses
-
-        # x-y coordinate of ith node: m2Ds[i,] = c(xi, yi)
-        m2Ds = self.coordinate(m, self.xdim)
-
         # this ensures that the same random order is not repeated if the training is restarted
         if self.epoch > 1:
             self.seed += 1
             np.random.seed(self.seed)
 
         # Added 06/17/2024: use random number generator, shuffle the data and take the first train samples
-        rng = np.random.default_rng()
+        rng = np.random.default_rng(self.seed)
         indices = np.arange(number_input_vectors)
         rng.shuffle(indices)
 
         # Added 06/25/2024: if the number of training steps is larger than the number of data points, repeat the shuffled indices
         if this_batch_train > number_input_vectors:
             indices = np.tile(indices, this_batch_train // number_input_vectors + 1)
-        xk = self.data_array[indices[:this_batch_train], :]
-
-        # implement momentum-based gradient descent
-        # momentum_decay_rate = self.momentum_decay_rate
+        indices = indices[:this_batch_train]
+
+        # the learning rate and neighborhood size only change at a handful of epochs, so the training is split
+        # into chunks where both are constant; each chunk runs entirely inside the numba kernel
+        boundaries, chunk_alpha, chunk_nsize, final_alpha = self.training_schedule(
+            epoch,
+            this_batch_train,
+            alpha,
+            alpha_freq,
+            nsize_max,
+            nsize_min,
+            nsize_step,
+            nsize_freq,
+        )
+        progress_freq = max(self.train // 10, 1)
 
-        # history of the loss function
-        # loss_freq = 1000
-        # self.loss_history = np.zeros((self.train, number_features))
-        # self.average_loss = np.zeros((self.train//loss_freq, number_features))
+        number_nodes, number_features = lattice.shape
+        if self.bmu_search == "auto":
+            indexed = use_node_index(number_nodes, number_features)
+        else:
+            indexed = self.bmu_search == "index"
 
         print("Begin training", flush=True)
-        while True:
-            if epoch % int(self.train // 10) == 0:
-                print("Evaluating epoch = ", epoch, flush=True)
-
-            # if (epoch % loss_freq == 0) & (epoch != 0):
-            # 	this_average_loss = np.mean(self.loss_history[epoch-loss_freq:epoch], axis=0) # average loss over the last [loss_freq] epochs
-            # 	self.average_loss[epoch//loss_freq-1,:] = this_average_loss
+        for k in range(len(boundaries) - 1):
+            start, stop = boundaries[k], boundaries[k + 1]
 
-            # if training step has gone over the step limit, terminate
-            if epoch >= stop_epoch:
+            if (epoch + start) % progress_freq == 0:
+                print("Evaluating epoch = ", epoch + start, flush=True)
+            if k > 0 and chunk_nsize[k] != chunk_nsize[k - 1]:
                 print(
-                    "Terminating from step limit reached at epoch ", epoch, flush=True
-                )
-                self.epoch = epoch
-                if self.save_lattice:
-                    print("Saving final lattice", epoch, flush=True)
-                    np.save(
-                        f"lattice_{epoch}_{self.xdim}{self.ydim}_{self.alpha}_{self.train}.npy",
-                        lattice,
-                    )
-                break
-
-                # get one random input vector
-            xk_m = xk[epoch - self.epoch, :]
-
-            # calculate the relative distance between input vector and nodes, take the closest node as the BMU
-            # momentum = diff * momentum_decay_rate # momentum-based gradient descent
-            diff = lattice - xk_m
-            squ = diff**2
-            s = np.sum(squ, axis=1)
-            c = np.argmin(s)
-
-            # self.loss_history[epoch,:] = np.sqrt(s[c])
-
-            # update step
-            gamma_m = np.outer(
-                self.Gamma(c, m2Ds, alpha, nsize), np.ones(number_features)
-            )
-            # lattice -= (diff + momentum) * gamma_m
-            lattice -= diff * gamma_m
-
-            # shrink the neighborhood size every [nsize_freq] epochs
-            if (
-                (epoch - self.epoch) > 2 * nsize_step
-                and (epoch - self.epoch) % nsize_freq == 0
-                and nsize > nsize_min
-            ):
-                nsize = (
-                    nsize_max - ((epoch - self.epoch) - 2 * nsize_step) // nsize_freq
+                    f"Shrinking neighborhood size to {chunk_nsize[k]} at epoch {epoch + start - 1}",
+                    flush=True,
                 )
+            if k > 0 and chunk_alpha[k] != chunk_alpha[k - 1]:
                 print(
-                    f"Shrinking neighborhood size to {nsize} at epoch {epoch}",
+                    f"Decaying learning rate to {chunk_alpha[k]} at epoch {epoch + start - 1}",
                     flush=True,
                 )
 
-            # decay the learning rate every [alpha_freq] epochs
-            if epoch % alpha_freq == 0 and self.alpha_type == 1 and epoch != 0:
-                alpha *= 0.75
-                print(f"Decaying learning rate to {alpha} at epoch {epoch}", flush=True)
+            window_size = (
+                min(2 * chunk_nsize[k] + 1, self.xdim)
+                * min(2 * chunk_nsize[k] + 1, self.ydim)
+                * lattice.shape[1]
+            )
+            kernel = self.neighborhood_kernel(chunk_nsize[k], chunk_alpha[k])
+            # the index pays off while the window is small; every moved node has to be fitted back into it
+            if indexed and 4 * window_size <= number_nodes * number_features:
+                # rebuild once per chunk, since the nodes are reordered as the map unfolds
+                train_chunk_indexed(
+                    lattice,
+                    self.data_array,
+                    indices,
+                    start,
+                    stop,
+                    self.xdim,
+                    kernel,
+                    build_node_index(lattice),
+                    number_nodes,
+                )
+            else:
+                if window_size >= parallel_window_size and get_num_threads() > 1:
+                    chunk_kernel = train_chunk_parallel
+                else:
+                    chunk_kernel = train_chunk
+                chunk_kernel(
+                    lattice, self.data_array, indices, start, stop, self.xdim, kernel
+                )
 
             # save lattice sparingly
-            if epoch % self.save_frequency == 0:
-                self.lattice = lattice.copy()
-                # print("Saving lattice at epoch ", epoch, flush=True)
-                self.lattice_history.append(self.lattice)
+            if (epoch + stop - 1) % self.save_frequency == 0:
+                self.save_snapshot(lattice)
+
+        epoch = stop_epoch
+        print("Terminating from step limit reached at epoch ", epoch, flush=True)
+        self.epoch = epoch
+        if self.save_lattice:
+            print("Saving final lattice", epoch, flush=True)
+            np.save(
+                f"lattice_{epoch}_{self.xdim}{self.ydim}_{self.alpha}_{self.train}.npy",
+                lattice,
+            )
+        print("Training complete", flush=True)
+
+        # update the learning rate, lattice, and Umatrix after training
+        self.alpha = final_alpha
+        self.lattice = lattice  # lattice takes the shape of [X*Y, F]
+        self.umat = self.compute_umat()
+
+    def batch_som(self, number_of_epochs: int):
+        """Performs the batch self-organizing map (SOM) training.
 
-                # compute the umatrix and save it
-                umat = self.compute_umat()
-                # np.save(f"umat_{epoch}_{self.xdim}{self.ydim}_{self.alpha}_{self.train}.npy", umat)
-                self.umat_history.append(umat)
+        Each epoch finds the BMU of every data point in parallel, accumulates the per-node sum of the data and hit count,
+        then replaces each node with the neighborhood-weighted mean of the data mapped around it. The neighborhood
+        shrinks linearly from the largest size to 8 over the epochs. Between epochs, the distances to the assigned and
+        second best nodes are kept as bounds (Hamerly's method), so points whose BMU provably did not change are skipped.
 
-            epoch += 1
+        Args:
+                number_of_epochs (int): Number of passes over the data.
+        """
+        number_input_vectors = self.data_array.shape[0]
+        lattice = self.initial_lattice()
+
+        nsize_max = max(self.xdim, self.ydim) + 1
+        nsize_min = min(8, nsize_max)
+        if number_of_epochs > 1:
+            nsize_schedule = np.round(
+                np.linspace(nsize_max, nsize_min, number_of_epochs)
+            ).astype(np.int64)
+        else:
+            nsize_schedule = np.array([nsize_min])
+
+        # BMU assignment with an upper bound on the distance to it and a lower bound on the distance to any other node
+        bmu = np.zeros(number_input_vectors, dtype=np.int64)
+        upper = np.zeros(number_input_vectors)
+        lower = np.zeros(number_input_vectors)
+        drift = np.zeros(lattice.shape[0])
+
+        print("starting epoch is: ", self.epoch, flush=True)
+        print("stopping epoch is: ", self.epoch + number_of_epochs, flush=True)
+        print("Begin batch training", flush=True)
+        for epoch in range(number_of_epochs):
+            sums, counts, searched = batch_accumulate(
+                lattice, self.data_array, bmu, upper, lower, drift, epoch == 0
+            )
+            new_lattice = batch_update(
+                lattice,
+                sums,
+                counts,
+                self.xdim,
+                self.neighborhood_kernel(nsize_schedule[epoch], 1.0),
+            )
+            drift = np.sqrt(np.sum((new_lattice - lattice) ** 2, axis=1))
+            lattice[:] = new_lattice
+
+            print(
+                f"Epoch {self.epoch + epoch}: neighborhood size {nsize_schedule[epoch]}, {searched} BMU searches",
+                flush=True,
+            )
+            self.save_snapshot(lattice)
+
+        self.epoch += number_of_epochs
+        if self.save_lattice:
+            print("Saving final lattice", self.epoch, flush=True)
+            np.save(
+                f"lattice_{self.epoch}_{self.xdim}{self.ydim}_batch_{self.train}.npy",
+                lattice,
+            )
         print("Training complete", flush=True)
 
-        # update the learning rate, lattice, and Umatrix after training
-        self.alpha = alpha
+        self.lattice = lattice
         self.umat = self.compute_umat()
-        self.lattice = lattice  # lattice takes the shape of [X*Y, F]
+
+    def neighborhood_kernel(self, nsize: int, alpha: float) -> np.ndarray:
+        """Return the neighborhood function times the learning rate, tabulated against the Chebyshev distance.
+
+        The unscaled table only depends on nsize, so it is cached and only rebuilt when the neighborhood shrinks.
+
+        Args:
+                nsize (int): The neighborhood size.
+                alpha (float): The learning rate.
+
+        Returns:
+                np.ndarray: The neighborhood function at the distances 0, 1, ..., nsize.
+        """
+        nsize = int(nsize)
+        if nsize not in self.kernel_cache:
+            self.kernel_cache[nsize] = neighborhood_table(nsize, self.neighborhood)
+        return (alpha * self.kernel_cache[nsize]).astype(self.dtype, copy=False)
+
+    def initial_lattice(self) -> np.ndarray:
+        """Return the starting node weights for training, either from a restart or from a fresh initialization.
+
+        Returns:
+                np.ndarray: The node weights of shape [X*Y, F].
+        """
+        number_input_vectors = self.data_array.shape[0]
+        number_features = self.data_array.shape[1]
+        number_nodes = self.xdim * self.ydim
+
+        if self.restart_lattice is not None:
+            lattice = self.restart_lattice
+        else:
+            if self.init == "uniform":
+                # vector with small init values for all nodes
+                # NOTE: each row represents a node, each column represents a feature.
+                lattice = np.random.uniform(
+                    0.0, 1.0, (number_nodes, number_features)
+                ).astype(self.dtype, copy=False)
+            else:
+                # sample a random subset of the data to initialize the lattice
+                ix = np.random.randint(0, number_input_vectors - 1, number_nodes)
+                lattice = self.data_array[ix, :]
+
+            self.save_snapshot(lattice)  # save the initial lattice and U-matrix
+
+        return lattice
+
+    def training_schedule(
+        self,
+        start_epoch: int,
+        number_of_steps: int,
+        alpha: float,
+        alpha_freq: int,
+        nsize_max: int,
+        nsize_min: int,
+        nsize_step: int,
+        nsize_freq: int,
+    ):
+        """Precompute the learning rate and neighborhood size schedules of one training batch.
+
+        The training steps are split into chunks bounded by every epoch where the learning rate decays, the neighborhood
+        shrinks, a snapshot of the lattice is saved, or a progress message is printed. Within each chunk, both the learning
+        rate and the neighborhood size are constant.
+
+        Args:
+                start_epoch (int): The global epoch at which this batch starts.
+                number_of_steps (int): The number of training steps in this batch.
+                alpha (float): The learning rate at the start of the batch.
+                alpha_freq (int): How often (in global epochs) the learning rate decays.
+                nsize_max (int): The initial neighborhood size.
+                nsize_min (int): The final neighborhood size.
+                nsize_step (int): A quarter of the training steps in this batch.
+                nsize_freq (int): How often (in local steps) the neighborhood shrinks; 0 if it never shrinks.
+
+        Returns:
+                tuple: (boundaries, chunk_alpha, chunk_nsize, final_alpha), where chunk k covers the local steps
+                [boundaries[k], boundaries[k+1]), and final_alpha is the learning rate after the last step.
+        """
+        stop_epoch = start_epoch + number_of_steps
+
+        # the learning rate decays after each step at a multiple of alpha_freq (except epoch 0)
+        if self.alpha_type == 1:
+            first = -(-max(start_epoch, 1) // alpha_freq) * alpha_freq
+            alpha_change = np.arange(first, stop_epoch, alpha_freq) - start_epoch + 1
+        else:
+            alpha_change = np.zeros(0, dtype=int)
+        alpha_values = np.empty(len(alpha_change) + 1)
+        alpha_values[0] = alpha
+        for i in range(len(alpha_change)):
+            alpha_values[i + 1] = alpha_values[i] * 0.75
+
+        # the neighborhood shrinks after each step at a multiple of nsize_freq during the third quarter
+        nsize_change = []
+        nsize_values = [nsize_max]
+        if nsize_freq > 0:
+            nsize = nsize_max
+            step = (2 * nsize_step // nsize_freq + 1) * nsize_freq
+            while step < number_of_steps and nsize > nsize_min:
+                nsize = nsize_max - (step - 2 * nsize_step) // nsize_freq
+                nsize_change.append(step + 1)
+                nsize_values.append(nsize)
+                step += nsize_freq
+        nsize_change = np.array(nsize_change, dtype=int)
+        nsize_values = np.array(nsize_values, dtype=int)
+
+        # snapshots are taken after the step, progress is reported before the step
+        save_change = (
+            np.arange(
+                -(-start_epoch // self.save_frequency) * self.save_frequency,
+                stop_epoch,
+                self.save_frequency,
+            )
+            - start_epoch
+            + 1
+        )
+        progress_freq = max(self.train // 10, 1)
+        progress_change = (
+            np.arange(
+                -(-start_epoch // progress_freq) * progress_freq,
+                stop_epoch,
+                progress_freq,
+            )
+            - start_epoch
+        )
+
+        boundaries = np.unique(
+            np.concatenate(
+                (
+                    [0, number_of_steps],
+                    alpha_change,
+                    nsize_change,
+                    save_change,
+                    progress_change,
+                )
+            )
+        ).astype(np.int64)
+        boundaries = boundaries[(boundaries >= 0) & (boundaries <= number_of_steps)]
+
+        chunk_alpha = alpha_values[
+            np.searchsorted(alpha_change, boundaries[:-1], side="right")
+        ]
+        chunk_nsize = nsize_values[
+            np.searchsorted(nsize_change, boundaries[:-1], side="right")
+        ]
+
+        return boundaries, chunk_alpha, chunk_nsize, alpha_values[-1]
+
+    def save_snapshot(self, lattice: np.ndarray):
+        """Save a copy of the lattice to the training history; its U-matrix is computed when umat_history is read.
+
+        Args:
+                lattice (np.ndarray): The current node weights.
+        """
+        self.lattice_history.append(lattice)
 
     @staticmethod
     @njit()
@@ -336,16 +1458,49 @@ class Lattice:
 
         return h
 
-    def map_data_to_lattice(self):
+    def map_data_to_lattice(self, grid_shape: tuple = None, tolerance: float = 4.0):
         """
         After training, map each data point to the nearest node in the lattice.
 
+        If the data are the voxels of a regular grid flattened in C order, e.g. a (F, nx, ny, nz) simulation box reshaped
+        to (nx*ny*nz, F), pass the grid shape to seed each search with the BMU of a neighboring voxel and walk the
+        lattice from there. Smooth fields then cost a handful of distance evaluations per voxel instead of a search over
+        all nodes; voxels whose local minimum looks suspicious fall back to the exact search.
+
+        Args:
+                grid_shape (tuple, optional): Shape of the grid, e.g. (nx, ny, nz); the product must be the number of data points. Defaults to None, for an exact search on unstructured data.
+                tolerance (float, optional): With grid_shape, the largest accepted ratio of the squared distance of a voxel to its BMU over that of its seed voxel. Defaults to 4.0.
+
         Returns:
                 np.ndarray[int]: A 2D array with the x and y coordinates of the best matching nodes for each data point.
         """
 
         print("Begin matching points with nodes", flush=True)
-        data_to_lattice_1d = self.best_match(self.lattice, self.data_array)
+        if grid_shape is None:
+            data_to_lattice_1d = self.best_match(
+                self.lattice, self.data_array, method=self.bmu_search
+            )
+        else:
+            if np.prod(grid_shape) != self.data_array.shape[0]:
+                sys.exit("grid_shape does not match the number of data points")
+            grid_shape = (1, 1) + tuple(grid_shape)
+            data_to_lattice_1d = np.zeros(
+                (self.data_array.shape[0], 1),
+                dtype=smallest_int_dtype(self.lattice.shape[0] - 1),
+            )
+            fallbacks = warm_start_kernel(
+                self.lattice,
+                np.asarray(self.data_array, dtype=self.lattice.dtype),
+                data_to_lattice_1d,
+                grid_shape[-2],
+                grid_shape[-1],
+                self.xdim,
+                tolerance,
+            )
+            print(
+                f"Warm-start mapping fell back to the exact search for {fallbacks} points",
+                flush=True,
+            )
 
         self.projection_1d = data_to_lattice_1d
 
@@ -358,6 +1513,453 @@ class Lattice:
 
         return projection_2d
 
+    def map_data_chunked(
+        self,
+        data,
+        labels=None,
+        bmu=None,
+        distance=None,
+        chunk_size: int = 1048576,
+        quality: bool = False,
+        distance_bins: int = 64,
+        max_distance: float = None,
+        transform=None,
+    ):
+        """
+        Map data that do not fit in memory to the lattice, one chunk of rows at a time.
+
+        The data are read with row slices, so they can be an h5py dataset or a memory-mapped .npy file
+        (np.load(path, mmap_mode="r")). The results are written with row slices into preallocated outputs of length N,
+        e.g. np.lib.format.open_memmap(path, mode="w+", shape=(N,), dtype=...) or an h5py dataset, so the memory use is
+        bounded by the chunk size instead of N. Nothing is stored on the Lattice.
+
+        Args:
+                data (array-like): N x F array of data points; each chunk is cast to the lattice dtype.
+                labels (array-like, optional): Output for the cluster id of each data point, from lattice_assigned_clusters. Defaults to None.
+                bmu (array-like, optional): Output for the 1d index of the best matching node of each data point. Defaults to None.
+                distance (array-like, optional): Output for the Euclidean distance of each data point to its best matching node. Defaults to None.
+                chunk_size (int, optional): Number of data points read and mapped at once. Defaults to 1048576.
+                quality (bool, optional): Whether to also measure the quality of the lattice, see quality. Defaults to False.
+                distance_bins (int, optional): Number of bins of the distance histogram, if quality. Defaults to 64.
+                max_distance (float, optional): Upper edge of the distance histogram, if quality. Defaults to None, for
+                        the diagonal of the bounding box of the node weights.
+                transform (callable, optional): Applied to each chunk as it is read, e.g. the scaling of the training
+                        data (run_som.manual_scaling with the statistics of the full data). Defaults to None.
+
+        Returns:
+                dict: The quality metrics if quality, otherwise None.
+        """
+
+        if quality:
+            if max_distance is None:
+                max_distance = np.sqrt(
+                    np.sum(
+                        (np.max(self.lattice, axis=0) - np.min(self.lattice, axis=0))
+                        ** 2,
+                        dtype=np.float64,
+                    )
+                )
+            hits = np.zeros(self.xdim * self.ydim, dtype=np.int64)
+            histogram = np.zeros(distance_bins, dtype=np.int64)
+            totals = np.zeros(2)
+
+        if labels is not None:
+            if not hasattr(self, "lattice_assigned_clusters"):
+                sys.exit(
+                    "map_data_chunked: assign clusters to the lattice before labeling data"
+                )
+            node_clusters = self.node_clusters()
+
+        number_obs = data.shape[0]
+        print(
+            f"Begin matching points with nodes, in chunks of {chunk_size} points",
+            flush=True,
+        )
+        for start in range(0, number_obs, chunk_size):
+            stop = min(start + chunk_size, number_obs)
+            chunk = data[start:stop]
+            if transform is not None:
+                chunk = transform(chunk)
+            chunk = np.asarray(chunk, dtype=self.dtype)
+            if quality:
+                chunk_bmu = np.empty((stop - start, 2), dtype=np.int64)
+                chunk_distance = np.empty(stop - start)
+                quality_kernel(
+                    self.lattice,
+                    chunk,
+                    self.xdim,
+                    chunk_bmu,
+                    chunk_distance,
+                    hits,
+                    histogram,
+                    max_distance,
+                    totals,
+                    bmu_search_buffers(self.lattice),
+                )
+                chunk_bmu = chunk_bmu[:, 0]
+                if labels is not None:
+                    labels[start:stop] = node_clusters[chunk_bmu]
+                if bmu is not None:
+                    bmu[start:stop] = chunk_bmu
+                if distance is not None:
+                    distance[start:stop] = chunk_distance
+                print(f"Mapped {stop}/{number_obs} points", flush=True)
+                continue
+            if bmu is None and distance is None and labels is not None:
+                labels[start:stop] = self.label(chunk)
+                print(f"Mapped {stop}/{number_obs} points", flush=True)
+                continue
+            chunk_bmu = self.best_match(self.lattice, chunk, method=self.bmu_search)[
+                :, 0
+            ]
+
+            if labels is not None:
+                labels[start:stop] = node_clusters[chunk_bmu]
+            if bmu is not None:
+                bmu[start:stop] = chunk_bmu
+            if distance is not None:
+                distance[start:stop] = np.sqrt(
+                    np.sum((chunk - self.lattice[chunk_bmu]) ** 2, axis=1)
+                )
+            print(f"Mapped {stop}/{number_obs} points", flush=True)
+
+        if quality:
+            return {
+                "quantization_error": totals[0] / number_obs,
+                "topographic_error": totals[1] / number_obs,
+                "hits": hits.reshape(self.ydim, self.xdim).T,
+                "distance_histogram": histogram,
+                "distance_edges": np.linspace(0, max_distance, distance_bins + 1),
+            }
+
+    def quality(
+        self,
+        data: np.ndarray,
+        distance_bins: int = 64,
+        max_distance: float = None,
+    ) -> dict:
+        """
+        Measure the quality of the lattice on the data, in a single pass that also finds the best matching nodes.
+
+        Args:
+                data (np.ndarray): N x F array of data points.
+                distance_bins (int, optional): Number of bins of the distance histogram. Defaults to 64.
+                max_distance (float, optional): Upper edge of the distance histogram; larger distances are counted in
+                        the last bin. Defaults to None, for the diagonal of the bounding box of the node weights.
+
+        Returns:
+                dict: The quality metrics, with keys
+                quantization_error: The mean distance of the data points to their best matching node.
+                topographic_error: The fraction of data points whose first and second best matching nodes are not
+                        neighbors on the lattice.
+                hits: X x Y array of the number of data points matched to each node.
+                distance_histogram, distance_edges: Histogram of the distances of the data points to their best matching node.
+                distance: The distance of each data point to its best matching node.
+        """
+
+        distance = np.empty(data.shape[0])
+        quality = self.map_data_chunked(
+            data,
+            distance=distance,
+            chunk_size=max(data.shape[0], 1),
+            quality=True,
+            distance_bins=distance_bins,
+            max_distance=max_distance,
+        )
+        quality["distance"] = distance
+        return quality
+
+    def significance(self, hits=None) -> np.ndarray:
+        """
+        Compute the relative significance of each feature, from the variance of the node weights weighted by their hits.
+
+        Each node stands for the data points matched to it, so the hit-weighted variance of the nodes estimates the
+        variance of the data without reading them. As in POPSOM, the variance of a feature is its likelihood of being
+        an important feature, normalized with uniform priors.
+
+        Args:
+                hits (np.ndarray, optional): Number of data points matched to each node, as an X x Y array (e.g. from
+                        quality or map_data_chunked(quality=True)) or a 1d array in node order. Defaults to None, which
+                        counts the best matching nodes of the last map_data_to_lattice.
+
+        Returns:
+                np.ndarray: The significance of each feature, summing to one.
+        """
+
+        if hits is None:
+            if not hasattr(self, "projection_1d"):
+                sys.exit("significance: map the data to the lattice or give the hits")
+            hits = np.bincount(
+                np.ravel(self.projection_1d), minlength=self.xdim * self.ydim
+            )
+        hits = np.asarray(hits, dtype=np.float64)
+        if hits.ndim == 2:
+            hits = hits.T.ravel()  # X x Y to node order
+
+        weights = hits / np.sum(hits)
+        lattice = np.asarray(self.lattice, dtype=np.float64)
+        mean = weights @ lattice
+        var_v = weights @ (lattice - mean) ** 2
+
+        return var_v / np.sum(var_v)
+
+    def convergence(
+        self,
+        data=None,
+        conf_int=0.95,
+        k=50,
+        verb=False,
+        ks=False,
+        sample_size=100000,
+    ):
+        """
+        Compute the convergence index of the lattice, the average of its embedding and topographic accuracy.
+
+        Args:
+                data (array-like, optional): N x F array of data points. Defaults to None, for the training data.
+                conf_int (float, optional): The confidence interval of the quality assessment. Defaults to 0.95.
+                k (int, optional): The number of samples used for the estimated topographic accuracy. Defaults to 50.
+                verb (bool, optional): If True, return the two components separately. Defaults to False.
+                ks (bool, optional): If True, use the Kolmogorov-Smirnov test, otherwise the variance and mean tests. Defaults to False.
+                sample_size (int, optional): Number of data points sampled for the embedding tests. Defaults to 100000.
+
+        Returns:
+                float or dict: The convergence index, or a dictionary with the embed and topo components if verb.
+        """
+
+        embed = self.embed(data, conf_int, verb=False, ks=ks, sample_size=sample_size)
+        topo = self.topo(data, k, conf_int, verb=False, interval=False)
+
+        if verb:
+            return {"embed": embed, "topo": topo}
+        else:
+            return 0.5 * embed + 0.5 * topo
+
+    def embed(self, data=None, conf_int=0.95, verb=False, ks=False, sample_size=100000):
+        """
+        Evaluate the embedding of the lattice, the variance of the data captured by the lattice.
+
+        Lattices with an embedding of less than 90% are typically not trustworthy; the precise cut-off depends on the
+        noise level in the data.
+
+        Args:
+                data (array-like, optional): N x F array of data points. Defaults to None, for the training data.
+                conf_int (float, optional): The confidence interval of the convergence test. Defaults to 0.95.
+                verb (bool, optional): If True, return the captured variance of each feature. Defaults to False.
+                ks (bool, optional): If True, use the Kolmogorov-Smirnov test, otherwise the variance and mean tests. Defaults to False.
+                sample_size (int, optional): Number of data points sampled for the tests. Defaults to 100000.
+
+        Returns:
+                float or np.ndarray: The embedding, or the embedding of each feature if verb.
+        """
+
+        if ks:
+            return self.embed_ks(data, conf_int, verb, sample_size)
+        else:
+            return self.embed_vm(data, conf_int, verb, sample_size)
+
+    def embedding_sample(self, data=None, sample_size=100000) -> np.ndarray:
+        """
+        Sample the data for the embedding tests.
+
+        Args:
+                data (array-like, optional): N x F array of data points. Defaults to None, for the training data.
+                sample_size (int, optional): Number of data points sampled. Defaults to 100000.
+
+        Returns:
+                np.ndarray: sample_size x F array of data points, in double precision.
+        """
+
+        if data is None:
+            if not hasattr(self, "data_array"):
+                sys.exit("embed: no data given and no training data on the lattice")
+            data = self.data_array
+        sample = sample_rows(data, sample_size, np.random.default_rng(self.seed))
+        return np.asarray(sample, dtype=np.float64)
+
+    def embed_ks(self, data=None, conf_int=0.95, verb=False, sample_size=100000):
+        """
+        Evaluate the embedding of the lattice with the Kolmogorov-Smirnov test.
+
+        The features whose node weights and data appear to come from the same distribution contribute their share of
+        the data variance to the embedding.
+
+        Args:
+                data (array-like, optional): N x F array of data points. Defaults to None, for the training data.
+                conf_int (float, optional): The confidence interval of the convergence test. Defaults to 0.95.
+                verb (bool, optional): If True, return the captured variance of each feature. Defaults to False.
+                sample_size (int, optional): Number of data points sampled for the test. Defaults to 100000.
+
+        Returns:
+                float or np.ndarray: The embedding, or the embedding of each feature if verb.
+        """
+
+        sample = self.embedding_sample(data, sample_size)
+        lattice = np.asarray(self.lattice, dtype=np.float64)
+
+        # one test per feature, done together along the feature axis
+        p_value = stats.ks_2samp(lattice, sample, axis=0).pvalue
+
+        # the share of each feature in the variance of the data
+        var_v = np.var(sample, axis=0)
+        prob_v = var_v / np.sum(var_v)
+        prob_v[~(p_value > 1 - conf_int)] = 0  # not converged
+
+        if verb:
+            return prob_v
+        else:
+            return np.sum(prob_v)
+
+    def embed_vm(self, data=None, conf_int=0.95, verb=False, sample_size=100000):
+        """
+        Evaluate the embedding of the lattice with the F-test on the variances and the t-test on the means.
+
+        The features whose node weights and data have the same variance and mean within the confidence interval
+        contribute their share of the data variance to the embedding.
+
+        Args:
+                data (array-like, optional): N x F array of data points. Defaults to None, for the training data.
+                conf_int (float, optional): The confidence interval of the convergence test. Defaults to 0.95.
+                verb (bool, optional): If True, return the captured variance of each feature. Defaults to False.
+                sample_size (int, optional): Number of data points sampled for the tests. Defaults to 100000.
+
+        Returns:
+                float or np.ndarray: The embedding, or the embedding of each feature if verb.
+        """
+
+        sample = self.embedding_sample(data, sample_size)
+        lattice = np.asarray(self.lattice, dtype=np.float64)
+        n_x = lattice.shape[0]
+        n_y = sample.shape[0]
+        mean_x = np.mean(lattice, axis=0)
+        mean_y = np.mean(sample, axis=0)
+        var_x = np.var(lattice, axis=0, ddof=1)
+        var_y = np.var(sample, axis=0, ddof=1)
+
+        # F-test on the ratio of the variances of each feature
+        beta = (1 - conf_int) / 2
+        ratio = var_x / var_y
+        var_conf_int_lo = ratio / stats.f.ppf(1 - beta, n_x - 1, n_y - 1)
+        var_conf_int_hi = ratio / stats.f.ppf(beta, n_x - 1, n_y - 1)
+
+        # Welch t-test on the difference of the means of each feature
+        se_x = var_x / n_x
+        se_y = var_y / n_y
+        se = np.sqrt(se_x + se_y)
+        dof = (se_x + se_y) ** 2 / (se_x**2 / (n_x - 1) + se_y**2 / (n_y - 1))
+        t_crit = stats.t.ppf(1 - beta, dof)
+        mean_conf_int_lo = mean_x - mean_y - t_crit * se
+        mean_conf_int_hi = mean_x - mean_y + t_crit * se
+
+        # the share of each feature in the variance of the data, if both the variance and mean have converged
+        var_v = np.var(sample, axis=0)
+        prob_v = var_v / np.sum(var_v)
+        converged = (
+            (var_conf_int_lo <= 1.0)
+            & (var_conf_int_hi >= 1.0)
+            & (mean_conf_int_lo <= 0.0)
+            & (mean_conf_int_hi >= 0.0)
+        )
+        prob_v[~converged] = 0
+
+        if verb:
+            return prob_v
+        else:
+            return np.sum(prob_v)
+
+    def topo(
+        self, data=None, k=50, conf_int=0.95, verb=False, interval=True, workers=None
+    ):
+        """
+        Measure the topographic accuracy of the lattice on a sample of the data.
+
+        The accuracy of a data point is 1 if its first and second best matching nodes are neighbors on the lattice,
+        and 0 otherwise.
+
+        Args:
+                data (array-like, optional): N x F array of data points. Defaults to None, for the training data.
+                k (int, optional): The number of samples used for the accuracy computation. Defaults to 50.
+                conf_int (float, optional): The confidence interval of the accuracy. Defaults to 0.95.
+                verb (bool, optional): If True, return the accuracy of each sample. Defaults to False.
+                interval (bool, optional): Whether to compute the confidence interval with the bootstrap. Defaults to True.
+                workers (int, optional): Number of threads of the bootstrap pool. Defaults to None, for the default of
+                        concurrent.futures.ThreadPoolExecutor.
+
+        Returns:
+                float, dict or np.ndarray: The estimated accuracy, a dictionary with the accuracy (val) and its
+                confidence interval (lo, hi) if interval, or the accuracy of each sample if verb.
+        """
+
+        if data is None:
+            if not hasattr(self, "data_array"):
+                sys.exit("topo: no data given and no training data on the lattice")
+            data = self.data_array
+        if k > data.shape[0]:
+            sys.exit("topo: sample larger than training data.")
+
+        sample = sample_rows(data, k, np.random.default_rng(self.seed))
+        bmu = self.best_match(
+            self.lattice, np.asarray(sample, dtype=self.dtype), full=True
+        )
+        # int64 coordinates, so that the differences below can not wrap around
+        best = self.coordinate(bmu[:, 0:1], self.xdim).astype(np.int64)
+        second = self.coordinate(bmu[:, 1:2], self.xdim).astype(np.int64)
+        acc_v = np.all(np.abs(best - second) <= 1, axis=1).astype(int)
+
+        if verb:
+            return acc_v
+
+        val = np.sum(acc_v) / k
+        if interval:
+            bval = self.bootstrap(conf_int, acc_v, workers=workers)
+            return {"val": val, "lo": bval["lo"], "hi": bval["hi"]}
+        else:
+            return val
+
+    def bootstrap(self, conf_int, sample_acc_v, bootstrap_size=200, workers=None):
+        """
+        Compute the confidence interval of a sampled accuracy with the bootstrap.
+
+        The replicas are drawn in blocks of bootstrap_block_size by a thread pool. Each block has its own seed spawned
+        from the seed of the lattice, so the result does not depend on the number of workers.
+
+        Args:
+                conf_int (float): The confidence interval.
+                sample_acc_v (array-like): The accuracy of each sample.
+                bootstrap_size (int, optional): Number of bootstrap replicas, including the sample itself. Defaults to 200.
+                workers (int, optional): Number of threads of the pool. Defaults to None, for the default of
+                        concurrent.futures.ThreadPoolExecutor.
+
+        Returns:
+                dict: The lower (lo) and upper (hi) bound of the confidence interval.
+        """
+
+        ix = int(100 - conf_int * 100)
+        sample_acc_v = np.asarray(sample_acc_v, dtype=np.float64)
+
+        block_sizes = [
+            min(bootstrap_block_size, bootstrap_size - 1 - start)
+            for start in range(0, bootstrap_size - 1, bootstrap_block_size)
+        ]
+        seeds = np.random.SeedSequence(self.seed).spawn(len(block_sizes))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            replicas = list(
+                pool.map(
+                    bootstrap_means,
+                    [sample_acc_v] * len(block_sizes),
+                    block_sizes,
+                    seeds,
+                )
+            )
+
+        bootstrap_acc_v = np.concatenate([[np.mean(sample_acc_v)]] + replicas)
+        bootstrap_acc_sort_v = np.sort(bootstrap_acc_v)
+
+        lo_val = bootstrap_acc_sort_v[ix - 1]
+        hi_val = bootstrap_acc_sort_v[bootstrap_size - ix - 1]
+
+        return {"lo": lo_val, "hi": hi_val}
+
     def assign_cluster_to_lattice(self, smoothing=None, merge_cost=0.0):
         """
         Assigns clusters to the lattice based on the computed centroids.
@@ -366,47 +1968,38 @@ class Lattice:
                 smoothing (float, optional): Smoothing parameter for computing Umatrix. Defaults to None.
                 merge_cost (float, optional): Cost threshold for merging similar centroids. Defaults to 0.0.
 
+        The merge hierarchy of the current Umatrix is built once and reused, so that sweeping merge_cost only
+        cuts the hierarchy at a different cost.
+
         Returns:
                 numpy.ndarray: Array representing the assigned clusters for each lattice point.
         """
 
         if smoothing is not None:  # smooth the Umatrix before computing the centroids
             self.umat = self.compute_umat(smoothing)
-        naive_centroids = self.compute_centroids(
-            False
-        )  # all local minima are centroids
-        centroids = self.merge_similar_centroids(
-            naive_centroids, merge_cost
+        hierarchy = self.build_merge_hierarchy()  # all local minima are centroids
+        centroids = self.cut_merge_hierarchy(
+            hierarchy, merge_cost
         )  # merge similar centroids
 
         x = self.xdim
         y = self.ydim
-        centr_locs = []
-
-        # create list of centroid locations
-        for ix in range(x):
-            for iy in range(y):
-                cx = centroids["centroid_x"][ix, iy]
-                cy = centroids["centroid_y"][ix, iy]
-
-                centr_locs.append((cx, cy))
 
-        unique_ids = list(set(centr_locs))
+        unique_ids = self.unique_ids(centroids)
         n_clusters = len(unique_ids)
         print(f"Number of clusters : {n_clusters}", flush=True)
         print("Centroids: ", unique_ids, flush=True)
 
-        # mapping = {}
-        clusters = 1000 * np.ones((x, y), dtype=np.int32)
-        for i in range(n_clusters):
-            # mapping[i] = unique_ids[i]
-            for ix in range(x):
-                for iy in range(y):
-                    if (
-                        centroids["centroid_x"][ix, iy],
-                        centroids["centroid_y"][ix, iy],
-                    ) == unique_ids[i]:
-                        clusters[ix, iy] = i
+        # cluster id of each centroid location, looked up by its 1d index; only centroid locations are read, the
+        # other ones hold n_clusters
+        cluster_of_location = np.full(
+            x * y, n_clusters, dtype=smallest_int_dtype(n_clusters)
+        )
+        for i, (cx, cy) in enumerate(unique_ids):
+            cluster_of_location[cx * y + cy] = i
+        clusters = cluster_of_location[
+            centroids["centroid_x"] * y + centroids["centroid_y"]
+        ]
 
         self.lattice_assigned_clusters = clusters
         return clusters
@@ -426,16 +2019,85 @@ class Lattice:
         Returns:
                 np.ndarray: cluster_id of each data point
         """
-        cluster_id = np.zeros(projection_2d.shape[0], dtype=np.int32)
+        cluster_id = np.zeros(projection_2d.shape[0], dtype=clusters_on_lattice.dtype)
         for i in prange(projection_2d.shape[0]):
             cluster_id[i] = clusters_on_lattice[
                 int(projection_2d[i, 0]), int(projection_2d[i, 1])
             ]
         return cluster_id
 
+    def label(self, data: np.ndarray, projection: bool = False):
+        """
+        Label each data point with the cluster of its best matching node, in a single pass over the data.
+
+        The cluster ids of lattice_assigned_clusters are flattened into a node-to-cluster table, and the BMU search
+        writes the cluster id directly, without the intermediate projections of map_data_to_lattice and
+        assign_cluster_to_data.
+
+        Args:
+                data (np.ndarray): N x F array of data points.
+                projection (bool, optional): Whether to also return the x-y coordinates of the best matching nodes. Defaults to False.
+
+        Returns:
+                np.ndarray: cluster id of each data point, or (cluster ids, N x 2 coordinates) if projection is True
+        """
+
+        if not hasattr(self, "lattice_assigned_clusters"):
+            sys.exit("label: assign clusters to the lattice before labeling data")
+        node_clusters = self.node_clusters()
+        obs = np.asarray(data, dtype=self.dtype)
+
+        if projection:
+            best_match_node = self.best_match(self.lattice, obs, method=self.bmu_search)
+            return node_clusters[best_match_node[:, 0]], self.coordinate(
+                best_match_node, self.xdim
+            )
+
+        labels = np.zeros((obs.shape[0], 1), dtype=node_clusters.dtype)
+        if self.bmu_search == "index" or (
+            self.bmu_search == "auto" and use_node_index(*self.lattice.shape)
+        ):
+            order, start, stop, left, right, _, _, lower, upper = build_node_index(
+                self.lattice
+            )
+            best_match_index_kernel(
+                self.lattice,
+                obs,
+                labels,
+                order,
+                start,
+                stop,
+                left,
+                right,
+                lower,
+                upper,
+                False,
+                node_clusters,
+            )
+        else:
+            best_match_kernel(
+                self.lattice,
+                obs,
+                labels,
+                bmu_search_buffers(self.lattice),
+                False,
+                node_clusters,
+            )
+        return labels[:, 0]
+
+    def node_clusters(self) -> np.ndarray:
+        """
+        Flatten lattice_assigned_clusters into a table of the cluster id of each node, indexed like the rows of the lattice.
+
+        Returns:
+                np.ndarray: cluster id of each of the X*Y nodes
+        """
+        return np.ascontiguousarray(self.lattice_assigned_clusters.T).ravel()
+
     @staticmethod
-    @njit(parallel=True)
-    def best_match(lattice: np.ndarray, obs: np.ndarray, full=False) -> np.ndarray:
+    def best_match(
+        lattice: np.ndarray, obs: np.ndarray, full=False, method: str = "auto"
+    ) -> np.ndarray:
         """
         Given input vector inp[n,f] (where n is number of different observations, f is number of features per observation), return the best matching node.
 
@@ -443,38 +2105,46 @@ class Lattice:
                 lattice (np.ndarray): weight values of the lattice
                 obs (np.ndarray): observations (input vectors)
                 full (bool, optional): indicate whether to return first and second best match. Defaults to False.
+                method (str, optional): "linear" for the blocked search over all nodes, "index" to query a node index, or "auto" to pick one from the lattice shape. Defaults to "auto".
 
         Returns:
-                np.ndarray: return the 1d index of the best-matched node (within the lattice) for each observation
+                np.ndarray: return the 1d index of the best-matched node (within the lattice) for each observation, in the smallest integer type that fits
         """
 
-        if full:
-            best_match_node = np.zeros((obs.shape[0], 2))
+        best_match_node = np.zeros(
+            (obs.shape[0], 2 if full else 1),
+            dtype=smallest_int_dtype(lattice.shape[0] - 1),
+        )
+        obs = np.asarray(obs, dtype=lattice.dtype)
+        if method == "auto":
+            method = "index" if use_node_index(*lattice.shape) else "linear"
+        if method == "index":
+            order, start, stop, left, right, _, _, lower, upper = build_node_index(
+                lattice
+            )
+            best_match_index_kernel(
+                lattice,
+                obs,
+                best_match_node,
+                order,
+                start,
+                stop,
+                left,
+                right,
+                lower,
+                upper,
+                full,
+            )
+        elif method == "linear":
+            best_match_kernel(
+                lattice, obs, best_match_node, bmu_search_buffers(lattice), full
+            )
         else:
-            best_match_node = np.zeros((obs.shape[0], 1))
-
-        for i in prange(obs.shape[0]):
-            diff = lattice - obs[i]
-            squ = diff**2
-            s = np.sum(squ, axis=1)
-
-            if full:
-                # numba does not support argsort, so we record the top two best matches this way
-                o = np.argmin(s)
-                best_match_node[i, 0] = o
-                s[o] = np.max(s)
-                o = np.argmin(s)
-                best_match_node[i, 1] = o
-            else:
-                best_match_node[i] = np.argmin(s)
-
-            if i % int(obs.shape[0] // 10) == 0:
-                print("i = ", i)
+            sys.exit(f"method must be one of {bmu_search_methods}")
 
         return best_match_node
 
     @staticmethod
-    @njit(parallel=True)
     def coordinate(rowix: np.ndarray, xdim: int) -> np.ndarray:
         """
         Convert from a list of row index to an array of xy-coordinates.
@@ -484,15 +2154,12 @@ class Lattice:
                 xdim (int): x dimension of the lattice
 
         Returns:
-                np.ndarray: array with x and y coordinates of each point in rowix
+                np.ndarray: array with x and y coordinates of each point in rowix, in the smallest signed integer type
+                that holds the indices of rowix, so that coordinates can be subtracted
         """
-
-        len_rowix = len(rowix)
-        coords = np.zeros((len_rowix, 2), dtype=np.int32)
-
-        for k in prange(len_rowix):
-            coords[k, :] = np.array([rowix[k, 0] % xdim, rowix[k, 0] // xdim])
-
+        rowix = np.asarray(rowix)
+        coords = np.zeros((len(rowix), 2), dtype=np.promote_types(rowix.dtype, np.int8))
+        coordinate_kernel(rowix, xdim, coords)
         return coords
 
     def rowix(self, x, y):
@@ -541,278 +2208,33 @@ class Lattice:
         xdim = self.xdim
         ydim = self.ydim
         heat = self.umat
-        centroid_x = np.array([[-1] * ydim for _ in range(xdim)])
-        centroid_y = np.array([[-1] * ydim for _ in range(xdim)])
-
-        def find_this_centroid(ix, iy):
-            # recursive function to find the centroid of a point on the map
-
-            if (centroid_x[ix, iy] > -1) and (centroid_y[ix, iy] > -1):
-                return {"bestx": centroid_x[ix, iy], "besty": centroid_y[ix, iy]}
-
-            min_val = heat[ix, iy]
-            min_x = ix
-            min_y = iy
-
-            # (ix, iy) is an inner map element
-            if ix > 0 and ix < xdim - 1 and iy > 0 and iy < ydim - 1:
-
-                if heat[ix - 1, iy - 1] < min_val:
-                    min_val = heat[ix - 1, iy - 1]
-                    min_x = ix - 1
-                    min_y = iy - 1
-
-                if heat[ix, iy - 1] < min_val:
-                    min_val = heat[ix, iy - 1]
-                    min_x = ix
-                    min_y = iy - 1
-
-                if heat[ix + 1, iy - 1] < min_val:
-                    min_val = heat[ix + 1, iy - 1]
-                    min_x = ix + 1
-                    min_y = iy - 1
-
-                if heat[ix + 1, iy] < min_val:
-                    min_val = heat[ix + 1, iy]
-                    min_x = ix + 1
-                    min_y = iy
-
-                if heat[ix + 1, iy + 1] < min_val:
-                    min_val = heat[ix + 1, iy + 1]
-                    min_x = ix + 1
-                    min_y = iy + 1
-
-                if heat[ix, iy + 1] < min_val:
-                    min_val = heat[ix, iy + 1]
-                    min_x = ix
-                    min_y = iy + 1
-
-                if heat[ix - 1, iy + 1] < min_val:
-                    min_val = heat[ix - 1, iy + 1]
-                    min_x = ix - 1
-                    min_y = iy + 1
-
-                if heat[ix - 1, iy] < min_val:
-                    min_val = heat[ix - 1, iy]
-                    min_x = ix - 1
-                    min_y = iy
-
-            # (ix, iy) is bottom left corner
-            elif ix == 0 and iy == 0:
-
-                if heat[ix + 1, iy] < min_val:
-                    min_val = heat[ix + 1, iy]
-                    min_x = ix + 1
-                    min_y = iy
-
-                if heat[ix + 1, iy + 1] < min_val:
-                    min_val = heat[ix + 1, iy + 1]
-                    min_x = ix + 1
-                    min_y = iy + 1
-
-                if heat[ix, iy + 1] < min_val:
-                    min_val = heat[ix, iy + 1]
-                    min_x = ix
-                    min_y = iy + 1
-
-            # (ix, iy) is bottom right corner
-            elif ix == xdim - 1 and iy == 0:
-
-                if heat[ix, iy + 1] < min_val:
-                    min_val = heat[ix, iy + 1]
-                    min_x = ix
-                    min_y = iy + 1
-
-                if heat[ix - 1, iy + 1] < min_val:
-                    min_val = heat[ix - 1, iy + 1]
-                    min_x = ix - 1
-                    min_y = iy + 1
-
-                if heat[ix - 1, iy] < min_val:
-                    min_val = heat[ix - 1, iy]
-                    min_x = ix - 1
-                    min_y = iy
-
-            # (ix, iy) is top right corner
-            elif ix == xdim - 1 and iy == ydim - 1:
-
-                if heat[ix - 1, iy - 1] < min_val:
-                    min_val = heat[ix - 1, iy - 1]
-                    min_x = ix - 1
-                    min_y = iy - 1
-
-                if heat[ix, iy - 1] < min_val:
-                    min_val = heat[ix, iy - 1]
-                    min_x = ix
-                    min_y = iy - 1
-
-                if heat[ix - 1, iy] < min_val:
-                    min_val = heat[ix - 1, iy]
-                    min_x = ix - 1
-                    min_y = iy
-
-            # (ix, iy) is top left corner
-            elif ix == 0 and iy == ydim - 1:
-
-                if heat[ix, iy - 1] < min_val:
-                    min_val = heat[ix, iy - 1]
-                    min_x = ix
-                    min_y = iy - 1
-
-                if heat[ix + 1, iy - 1] < min_val:
-                    min_val = heat[ix + 1, iy - 1]
-                    min_x = ix + 1
-                    min_y = iy - 1
-
-                if heat[ix + 1, iy] < min_val:
-                    min_val = heat[ix + 1, iy]
-                    min_x = ix + 1
-                    min_y = iy
-
-            # (ix, iy) is a left side element
-            elif ix == 0 and iy > 0 and iy < ydim - 1:
-
-                if heat[ix, iy - 1] < min_val:
-                    min_val = heat[ix, iy - 1]
-                    min_x = ix
-                    min_y = iy - 1
-
-                if heat[ix + 1, iy - 1] < min_val:
-                    min_val = heat[ix + 1, iy - 1]
-                    min_x = ix + 1
-                    min_y = iy - 1
-
-                if heat[ix + 1, iy] < min_val:
-                    min_val = heat[ix + 1, iy]
-                    min_x = ix + 1
-                    min_y = iy
-
-                if heat[ix + 1, iy + 1] < min_val:
-                    min_val = heat[ix + 1, iy + 1]
-                    min_x = ix + 1
-                    min_y = iy + 1
-
-                if heat[ix, iy + 1] < min_val:
-                    min_val = heat[ix, iy + 1]
-                    min_x = ix
-                    min_y = iy + 1
-
-            # (ix, iy) is a bottom side element
-            elif ix > 0 and ix < xdim - 1 and iy == 0:
-
-                if heat[ix + 1, iy] < min_val:
-                    min_val = heat[ix + 1, iy]
-                    min_x = ix + 1
-                    min_y = iy
-
-                if heat[ix + 1, iy + 1] < min_val:
-                    min_val = heat[ix + 1, iy + 1]
-                    min_x = ix + 1
-                    min_y = iy + 1
-
-                if heat[ix, iy + 1] < min_val:
-                    min_val = heat[ix, iy + 1]
-                    min_x = ix
-                    min_y = iy + 1
-
-                if heat[ix - 1, iy + 1] < min_val:
-                    min_val = heat[ix - 1, iy + 1]
-                    min_x = ix - 1
-                    min_y = iy + 1
-
-                if heat[ix - 1, iy] < min_val:
-                    min_val = heat[ix - 1, iy]
-                    min_x = ix - 1
-                    min_y = iy
-
-            # (ix, iy) is a right side element
-            elif ix == xdim - 1 and iy > 0 and iy < ydim - 1:
-
-                if heat[ix - 1, iy - 1] < min_val:
-                    min_val = heat[ix - 1, iy - 1]
-                    min_x = ix - 1
-                    min_y = iy - 1
-
-                if heat[ix, iy - 1] < min_val:
-                    min_val = heat[ix, iy - 1]
-                    min_x = ix
-                    min_y = iy - 1
-
-                if heat[ix, iy + 1] < min_val:
-                    min_val = heat[ix, iy + 1]
-                    min_x = ix
-                    min_y = iy + 1
-
-                if heat[ix - 1, iy + 1] < min_val:
-                    min_val = heat[ix - 1, iy + 1]
-                    min_x = ix - 1
-                    min_y = iy + 1
-
-                if heat[ix - 1, iy] < min_val:
-                    min_val = heat[ix - 1, iy]
-                    min_x = ix - 1
-                    min_y = iy
-
-            # (ix, iy) is a top side element
-            elif ix > 0 and ix < xdim - 1 and iy == ydim - 1:
-
-                if heat[ix - 1, iy - 1] < min_val:
-                    min_val = heat[ix - 1, iy - 1]
-                    min_x = ix - 1
-                    min_y = iy - 1
-
-                if heat[ix, iy - 1] < min_val:
-                    min_val = heat[ix, iy - 1]
-                    min_x = ix
-                    min_y = iy - 1
-
-                if heat[ix + 1, iy - 1] < min_val:
-                    min_val = heat[ix + 1, iy - 1]
-                    min_x = ix + 1
-                    min_y = iy - 1
-
-                if heat[ix + 1, iy] < min_val:
-                    min_val = heat[ix + 1, iy]
-                    min_x = ix + 1
-                    min_y = iy
-
-                if heat[ix - 1, iy] < min_val:
-                    min_val = heat[ix - 1, iy]
-                    min_x = ix - 1
-                    min_y = iy
-
-                    # if successful
-                    # move to the square with the smaller value, i_e_, call
-                    # find_this_centroid on this new square
-                    # note the RETURNED x-y coords in the centroid_x and
-                    # centroid_y matrix at the current location
-                    # return the RETURNED x-y coordinates
-
-            if min_x != ix or min_y != iy:
-                r_val = find_this_centroid(min_x, min_y)
-
-                # if explicit is set show the exact connected component
-                # otherwise construct a connected componenent where all
-                # nodes are connected to a centrol node
-                if explicit:
-
-                    centroid_x[ix, iy] = min_x
-                    centroid_y[ix, iy] = min_y
-                    return {"bestx": min_x, "besty": min_y}
-
-                else:
-                    centroid_x[ix, iy] = r_val["bestx"]
-                    centroid_y[ix, iy] = r_val["besty"]
-                    return r_val
 
-            else:
-                centroid_x[ix, iy] = ix
-                centroid_y[ix, iy] = iy
-                return {"bestx": ix, "besty": iy}
-
-        for i in range(xdim):
-            for j in range(ydim):
-                find_this_centroid(i, j)
+        # steepest descent: every node points to the lowest of itself and its 8 neighbors, visited in the order of
+        # umat_neighbors; a neighbor only wins if it is strictly lower, so the node itself wins ties
+        padded = np.full((xdim + 2, ydim + 2), np.inf)
+        padded[1:-1, 1:-1] = heat
+        min_val = padded[1:-1, 1:-1]
+        ix, iy = np.indices((xdim, ydim))
+        pointer = ix * ydim + iy  # 1d index of (ix, iy) in the X x Y matrices
+        for dx, dy in umat_neighbors:
+            neighbor = padded[1 + dx : xdim + 1 + dx, 1 + dy : ydim + 1 + dy]
+            lower = neighbor < min_val
+            min_val = np.where(lower, neighbor, min_val)
+            pointer = np.where(lower, (ix + dx) * ydim + iy + dy, pointer)
+        pointer = pointer.ravel()
+
+        # if explicit is set show the exact connected component (each node points to its downhill neighbor),
+        # otherwise every node is connected to the local minimum at the end of its path
+        if not explicit:
+            # pointer jumping: after k rounds, each node points 2^k steps further down its path
+            while True:
+                jumped = pointer[pointer]
+                if np.array_equal(jumped, pointer):
+                    break
+                pointer = jumped
+
+        centroid_x = (pointer // ydim).reshape((xdim, ydim))
+        centroid_y = (pointer % ydim).reshape((xdim, ydim))
 
         return {"centroid_x": centroid_x, "centroid_y": centroid_y}
 
@@ -832,22 +2254,71 @@ class Lattice:
         Returns:
                 dict[str, np.ndarray]: The updated centroids dictionary.
         """
-        (xdim, ydim) = centroids["centroid_x"].shape
-        for ix in range(xdim):
-            for iy in range(ydim):
-                if (
-                    centroids["centroid_x"][ix, iy] == centroid_a[0]
-                    and centroids["centroid_y"][ix, iy] == centroid_a[1]
-                ):
-                    centroids["centroid_x"][ix, iy] = centroid_b[0]
-                    centroids["centroid_y"][ix, iy] = centroid_b[1]
+        replace = (centroids["centroid_x"] == centroid_a[0]) & (
+            centroids["centroid_y"] == centroid_a[1]
+        )
+        centroids["centroid_x"][replace] = centroid_b[0]
+        centroids["centroid_y"][replace] = centroid_b[1]
 
         return centroids
 
+    def centroid_path_costs(
+        self,
+        positions: list[tuple],
+        first: np.ndarray = None,
+        second: np.ndarray = None,
+    ) -> tuple:
+        """
+        Compute the cost of the straight path between every pair of centroids on the squared U-matrix.
+
+        The path from a to b is sampled at 5 * int(|b - a|) evenly spaced points (the same points as np.linspace), and
+        its cost is the sum of the spline-interpolated heat**2 at these points. The points of all the paths are
+        interpolated in a single map_coordinates call. The cost of a path from b to a can differ in the last bits.
+
+        Args:
+                positions (list[tuple]): The (x, y) locations of the centroids.
+                first, second (np.ndarray, optional): Indices into positions of the start and end of each path.
+                        Defaults to None, for every pair with first < second.
+
+        Returns:
+                tuple: (first, second, cost) arrays with one entry per path.
+        """
+
+        positions = np.asarray(positions, dtype=float).reshape((-1, 2))
+        if first is None:
+            first, second = np.triu_indices(len(positions), k=1)
+        a = positions[first]
+        b = positions[second]
+        num_sample = 5 * np.sqrt(np.sum((b - a) ** 2, axis=1)).astype(int)
+
+        # sample i of a path is a + i * (b - a) / (num_sample - 1), and the last sample is exactly b
+        offsets = np.cumsum(num_sample) - num_sample
+        pair = np.repeat(np.arange(len(first)), num_sample)
+        i = np.arange(num_sample.sum()) - offsets[pair]
+        step = (b - a) / (num_sample - 1)[:, None]
+        samples = i[:, None] * step[pair] + a[pair]
+        samples[offsets + num_sample - 1] = b
+
+        umat_dist = map_coordinates(self.umat**2, samples.T)
+        # np.sum on each path, for the same rounding as summing the paths one by one
+        cost = np.array(
+            [
+                np.sum(umat_dist[offset : offset + n])
+                for offset, n in zip(offsets.tolist(), num_sample.tolist())
+            ]
+        )
+
+        return first, second, cost
+
     def merge_similar_centroids(self, naive_centroids: np.ndarray, threshold=0.3):
         """
         Merge centroids that are close enough together.
 
+        At each step, the pair of centroids with the lowest path cost (see centroid_path_costs), normalized by the
+        largest cost among the remaining pairs, is merged if this cost is below the threshold; the centroid with the
+        larger number of nodes is kept. The merge sequence comes from build_merge_hierarchy, and is cut at the first
+        step whose cost reaches the threshold.
+
         Args:
                 naive_centroids (np.ndarray): original centroids before merging
                 threshold (float, optional): Any centroids with pairwise cost less than this threshold is merged. Defaults to 0.3.
@@ -856,85 +2327,243 @@ class Lattice:
                 np.ndarray: new node map with combined centroids
         """
 
-        heat = self.umat
-        centroids = naive_centroids.copy()
-        unique_centroids = self.get_unique_centroids(
-            centroids
-        )  # the nodes_count dictionary is also created here, so don't remove this line
+        hierarchy = self.build_merge_hierarchy(naive_centroids)
+        return self.cut_merge_hierarchy(hierarchy, threshold)
 
-        # for each pair of centroids, compute the weighted distance between them via interpolating the umat
-        # if the distance is less than the threshold, combine the centroids
-
-        cost_between_centroids = []
-
-        for i in range(len(unique_centroids["position_x"]) - 1):
-            for j in range(i + 1, len(unique_centroids["position_x"])):
-                a = [
-                    unique_centroids["position_x"][i],
-                    unique_centroids["position_y"][i],
-                ]
-                b = [
-                    unique_centroids["position_x"][j],
-                    unique_centroids["position_y"][j],
-                ]
-                num_sample = 5 * int(np.sqrt((b[0] - a[0]) ** 2 + (b[1] - a[1]) ** 2))
-                x, y = np.linspace(a[0], b[0], num_sample), np.linspace(
-                    a[1], b[1], num_sample
-                )
-                umat_dist = map_coordinates(heat**2, np.vstack((x, y)))
-                total_cost = np.sum(umat_dist)
-                # total_cost /= num_sample
-                cost_between_centroids.append([a, b, total_cost])
-
-        # cost_between_centroids.sort(key=lambda x: x[2])
-        sorted_cost = sorted(
-            cost_between_centroids, key=lambda x: x[2]
-        )  # this ranks all pairwise cost in ascending order
-        # normalize the cost such that the largest cost at each step is always one
-        sorted_cost = [[a, b, c / sorted_cost[-1][2]] for a, b, c in sorted_cost]
-
-        # combine the centroids recursively until the threshold is reached
-        if sorted_cost[0][2] < threshold:
-            centroid_a = tuple(sorted_cost[0][0])
-            centroid_b = tuple(sorted_cost[0][1])
-            # heat_a = heat[centroid_a[0], centroid_a[1]]
-            # heat_b = heat[centroid_b[0], centroid_b[1]]
-            nodes_a = self.nodes_count[centroid_a]
-            nodes_b = self.nodes_count[centroid_b]
-
-            print(f"Centroid A: {centroid_a}, count: {nodes_a}", flush=True)
-            print(f"Centroid B: {centroid_b}, count: {nodes_b}", flush=True)
-            # print(f"Centroid A: {centroid_a}, Umatrix value: {heat_a}", flush=True)
-            # print(f"Centroid B: {centroid_b}, Umatrix value: {heat_b}", flush=True)
-            print("Merging...", flush=True)
+    def build_merge_hierarchy(self, naive_centroids: dict = None) -> dict:
+        """
+        Merge the centroids down to a single one and record the merge sequence (a dendrogram).
+
+        At each step, the pair of centroids with the lowest path cost (see centroid_path_costs), normalized by the
+        largest cost among the remaining pairs, is merged; the centroid with the larger number of nodes is kept.
+        Since the kept centroid does not move, the costs of both directions of every path are computed once, and the
+        pairs are kept in two heaps, on the lower and on the higher cost of their two directions, so that each step
+        only looks at the pairs whose costs are within the difference of the directions of the lowest (or highest).
+
+        Each step follows the recursive merge of earlier versions exactly: the remaining centroids are ordered as
+        in get_unique_centroids (the order of a set of their locations), the path of a pair goes from the earlier
+        to the later one, equal costs are taken in the order the pairs are enumerated, and the earlier centroid of
+        the pair is kept when the node counts are equal.
 
-            replace_a_with_b = False
+        The hierarchy is cached in self.merge_hierarchy together with the Umatrix and the naive centroids it was
+        built from, and is returned again as long as both are unchanged.
+
+        Args:
+                naive_centroids (dict, optional): original centroids before merging. Defaults to None, which uses
+                        the centroids of all local minima of the Umatrix (compute_centroids(False)).
+
+        Returns:
+                dict: The hierarchy, with keys
+                umat, naive_centroids: The Umatrix and the centroids before merging.
+                positions: The unique naive centroid positions.
+                first, second: Indices into positions of the centroids merged at each step, and their node counts
+                        first_count, second_count at that step.
+                kept, removed: Indices of the centroid kept and of the centroid merged into it at each step.
+                cost: The normalized cost of each step.
+        """
+
+        if naive_centroids is None:
+            naive_centroids = self.compute_centroids(False)
+
+        cached = self.merge_hierarchy
+        if (
+            cached is not None
+            and np.array_equal(cached["umat"], self.umat)
+            and all(
+                np.array_equal(cached["naive_centroids"][key], naive_centroids[key])
+                for key in ("centroid_x", "centroid_y")
+            )
+        ):
+            return cached
+
+        naive_centroids = {key: value.copy() for key, value in naive_centroids.items()}
+        unique_centroids = self.get_unique_centroids(
+            naive_centroids
+        )  # the nodes_count dictionary is also created here, so don't remove this line
+        positions = list(
+            zip(unique_centroids["position_x"], unique_centroids["position_y"])
+        )
+        nodes_count = [self.nodes_count[position] for position in positions]
+        merged = np.zeros(len(positions), dtype=bool)
+        index_of = {position: i for i, position in enumerate(positions)}
+
+        # first node (in row-major order) attached to each centroid, which sets the order of the set of locations
+        position_index = np.zeros(self.xdim * self.ydim, dtype=np.int64)
+        position_index[[x * self.ydim + y for x, y in positions]] = np.arange(
+            len(positions)
+        )
+        node_centroid = position_index[
+            (
+                naive_centroids["centroid_x"] * self.ydim
+                + naive_centroids["centroid_y"]
+            ).ravel()
+        ]
+        first_node = np.full(len(positions), node_centroid.size, dtype=np.int64)
+        np.minimum.at(first_node, node_centroid, np.arange(node_centroid.size))
+
+        first, second, forward_cost = self.centroid_path_costs(positions)
+        _, _, backward_cost = self.centroid_path_costs(positions, second, first)
+        lower = np.minimum(forward_cost, backward_cost).tolist()
+        upper = np.maximum(forward_cost, backward_cost).tolist()
+        # pairs by their lower cost, and by their higher cost in decreasing order; merged pairs are dropped when popped
+        lowest = list(zip(lower, range(len(first))))
+        highest = list(zip([-cost for cost in upper], range(len(first))))
+        heapq.heapify(lowest)
+        heapq.heapify(highest)
+
+        steps = {
+            key: []
+            for key in (
+                "first",
+                "second",
+                "first_count",
+                "second_count",
+                "kept",
+                "removed",
+                "cost",
+            )
+        }
+        for _ in range(len(positions) - 1):
+            # the lowest cost is at most the higher cost of any pair, so only the pairs whose lower cost is below the
+            # higher costs of those popped before can have it; likewise for the highest cost
+            low_pairs = []
+            bound = np.inf
+            while lowest and lowest[0][0] <= bound:
+                _, p = heapq.heappop(lowest)
+                if not (merged[first[p]] or merged[second[p]]):
+                    low_pairs.append(p)
+                    bound = min(bound, upper[p])
+            high_pairs = []
+            bound = -np.inf
+            while highest and -highest[0][0] >= bound:
+                _, p = heapq.heappop(highest)
+                if not (merged[first[p]] or merged[second[p]]):
+                    high_pairs.append(p)
+                    bound = max(bound, lower[p])
+
+            # order of the remaining centroids, as in get_unique_centroids, which sets the direction of the paths
+            remaining = np.flatnonzero(~merged)
+            remaining = remaining[np.argsort(first_node[remaining])]
+            rank = np.zeros(len(positions), dtype=np.int64)
+            for r, position in enumerate(set(positions[i] for i in remaining)):
+                rank[index_of[position]] = r
+
+            pairs = np.array(low_pairs)
+            forward = rank[first[pairs]] < rank[second[pairs]]
+            cost = np.where(forward, forward_cost[pairs], backward_cost[pairs])
+            # the pairs are sorted by cost; equal costs keep the order in which the pairs are enumerated
+            tied = np.flatnonzero(cost == cost.min())
+            low = np.minimum(rank[first[pairs[tied]]], rank[second[pairs[tied]]])
+            high = np.maximum(rank[first[pairs[tied]]], rank[second[pairs[tied]]])
+            pick = tied[np.lexsort((high, low))[0]]
+
+            # normalize the cost such that the largest cost at each step is always one
+            top = np.array(high_pairs)
+            max_cost = np.where(
+                rank[first[top]] < rank[second[top]],
+                forward_cost[top],
+                backward_cost[top],
+            ).max()
+            min_cost = cost[pick] / max_cost
+
+            i, j = first[pairs[pick]], second[pairs[pick]]
+            if not forward[pick]:
+                i, j = j, i
+            steps["first"].append(i)
+            steps["second"].append(j)
+            steps["first_count"].append(nodes_count[i])
+            steps["second_count"].append(nodes_count[j])
+            steps["cost"].append(min_cost)
 
             # this method takes the centroid with the larger number of nodes
-            if nodes_a < nodes_b:
-                replace_a_with_b = True
+            if nodes_count[i] < nodes_count[j]:
+                i, j = j, i
+            steps["kept"].append(i)
+            steps["removed"].append(j)
+            nodes_count[i] += nodes_count[j]
+            first_node[i] = min(first_node[i], first_node[j])
+            merged[j] = True
+            for p in low_pairs:
+                if first[p] != j and second[p] != j:
+                    heapq.heappush(lowest, (lower[p], p))
+            for p in high_pairs:
+                if first[p] != j and second[p] != j:
+                    heapq.heappush(highest, (-upper[p], p))
+
+        hierarchy = {key: np.array(value) for key, value in steps.items()}
+        hierarchy["cost"] = hierarchy["cost"].astype(float)
+        hierarchy["umat"] = self.umat.copy()
+        hierarchy["naive_centroids"] = naive_centroids
+        hierarchy["positions"] = positions
+        self.merge_hierarchy = hierarchy
+        return hierarchy
+
+    def cut_merge_hierarchy(self, hierarchy: dict, threshold=0.3) -> dict:
+        """
+        Apply the merges of a hierarchy up to the first step whose normalized cost reaches the threshold.
 
-            # this method takes the centroid with the smaller U-matrix value
-            # if heat_a > heat_b:
-            #     replace_a_with_b = True
+        Args:
+                hierarchy (dict): The merge hierarchy from build_merge_hierarchy.
+                threshold (float, optional): Any centroids with pairwise cost less than this threshold is merged. Defaults to 0.3.
 
-            if replace_a_with_b:
-                centroids = self.replace_value(centroids, centroid_a, centroid_b)
-            else:
-                centroids = self.replace_value(centroids, centroid_b, centroid_a)
+        Returns:
+                dict: new node map with combined centroids
+        """
 
-            # print("New centroids: \n", centroids, flush=True)
-            centroids = self.merge_similar_centroids(centroids, threshold)
+        positions = hierarchy["positions"]
+        cost = hierarchy["cost"]
+        above = np.flatnonzero(cost >= threshold)
+        number_steps = above[0] if len(above) else len(cost)
+
+        for i, j, count_i, count_j in zip(
+            hierarchy["first"][:number_steps].tolist(),
+            hierarchy["second"][:number_steps].tolist(),
+            hierarchy["first_count"][:number_steps].tolist(),
+            hierarchy["second_count"][:number_steps].tolist(),
+        ):
+            print(f"Centroid A: {positions[i]}, count: {count_i}", flush=True)
+            print(f"Centroid B: {positions[j]}, count: {count_j}", flush=True)
+            print("Merging...", flush=True)
+
+        # each centroid points to the one it was merged into, then follow the pointers to the surviving centroid
+        parent = np.arange(len(positions))
+        parent[hierarchy["removed"][:number_steps]] = hierarchy["kept"][:number_steps]
+        while True:
+            root = parent[parent]
+            if np.array_equal(root, parent):
+                break
+            parent = root
+
+        # index of the naive centroid of each node, looked up by its 1d location
+        naive_centroids = hierarchy["naive_centroids"]
+        position_index = np.zeros(self.xdim * self.ydim, dtype=np.int64)
+        position_x = np.array([x for x, y in positions], dtype=np.int64)
+        position_y = np.array([y for x, y in positions], dtype=np.int64)
+        position_index[position_x * self.ydim + position_y] = np.arange(len(positions))
+        node_root = parent[
+            position_index[
+                naive_centroids["centroid_x"] * self.ydim
+                + naive_centroids["centroid_y"]
+            ]
+        ]
+        centroids = {
+            "centroid_x": position_x[node_root],
+            "centroid_y": position_y[node_root],
+        }
+
+        if number_steps < len(cost):
+            min_cost = cost[number_steps]
+        elif len(cost):
+            min_cost = cost[-1]
         else:
-            unique_centroids = self.get_unique_centroids(centroids)
-            # print("Centroids: \n", unique_centroids, flush=True)
-            print(
-                "Number of unique centroids: ",
-                len(unique_centroids["position_x"]),
-                flush=True,
-            )
-            print("Minimum cost between centroids: ", sorted_cost[0][2], flush=True)
-            return centroids
+            min_cost = None
+        unique_centroids = self.get_unique_centroids(centroids)
+        print(
+            "Number of unique centroids: ",
+            len(unique_centroids["position_x"]),
+            flush=True,
+        )
+        print("Minimum cost between centroids: ", min_cost, flush=True)
 
         return centroids
 
@@ -952,42 +2581,87 @@ class Lattice:
                 position_y: A list of unique y positions.
         """
 
-        # get the dimensions of the map
-        xdim = self.xdim
-        ydim = self.ydim
-        xlist = []
-        ylist = []
-        centr_locs = []
-
-        # create a list of unique centroid positions
-        for ix in range(xdim):
-            for iy in range(ydim):
-                cx = centroids["centroid_x"][ix, iy]
-                cy = centroids["centroid_y"][ix, iy]
-
-                centr_locs.append((cx, cy))
-
-        self.nodes_count = {i: centr_locs.count(i) for i in centr_locs}
+        # count the nodes attached to each centroid, in order of first appearance
+        positions = np.stack(
+            (centroids["centroid_x"].ravel(), centroids["centroid_y"].ravel()), axis=1
+        )
+        unique_positions, first, counts = np.unique(
+            positions, axis=0, return_index=True, return_counts=True
+        )
+        order = np.argsort(first)
+        self.nodes_count = dict(
+            zip(map(tuple, unique_positions[order].tolist()), counts[order].tolist())
+        )
 
-        unique_ids = list(set(centr_locs))
+        unique_ids = self.unique_ids(centroids)
         xlist = [x for x, y in unique_ids]
         ylist = [y for x, y in unique_ids]
 
         return {"position_x": xlist, "position_y": ylist}
 
-    def compute_umat(self, smoothing=None):
+    @staticmethod
+    def unique_ids(centroids: dict[str, np.ndarray]) -> list[tuple]:
+        """
+        List the distinct (x, y) centroid locations, in the order used to number the clusters.
+
+        Args:
+                centroids (dict[str, np.ndarray]): A dictionary containing the centroids.
+
+        Returns:
+                list[tuple]: The distinct centroid locations.
+        """
+        return list(
+            set(
+                zip(
+                    centroids["centroid_x"].ravel().tolist(),
+                    centroids["centroid_y"].ravel().tolist(),
+                )
+            )
+        )
+
+    def compute_umat(self, smoothing=None, lattice=None):
         """
         Compute the unified distance matrix.
 
         Args:
                 smoothing (float, optional): A positive floating point value controlling the smoothing of the umat representation. Defaults to None.
+                lattice (np.ndarray, optional): Node weights to use instead of self.lattice, e.g. a snapshot from lattice_history. Defaults to None.
 
         Returns:
                 numpy.ndarray: A matrix with the same x-y dimensions as the original map containing the umat values.
         """
 
-        d = euclidean_distances(self.lattice, self.lattice) / (self.xdim * self.ydim)
-        umat = self.compute_heat(d, smoothing)
+        if lattice is None:
+            lattice = self.lattice
+        x = self.xdim
+        y = self.ydim
+        if x == 1 or y == 1:
+            sys.exit(
+                "compute_umat: umat can not be computed for a map with a dimension of 1"
+            )
+
+        # only the distances between neighbors are needed, so instead of the full distance matrix of compute_heat,
+        # each of the 8 neighbor directions is one difference of shifted views of the [X, Y, F] lattice
+        nodes = lattice.reshape((y, x, -1)).transpose((1, 0, 2))
+        heat = np.zeros((x, y), dtype=lattice.dtype)
+        count = np.zeros((x, y), dtype=int)
+        for dx, dy in umat_neighbors:
+            # the nodes (ix, iy) that have a neighbor (ix + dx, iy + dy), and these neighbors
+            this = (
+                slice(max(-dx, 0), x - max(dx, 0)),
+                slice(max(-dy, 0), y - max(dy, 0)),
+            )
+            other = (
+                slice(max(dx, 0), x + min(dx, 0)),
+                slice(max(dy, 0), y + min(dy, 0)),
+            )
+            heat[this] += np.sqrt(
+                np.sum((nodes[this] - nodes[other]) ** 2, axis=-1)
+            ) / (x * y)
+            count[this] += 1
+        heat /= count
+
+        umat = self.smooth_heat(heat, smoothing)
 
         return umat
 
@@ -1005,7 +2679,7 @@ class Lattice:
 
         x = self.xdim
         y = self.ydim
-        heat = np.array([[0.0] * y for _ in range(x)])
+        heat = np.zeros((x, y), dtype=d.dtype)
 
         if x == 1 or y == 1:
             sys.exit(
@@ -1132,12 +2806,28 @@ class Lattice:
             )
             heat[ix, iy] = sum / 3
 
+        return self.smooth_heat(heat, smoothing)
+
+    def smooth_heat(self, heat, smoothing=None):
+        """
+        Smooth a heat map, as requested by the smoothing parameter of compute_umat and compute_heat.
+
+        Args:
+                heat (numpy.ndarray): An X x Y heat map.
+                smoothing (float, optional): None for no smoothing, 0 for the default smoothing, or a positive value for the smoothing length. Defaults to None.
+
+        Returns:
+                numpy.ndarray: The smoothed heat map.
+        """
+
         if smoothing is not None:
             if smoothing == 0:
-                heat = self.smooth_2d(heat, nrow=x, ncol=y, surface=False)
+                heat = self.smooth_2d(
+                    heat, nrow=self.xdim, ncol=self.ydim, surface=False
+                )
             elif smoothing > 0:
                 heat = self.smooth_2d(
-                    heat, nrow=x, ncol=y, surface=False, theta=smoothing
+                    heat, nrow=self.xdim, ncol=self.ydim, surface=False, theta=smoothing
                 )
             else:
                 sys.exit("compute_heat: bad value for smoothing parameter")
@@ -1214,12 +2904,12 @@ class Lattice:
         Args:
                 Y (array-like): The input data to be smoothed.
                 ind (array-like, optional): The indices of the data to be smoothed. Defaults to None.
-                weight_obj (dict, optional): The weight object used for smoothing. Defaults to None.
+                weight_obj (dict, optional): Unused; the weights are cached per (nrow, ncol, theta). Defaults to None.
                 grid (dict, optional): The grid object used for smoothing. Defaults to None.
                 nrow (int, optional): The number of rows in the grid. Defaults to 64.
                 ncol (int, optional): The number of columns in the grid. Defaults to 64.
                 surface (bool, optional): Flag indicating whether the data represents a surface. Defaults to True.
-                theta (float, optional): The theta value used in the exponential covariance function. Defaults to None.
+                theta (float, optional): The theta value used in the exponential covariance function. Defaults to None, for 2.
 
         Returns:
                 array-like: The smoothed data.
@@ -1229,55 +2919,34 @@ class Lattice:
 
         """
 
-        def exp_cov(x1, x2, theta=2, p=2, distMat=0):
-            x1 = x1 * (1 / theta)
-            x2 = x2 * (1 / theta)
-            distMat = euclidean_distances(x1, x2)
-            distMat = distMat**p
-            return np.exp(-distMat)
-
-        NN = [[1] * ncol] * nrow
-        grid = {"x": [i for i in range(nrow)], "y": [i for i in range(ncol)]}
-
-        if weight_obj is None:
-            dx = grid["x"][1] - grid["x"][0]
-            dy = grid["y"][1] - grid["y"][0]
-            m = len(grid["x"])
-            n = len(grid["y"])
-            M = 2 * m
-            N = 2 * n
-            xg = []
-
-            for i in range(N):
-                for j in range(M):
-                    xg.extend([[j, i]])
-
-            xg = np.array(xg)
+        if theta is None:
+            theta = 2  # default length of the exponential covariance
+        M = 2 * nrow
+        N = 2 * ncol
 
-            center = []
-            center.append([int(dx * M / 2 - 1), int((dy * N) / 2 - 1)])
-
-            out = exp_cov(xg, np.array(center), theta=theta)
-            out = np.transpose(np.reshape(out, (N, M)))
+        def convolve(values, wght):
+            # zero-padded circular convolution of values with the smoothing kernel
             temp = np.zeros((M, N))
-            temp[int(M / 2 - 1)][int(N / 2 - 1)] = 1
-
-            wght = np.fft.fft2(out) / (np.fft.fft2(temp) * M * N)
-            weight_obj = {"m": m, "n": n, "N": N, "M": M, "wght": wght}
-
-        temp = np.zeros((weight_obj["M"], weight_obj["N"]))
-        temp[0:m, 0:n] = Y
-        temp2 = np.fft.ifft2(np.fft.fft2(temp) * weight_obj["wght"]).real[
-            0 : weight_obj["m"], 0 : weight_obj["n"]
-        ]
+            temp[0:nrow, 0:ncol] = values
+            return np.fft.irfft2(np.fft.rfft2(temp) * wght, s=(M, N))[0:nrow, 0:ncol]
+
+        key = (nrow, ncol, theta)
+        if key not in self.smoothing_cache:
+            # exponential covariance of each grid offset from the center (M/2 - 1, N/2 - 1) of the padded grid,
+            # arranged so that the zero offset is at the origin
+            offset_x = (np.arange(M) + nrow - 1) % M - (nrow - 1)
+            offset_y = (np.arange(N) + ncol - 1) % N - (ncol - 1)
+            kernel = np.exp(
+                -(offset_x[:, np.newaxis] ** 2 + offset_y[np.newaxis, :] ** 2)
+                / theta**2
+            )
+            wght = np.fft.rfft2(kernel)
 
-        temp = np.zeros((weight_obj["M"], weight_obj["N"]))
-        temp[0:m, 0:n] = NN
-        temp3 = np.fft.ifft2(np.fft.fft2(temp) * weight_obj["wght"]).real[
-            0 : weight_obj["m"], 0 : weight_obj["n"]
-        ]
+            # the smoothed constant surface normalizes the weights near the edges
+            self.smoothing_cache[key] = (wght, convolve(np.ones((nrow, ncol)), wght))
 
-        return temp2 / temp3
+        wght, norm = self.smoothing_cache[key]
+        return convolve(Y, wght) / norm
 
     def plot_heat(self, heat, explicit=False, comp=True, merge=False, merge_cost=0.001):
         """
@@ -0,0 +1,49 @@
+import pytest
+import numpy as np
+
+from aweSOM import Lattice
+from aweSOM.history import LatticeHistory
+
+rng = np.random.default_rng()
+snapshots = [rng.random((20, 3)) for _ in range(5)]
+
+
+@pytest.mark.parametrize("mode", ["all", "last", "disk", "off"])
+def test_lattice_history(mode, tmp_path):
+    history = LatticeHistory(mode, size=2, path=str(tmp_path / "history.h5"))
+    for snapshot in snapshots:
+        lattice = snapshot.copy()
+        history.append(lattice)
+        lattice += 1.0  # the history keeps a copy
+
+    expected = {"all": snapshots, "last": snapshots[-2:], "disk": snapshots, "off": []}[
+        mode
+    ]
+    assert len(history) == len(expected)
+    assert all(np.array_equal(a, b) for a, b in zip(history, expected))
+    if expected:
+        assert np.array_equal(history[-1], expected[-1])
+        assert len(history[1:]) == len(expected) - 1
+    with pytest.raises(IndexError):
+        history[len(expected)]
+
+
+def test_lattice_history_restart(tmp_path):
+    # a new history on the same file replaces the old snapshots
+    path = str(tmp_path / "history.h5")
+    for _ in range(2):
+        history = LatticeHistory("disk", path=path)
+        for snapshot in snapshots[:3]:
+            history.append(snapshot)
+    assert len(LatticeHistory("disk", path=path)) == 0
+    assert np.array_equal(np.array(history), np.array(snapshots[:3]))
+
+
+def test_umat_history():
+    map = Lattice(5, 4, history="last", history_size=3)
+    for snapshot in snapshots:
+        map.save_snapshot(snapshot)
+    assert len(map.umat_history) == 3
+    map.lattice = snapshots[-1]
+    assert np.array_equal(map.umat_history[-1], map.compute_umat())
+    assert np.array(map.umat_history).shape == (3, 5, 4)
@@ -9,6 +9,7 @@ from aweSOM.make_sce_clusters import (
     get_gsum_values,
     get_sce_cluster_separation,
     combine_separated_clusters,
+    get_gsum_mask,
     make_file_name,
 )
 
@@ -98,6 +99,72 @@ def test_combine_separated_clusters():
     )
     assert combined_clusters.shape == (7, 150)
 
+    # summing the stacked masks of each cluster gives the same map
+    for cluster, (start, end) in enumerate(cluster_ranges):
+        masks = np.array(
+            [
+                np.load(file_path + f"/mask-{instance[2]}-id{instance[1]}.npy")
+                for instance in map_list[start:end]
+            ],
+            dtype=np.float32,
+        )
+        assert np.array_equal(combined_clusters[cluster], np.sum(masks, axis=0))
+
+
+def test_get_gsum_mask(tmp_path):
+    # without mask files, the masks are rebuilt from the labels and gsum values
+    file_path = "examples/iris/som_results/SCE"
+    labels_path = "examples/iris/som_results"
+    _, map_list = get_gsum_values(file_path + "/multimap_mappings.txt")
+    for instance in map_list:
+        mask = np.load(file_path + f"/mask-{instance[2]}-id{instance[1]}.npy")
+        rebuilt = get_gsum_mask(instance, [150], str(tmp_path), labels_path)
+        assert np.array_equal(rebuilt, mask)
+
+    # by default the labels are read from the parent folder
+    (tmp_path / "SCE").mkdir()
+    np.save(
+        tmp_path / f"{map_list[0][2]}.npy",
+        np.load(f"{labels_path}/{map_list[0][2]}.npy"),
+    )
+    assert np.array_equal(
+        get_gsum_mask(map_list[0], [150], str(tmp_path / "SCE")),
+        get_gsum_mask(map_list[0], [150], file_path),
+    )
+
+    # leftover mask files are only read with mask_files
+    gsum_value, cid, run = map_list[0]
+    np.save(tmp_path / "SCE" / f"mask-{run}-id{cid}.npy", np.ones(150))
+    assert not np.array_equal(
+        get_gsum_mask(map_list[0], [150], str(tmp_path / "SCE")), np.ones(150)
+    )
+    assert np.array_equal(
+        get_gsum_mask(map_list[0], [150], str(tmp_path / "SCE"), mask_files=True),
+        np.ones(150),
+    )
+
+
+def test_get_gsum_mask_run_names(tmp_path, monkeypatch):
+    # run names ending in any of the letters of ".npy" are recorded and read back unchanged
+    from aweSOM.sce import main
+
+    monkeypatch.chdir(tmp_path)  # main changes the working directory
+
+    rng = np.random.default_rng(0)
+    for run in ["labels.run-1-happy", "labels.run-2-yp"]:
+        np.save(tmp_path / f"{run}.npy", rng.integers(0, 3, 20).astype(np.int32))
+    main(str(tmp_path), "SCE", [20])
+
+    _, map_list = get_gsum_values(str(tmp_path / "SCE" / "multimap_mappings.txt"))
+    assert sorted({instance[2] for instance in map_list}) == [
+        "labels.run-1-happy",
+        "labels.run-2-yp",
+    ]
+    for instance in map_list:
+        labels = np.load(tmp_path / f"{instance[2]}.npy")
+        mask = get_gsum_mask(instance, [20], str(tmp_path / "SCE"))
+        assert np.array_equal(mask, np.where(labels == instance[1], instance[0], 0.0))
+
 
 def test_make_file_name():
     assert make_file_name(1, "png") == "0001.png"
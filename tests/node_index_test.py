@@ -0,0 +1,111 @@
+import pytest
+import numpy as np
+
+from aweSOM.node_index import (
+    use_node_index,
+    build_node_index,
+    refit_node_index,
+    expand_node_index,
+    query_node_index,
+)
+
+number_nodes = 1500
+number_features = 3
+lattice = np.random.rand(number_nodes, number_features)
+obs = np.random.rand(200, number_features)
+
+
+@pytest.fixture
+def node_index():
+    return build_node_index(lattice.copy(), leaf_size=8)
+
+
+def test_build_node_index(node_index):
+    print("Testing the node index structure", flush=True)
+    order, start, stop, left, right, parent, leaf_of, lower, upper = node_index
+    assert np.array_equal(np.sort(order), np.arange(number_nodes))
+    assert start[0] == 0 and stop[0] == number_nodes
+
+    leaves = left == -1
+    assert np.all(stop[leaves] - start[leaves] <= 8)
+    assert np.all(right[leaves] == -1)
+    # children come after their parent and split its range in two
+    inner = np.flatnonzero(~leaves)
+    assert np.all(left[inner] > inner) and np.all(right[inner] > inner)
+    assert np.array_equal(stop[left[inner]], start[right[inner]])
+    assert np.array_equal(parent[left[inner]], inner)
+
+    # every node belongs to its leaf and lies inside the boxes of its leaf and of the root
+    position = np.argsort(order)
+    assert np.all(leaves[leaf_of])
+    assert np.all((start[leaf_of] <= position) & (position < stop[leaf_of]))
+    assert np.all(lattice >= lower[leaf_of]) and np.all(lattice <= upper[leaf_of])
+    assert np.allclose(lower[0], lattice.min(axis=0))
+    assert np.allclose(upper[0], lattice.max(axis=0))
+
+
+def test_query_node_index(node_index):
+    print("Testing exact queries on the node index", flush=True)
+    order, start, stop, left, right, _, _, lower, upper = node_index
+    stack = np.empty(start.shape[0] + 1, dtype=np.int64)
+    distances = np.sum((obs[:, None, :] - lattice[None, :, :]) ** 2, axis=2)
+    expected = np.argsort(distances, axis=1, kind="stable")[:, :2]
+
+    for k in range(obs.shape[0]):
+        best_node, best, second_node, second = query_node_index(
+            lattice, obs[k], order, start, stop, left, right, lower, upper, stack, True
+        )
+        assert (best_node, second_node) == tuple(expected[k])
+        assert np.isclose(best, distances[k, best_node])
+        assert best <= second
+
+    # ties go to the lower node index, same as a linear scan
+    duplicated = np.vstack([lattice, lattice])
+    order, start, stop, left, right, _, _, lower, upper = build_node_index(duplicated)
+    stack = np.empty(start.shape[0] + 1, dtype=np.int64)
+    for k in range(10):
+        best_node, _, second_node, _ = query_node_index(
+            duplicated,
+            obs[k],
+            order,
+            start,
+            stop,
+            left,
+            right,
+            lower,
+            upper,
+            stack,
+            True,
+        )
+        assert best_node == expected[k, 0]
+        assert second_node == expected[k, 0] + number_nodes
+
+
+def test_expand_and_refit_node_index(node_index):
+    print("Testing box updates of the node index", flush=True)
+    moved = lattice.copy()
+    order, start, stop, left, right, parent, leaf_of, lower, upper = node_index
+    stack = np.empty(start.shape[0] + 1, dtype=np.int64)
+
+    # move some nodes outside of their boxes; the expanded index stays exact
+    for node in np.random.choice(number_nodes, 50, replace=False):
+        moved[node] = np.random.rand(number_features) * 1.5 - 0.25
+        expand_node_index(moved, node, parent, leaf_of, lower, upper)
+    assert np.all(moved >= lower[leaf_of]) and np.all(moved <= upper[leaf_of])
+    distances = np.sum((obs[:, None, :] - moved[None, :, :]) ** 2, axis=2)
+    for k in range(obs.shape[0]):
+        best_node = query_node_index(
+            moved, obs[k], order, start, stop, left, right, lower, upper, stack
+        )[0]
+        assert best_node == np.argmin(distances[k])
+
+    # refitting gives the same boxes as a fresh build with the same tree
+    refit_node_index(moved, order, start, stop, left, right, lower, upper)
+    assert np.allclose(lower[0], moved.min(axis=0))
+    assert np.allclose(upper[0], moved.max(axis=0))
+
+
+def test_use_node_index():
+    assert use_node_index(100 * 100, 3)
+    assert not use_node_index(10 * 10, 3)
+    assert not use_node_index(100 * 100, 64)
@@ -7,8 +7,10 @@ from aweSOM.run_som import (
     number_of_nodes,
     initialize_lattice,
     manual_scaling,
+    scaling_statistics,
     save_som_object,
     save_cluster_labels,
+    open_cluster_labels,
 )
 
 
@@ -64,6 +66,20 @@ def test_manual_scaling(sample_data):
     scaled_data = manual_scaling(sample_data)
     assert scaled_data.shape == sample_data.shape
 
+    scaled_data_32 = manual_scaling(sample_data, dtype=np.float32)
+    assert scaled_data_32.dtype == np.float32
+    assert np.allclose(scaled_data_32, scaled_data, atol=1e-6)
+
+
+def test_scaling_statistics(sample_data):
+    mean, std = scaling_statistics(sample_data, chunk_size=30)
+    assert np.allclose(mean, np.mean(sample_data, axis=0))
+    assert np.allclose(std, np.std(sample_data, axis=0))
+
+    # a chunk scaled with the statistics of the full data is the same rows of the scaled full data
+    chunk = manual_scaling(sample_data[30:60], statistics=(mean, std))
+    assert np.allclose(chunk, manual_scaling(sample_data)[30:60])
+
 
 def test_save_som_object():
     som = MockLattice(10, 10, 0.5, 100)
@@ -85,6 +101,16 @@ def test_save_cluster_labels():
     os.remove(file_name)
 
 
+def test_open_cluster_labels():
+    labels = open_cluster_labels(25, np.uint8, 10, 10, 0.5, 100, name_of_dataset="test")
+    labels[:] = np.arange(25)
+    labels.flush()
+    del labels
+    file_name = "labels.test-10-10-0.5-100-1s.npy"
+    assert np.array_equal(np.load(file_name), np.arange(25, dtype=np.uint8))
+    os.remove(file_name)
+
+
 # Run the tests
 if __name__ == "__main__":
     pytest.main()
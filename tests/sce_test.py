@@ -3,12 +3,24 @@ import numpy as np
 from unittest.mock import patch
 import warnings
 import glob
+import os
+import argparse
 
 from aweSOM.sce import (
     load_som_npy,
+    RunCache,
     create_mask,
     compute_SQ,
+    contingency_table,
+    SQ_from_contingency,
+    loop_over_all_clusters,
+    loop_over_all_clusters_contingency,
+    run_pairs,
+    shard_pairs,
+    merge_shards,
+    parse_shard,
     find_number_of_clusters,
+    main,
 )
 
 # Mock data for testing
@@ -74,6 +86,138 @@ def test_compute_SQ():
     assert isinstance(SQ_matrix, np.ndarray)
 
 
+def test_SQ_from_contingency():
+    rng = np.random.default_rng(3)
+    labels = rng.integers(0, 3, 40)
+    labelsC = rng.integers(0, 4, 40)
+    labelsC[labels == 2] = 3  # some pairs with Q = 0 or empty intersections
+
+    table = contingency_table(labels, labelsC)
+    assert np.array_equal(
+        table, np.bincount(labels * 4 + labelsC, minlength=12).reshape(3, 4)
+    )
+
+    # same values as the masks, including an id (4) missing from the second run
+    SQ_table = SQ_from_contingency(table, 3, 5)
+    for cid in range(3):
+        for cidC in range(5):
+            SQ, _ = compute_SQ(create_mask(labels, cid), create_mask(labelsC, cidC))
+            assert SQ_table[cid, cidC] == SQ
+
+
+def test_loop_over_all_clusters_contingency(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(4)
+    dimensions = np.array([4, 5, 6])
+    cluster_files = []
+    for run in range(4):
+        labels = rng.integers(0, 3 + run % 2, np.prod(dimensions)).astype(np.int32)
+        if run == 2:
+            labels[labels == 1] = 2  # ids 0 and 2 only
+        cluster_files.append(f"labels.run-{run}.npy")
+        np.save(cluster_files[-1], labels)
+    nids_array = find_number_of_clusters(cluster_files)
+
+    for subfolder in ["masks", "masks-3", "contingency", "contingency-1"]:
+        (tmp_path / subfolder).mkdir()
+    loop_over_all_clusters(cluster_files, nids_array, dimensions, "masks")
+    loop_over_all_clusters(cluster_files, nids_array, dimensions, "masks-3", workers=3)
+    loop_over_all_clusters_contingency(
+        cluster_files, nids_array, dimensions, "contingency"
+    )
+    loop_over_all_clusters_contingency(
+        cluster_files, nids_array, dimensions, "contingency-1", workers=1
+    )
+
+    # same output for both engines and any number of workers
+    expected = (tmp_path / "masks" / "multimap_mappings.txt").read_text()
+    for subfolder in ["masks-3", "contingency", "contingency-1"]:
+        assert (tmp_path / subfolder / "multimap_mappings.txt").read_text() == expected
+
+    # only the Gsum values are saved, the masks are rebuilt from the runs when needed
+    assert list(tmp_path.glob("*/mask-*.npy")) == []
+
+
+def test_merge_shards(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(5)
+    for run in range(5):
+        np.save(f"labels.run-{run}.npy", rng.integers(0, 4, 120).astype(np.int32))
+
+    main(str(tmp_path), "SCE", [120])
+    expected = (tmp_path / "SCE" / "multimap_mappings.txt").read_text()
+
+    # every pair of runs is in exactly one shard, some shards have none
+    for number_of_shards in [1, 3, 12]:
+        pairs = [shard_pairs(5, k, number_of_shards) for k in range(number_of_shards)]
+        assert sorted(sum(pairs, [])) == run_pairs(5)
+
+        subfolder = f"shards-{number_of_shards}"
+        for k in range(number_of_shards):
+            main(str(tmp_path), subfolder, [120], shard=(k, number_of_shards))
+        assert not (tmp_path / subfolder / "multimap_mappings.txt").exists()
+        merge_shards(subfolder)
+        assert (tmp_path / subfolder / "multimap_mappings.txt").read_text() == expected
+
+    # a shard only reads the runs it compares, and every n-th run
+    with patch("numpy.bincount", wraps=np.bincount) as bincount:
+        main(str(tmp_path), "shards-new", [120], shard=(11, 12))
+        bincount.assert_not_called()
+        main(str(tmp_path), "shards-new", [120], shard=(0, 12))
+        assert bincount.call_count == 2  # the pair (0, 1)
+
+    (tmp_path / "shards-3" / "shard-1-of-3.npz").unlink()
+    with pytest.raises(ValueError, match="missing shards"):
+        merge_shards("shards-3")
+
+    assert parse_shard("2/3") == (2, 3)
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_shard("3/3")
+
+
+def test_run_cache(tmp_path):
+    path_to_example_files = "examples/iris/som_results/"
+    all_files = sorted(glob.glob(path_to_example_files + "/*.npy"))
+    index_file = tmp_path / "run_index.json"
+
+    cache = RunCache(all_files, str(index_file))
+    assert len(cache) == len(all_files)
+    assert np.array_equal(cache.number_of_clusters, find_number_of_clusters(all_files))
+    assert np.array_equal(cache.max_ids, [np.max(np.load(file)) for file in all_files])
+    for i, file in enumerate(all_files):
+        assert np.array_equal(cache[i], np.load(file))
+
+    # the index is reused without reading the files, unless a file changed
+    with patch("numpy.bincount") as bincount:
+        assert np.array_equal(
+            RunCache(all_files, str(index_file)).number_of_clusters,
+            cache.number_of_clusters,
+        )
+        bincount.assert_not_called()
+
+    # only the given runs are opened
+    cache = RunCache(all_files, runs=[1, 3])
+    assert cache[0] is None and cache[2] is None
+    assert np.array_equal(cache[3], np.load(all_files[3]))
+    expected = np.full(len(all_files), -1)
+    expected[[1, 3]] = find_number_of_clusters([all_files[1], all_files[3]])
+    assert np.array_equal(cache.number_of_clusters, expected)
+
+    changed = tmp_path / "changed.npy"
+    np.save(changed, np.array([0, 1, 2, 5]))
+    RunCache([str(changed)], str(index_file))
+    np.save(changed, np.array([0, 0, 0, 0, 0]))
+    os.utime(changed, (0, 0))
+    assert RunCache([str(changed)], str(index_file)).number_of_clusters[0] == 1
+
+    # the runs are only copied to the JAX device for the masks engine
+    with patch("aweSOM.sce.USE_JAX", True), patch("aweSOM.sce.jnp", create=True) as jnp:
+        RunCache(all_files, str(index_file), device_bytes=10**9)
+        jnp.asarray.assert_not_called()
+        RunCache(all_files, str(index_file), device_bytes=10**9, device=True)
+        assert jnp.asarray.call_count == len(all_files)
+
+
 def test_find_number_of_clusters():
     # Example data for testing
     path_to_example_files = "examples/iris/som_results/"
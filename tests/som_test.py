@@ -1,6 +1,17 @@
 import pytest
 import numpy as np
+import h5py
 from aweSOM import Lattice
+from aweSOM.node_index import build_node_index
+from aweSOM.som import (
+    train_chunk,
+    train_chunk_parallel,
+    train_chunk_indexed,
+    batch_accumulate,
+    neighborhood_table,
+    label_ensemble,
+    bmu_search_buffers,
+)
 
 # Set up the parameters for the lattice; can change to stress test
 training_steps = 10000
@@ -91,12 +102,394 @@ def test_Gamma(trained_map: Lattice):
     assert np.abs(gamma[reference_index] - expected_value) < 1e-4
 
 
+def test_train_chunk(map: Lattice):
+    print("Testing JIT-compiled training steps", flush=True)
+    lattice = np.random.uniform(0.0, 1.0, (xdim * ydim, data_dims[1]))
+    indices = np.random.randint(0, data_dims[0], 200)
+    m2Ds = map.coordinate(np.arange(xdim * ydim).reshape((-1, 1)), xdim)
+    nsize = 8
+
+    # reference: the sequential update rule, one step at a time
+    expected = lattice.copy()
+    for step in range(200):
+        diff = expected - data[indices[step]]
+        c = np.argmin(np.sum(diff**2, axis=1))
+        gamma_m = np.outer(map.Gamma(c, m2Ds, alpha_0, nsize), np.ones(data_dims[1]))
+        expected -= diff * gamma_m
+
+    lattice_parallel = lattice.copy()
+    kernel = map.neighborhood_kernel(nsize, alpha_0)
+    train_chunk(lattice, data, indices, 0, 100, xdim, kernel)
+    train_chunk(lattice, data, indices, 100, 200, xdim, kernel)
+    assert np.array_equal(lattice, expected)
+
+    train_chunk_parallel(lattice_parallel, data, indices, 0, 200, xdim, kernel)
+    assert np.array_equal(lattice_parallel, expected)
+
+    # the node index finds the same BMUs; refit often to exercise both box updates
+    lattice_indexed = lattice_parallel.copy()
+    lattice_parallel = lattice_parallel.copy()
+    train_chunk(lattice_parallel, data, indices, 0, 200, xdim, kernel)
+    node_index = build_node_index(lattice_indexed, leaf_size=4)
+    train_chunk_indexed(
+        lattice_indexed, data, indices, 0, 200, xdim, kernel, node_index, 50
+    )
+    assert np.array_equal(lattice_indexed, lattice_parallel)
+
+
+def test_neighborhood_table(map: Lattice):
+    print("Testing neighborhood lookup tables", flush=True)
+    m2Ds = map.coordinate(np.arange(xdim * ydim).reshape((-1, 1)), xdim)
+    bmu_index = np.random.randint(0, xdim * ydim)
+    nsize = 8
+    chebyshev_distance = np.max(np.abs(m2Ds - m2Ds[bmu_index]), axis=1)
+    inside = chebyshev_distance <= nsize
+
+    # the Gaussian and bubble tables match Gamma exactly within the neighborhood
+    kernel = map.neighborhood_kernel(nsize, alpha_0)
+    gamma = map.Gamma(bmu_index, m2Ds, alpha_0, nsize)
+    assert np.array_equal(kernel[chebyshev_distance[inside]], gamma[inside])
+    assert nsize in map.kernel_cache
+
+    bubble = alpha_0 * neighborhood_table(nsize, "bubble")
+    gamma = map.Gamma(bmu_index, m2Ds, alpha_0, nsize, gaussian=False)
+    assert np.array_equal(bubble[chebyshev_distance[inside]], gamma[inside])
+
+    # compact-support shapes decay monotonically and stay positive up to nsize
+    for shape in ["triangle", "epanechnikov"]:
+        table = neighborhood_table(nsize, shape)
+        assert table[0] == 1.0
+        assert np.all(np.diff(table) < 0)
+        assert table[-1] > 0.0
+
+
+def test_training_schedule(map: Lattice):
+    print("Testing training schedule", flush=True)
+    map.alpha_type = 1
+    boundaries, chunk_alpha, chunk_nsize, final_alpha = map.training_schedule(
+        0,
+        training_steps,
+        alpha_0,
+        training_steps // 25,
+        21,
+        8,
+        training_steps // 4,
+        192,
+    )
+    assert boundaries[0] == 0 and boundaries[-1] == training_steps
+    assert np.all(np.diff(boundaries) > 0)
+    assert len(chunk_alpha) == len(chunk_nsize) == len(boundaries) - 1
+    assert chunk_alpha[0] == alpha_0 and final_alpha == pytest.approx(
+        alpha_0 * 0.75**24
+    )
+    assert chunk_nsize[0] == 21 and chunk_nsize[-1] == 8
+    assert np.all(np.diff(chunk_nsize) <= 0)
+
+
+def test_batch_training(map: Lattice):
+    print("Testing batch training", flush=True)
+    map.train_lattice(data, features_names, training_mode="batch", number_of_epochs=5)
+    assert map.lattice.shape == (xdim * ydim, data_dims[1])
+    assert map.epoch == 5
+    assert len(map.lattice_history) == 6
+    assert map.umat.shape == (xdim, ydim)
+
+
+def test_batch_accumulate():
+    print("Testing BMU bounds in batch accumulation", flush=True)
+    lattice = np.random.rand(xdim * ydim, data_dims[1])
+    bmu = np.zeros(data_dims[0], dtype=np.int64)
+    upper = np.zeros(data_dims[0])
+    lower = np.zeros(data_dims[0])
+    drift = np.zeros(xdim * ydim)
+    sums, counts, searched = batch_accumulate(
+        lattice, data, bmu, upper, lower, drift, True
+    )
+    assert searched == data_dims[0]
+    assert np.sum(counts) == data_dims[0]
+    assert np.allclose(np.sum(sums, axis=0), np.sum(data, axis=0))
+
+    # move a few nodes slightly; the skipped points must keep the exact BMU
+    new_lattice = lattice.copy()
+    new_lattice[:10] += 1.0e-3
+    drift = np.sqrt(np.sum((new_lattice - lattice) ** 2, axis=1))
+    _, _, searched = batch_accumulate(
+        new_lattice, data, bmu, upper, lower, drift, False
+    )
+    expected = np.argmin(
+        np.sum((new_lattice[None, :, :] - data[:, None, :]) ** 2, axis=2), axis=1
+    )
+    assert searched < data_dims[0]
+    assert np.array_equal(bmu, expected)
+
+
+def test_float32_mode():
+    print("Testing float32 mode", flush=True)
+    map32 = Lattice(
+        xdim=xdim,
+        ydim=ydim,
+        alpha_0=alpha_0,
+        train=1000,
+        sampling_type="uniform",
+        dtype=np.float32,
+    )
+    map32.train_lattice(data, features_names)
+    projection_2d = map32.map_data_to_lattice()
+    clusters = map32.assign_cluster_to_lattice()
+    som_labels = map32.assign_cluster_to_data(projection_2d, clusters)
+
+    assert map32.data_array.dtype == np.float32
+    assert map32.lattice.dtype == np.float32
+    assert map32.umat.dtype == np.float32
+    assert map32.lattice_history[-1].dtype == np.float32
+    assert map32.projection_1d.dtype == np.uint8  # 200 nodes
+    assert projection_2d.dtype == np.int16  # signed, so that coordinates can be subtracted
+    assert som_labels.dtype == clusters.dtype == np.uint8
+
+
 def test_map_data_to_lattice(map_after_mapping: Lattice):
     print("Testing mapping data to lattice", flush=True)
     assert map_after_mapping.projection_1d.shape == (data_dims[0], 1)
     assert map_after_mapping.projection_2d.shape == (data_dims[0], 2)
 
 
+def test_map_data_to_lattice_grid(trained_map: Lattice):
+    print("Testing warm-start mapping of gridded data", flush=True)
+    grid_shape = (5, 10, 10)
+    z, y, x = np.meshgrid(
+        *[np.linspace(0.0, 1.0, n) for n in grid_shape], indexing="ij"
+    )
+    trained_map.data_array = np.stack([x, y, z, x * y], axis=-1).reshape(-1, 4)
+    exact = trained_map.map_data_to_lattice()
+    best_match_node = trained_map.projection_1d.copy()
+
+    # every voxel ends at a local minimum over its lattice neighbors
+    projection_2d = trained_map.map_data_to_lattice(grid_shape=grid_shape)
+    assert projection_2d.shape == exact.shape
+    distances = np.sum(
+        (trained_map.data_array[:, None, :] - trained_map.lattice[None, :, :]) ** 2,
+        axis=2,
+    )
+    warm = np.take_along_axis(distances, trained_map.projection_1d.astype(int), axis=1)
+    nodes_2d = trained_map.coordinate(np.arange(xdim * ydim).reshape((-1, 1)), xdim)
+    lattice_neighbors = (
+        np.max(np.abs(projection_2d[:, None, :] - nodes_2d[None, :, :]), axis=2) <= 1
+    )
+    assert np.all(
+        warm
+        <= np.where(lattice_neighbors, distances, np.inf).min(axis=1, keepdims=True)
+    )
+
+    # with no tolerance, every voxel is checked with the exact search
+    trained_map.map_data_to_lattice(grid_shape=grid_shape, tolerance=0.0)
+    assert np.array_equal(trained_map.projection_1d, best_match_node)
+
+
+def test_map_data_chunked(map_after_mapping: Lattice, tmp_path):
+    print("Testing chunked mapping into memory-mapped outputs", flush=True)
+    np.save(tmp_path / "data.npy", data)
+    source = np.load(tmp_path / "data.npy", mmap_mode="r")
+    expected_labels = map_after_mapping.assign_cluster_to_data(
+        map_after_mapping.projection_2d, map_after_mapping.lattice_assigned_clusters
+    )
+    expected_bmu = map_after_mapping.projection_1d[:, 0]
+
+    labels = np.lib.format.open_memmap(
+        tmp_path / "labels.npy",
+        mode="w+",
+        dtype=expected_labels.dtype,
+        shape=(data_dims[0],),
+    )
+    bmu = np.lib.format.open_memmap(
+        tmp_path / "bmu.npy", mode="w+", dtype=np.int64, shape=(data_dims[0],)
+    )
+    with h5py.File(tmp_path / "distance.h5", "w") as f5:
+        distance = f5.create_dataset(
+            "distance", shape=(data_dims[0],), dtype=np.float64
+        )
+        map_after_mapping.map_data_chunked(
+            source, labels=labels, bmu=bmu, distance=distance, chunk_size=128
+        )
+        distance = distance[()]
+
+    assert np.array_equal(labels, expected_labels)
+    assert np.array_equal(bmu, expected_bmu)
+    assert np.allclose(
+        distance,
+        np.linalg.norm(data - map_after_mapping.lattice[expected_bmu], axis=1),
+    )
+
+
+def test_quality(map_after_mapping: Lattice):
+    print("Testing the quality metrics of the lattice", flush=True)
+    lattice = map_after_mapping.lattice
+    distances = np.linalg.norm(data[:, None, :] - lattice[None, :, :], axis=-1)
+    order = np.argsort(distances, axis=1, kind="stable")
+    best, second = order[:, 0], order[:, 1]
+    best_distance = distances[np.arange(data_dims[0]), best]
+    max_distance = 1.5 * np.median(best_distance)  # some distances are above
+
+    quality = map_after_mapping.quality(
+        data, distance_bins=8, max_distance=max_distance
+    )
+    assert np.allclose(quality["distance"], best_distance)
+    assert np.isclose(quality["quantization_error"], np.mean(best_distance))
+    neighbors = (np.abs(best % xdim - second % xdim) <= 1) & (
+        np.abs(best // xdim - second // xdim) <= 1
+    )
+    assert np.isclose(quality["topographic_error"], 1 - np.mean(neighbors))
+    assert np.array_equal(
+        quality["hits"].T.ravel(), np.bincount(best, minlength=xdim * ydim)
+    )
+    expected, _ = np.histogram(
+        np.minimum(best_distance, max_distance), bins=quality["distance_edges"]
+    )
+    assert np.array_equal(quality["distance_histogram"], expected)
+
+    # the streaming mapper accumulates the same metrics over the chunks
+    labels = np.empty(
+        data_dims[0], dtype=map_after_mapping.lattice_assigned_clusters.dtype
+    )
+    streamed = map_after_mapping.map_data_chunked(
+        data,
+        labels=labels,
+        chunk_size=100,
+        quality=True,
+        distance_bins=8,
+        max_distance=max_distance,
+    )
+    assert np.array_equal(labels, map_after_mapping.label(data))
+    assert np.isclose(streamed["quantization_error"], quality["quantization_error"])
+    assert np.isclose(streamed["topographic_error"], quality["topographic_error"])
+    assert np.array_equal(streamed["hits"], quality["hits"])
+    assert np.array_equal(streamed["distance_histogram"], quality["distance_histogram"])
+
+
+def test_significance(map_after_mapping: Lattice):
+    print("Testing the feature significance of the lattice", flush=True)
+    bmu = map_after_mapping.projection_1d.ravel()
+
+    # the variance of the data with each point replaced by its best matching node
+    var_v = np.var(map_after_mapping.lattice[bmu], axis=0)
+    expected = var_v / np.sum(var_v)
+    assert np.allclose(map_after_mapping.significance(), expected)
+
+    hits = map_after_mapping.quality(data)["hits"]
+    assert np.allclose(map_after_mapping.significance(hits), expected)
+    assert np.allclose(map_after_mapping.significance(hits.T.ravel()), expected)
+
+
+def test_embed(map_after_mapping: Lattice):
+    print("Testing the embedding tests of the lattice", flush=True)
+    from scipy import stats
+
+    lattice = map_after_mapping.lattice
+    rng = np.random.default_rng(0)
+    # data that the lattice does not (yet) embed, and data drawn close to the nodes
+    near_lattice = np.repeat(lattice, 3, axis=0) + rng.normal(
+        0, 1e-3, (3 * xdim * ydim, 4)
+    )
+    for samples in [data, near_lattice]:
+        var_v = np.var(samples, axis=0)
+        prob_v = var_v / np.sum(var_v)
+
+        # one test per feature, as in POPSOM
+        expected_ks = prob_v.copy()
+        expected_vm = prob_v.copy()
+        for i in range(data_dims[1]):
+            if stats.ks_2samp(lattice[:, i], samples[:, i]).pvalue <= 0.05:
+                expected_ks[i] = 0
+            ratio = np.var(lattice[:, i], ddof=1) / np.var(samples[:, i], ddof=1)
+            f_lo, f_hi = stats.f.ppf(
+                [0.975, 0.025], xdim * ydim - 1, samples.shape[0] - 1
+            )
+            mean_test = stats.ttest_ind(lattice[:, i], samples[:, i], equal_var=False)
+            mean_lo, mean_hi = mean_test.confidence_interval(0.95)
+            if not (ratio / f_lo <= 1 <= ratio / f_hi and mean_lo <= 0 <= mean_hi):
+                expected_vm[i] = 0
+
+        embed_ks = map_after_mapping.embed_ks(samples, verb=True)
+        embed_vm = map_after_mapping.embed_vm(samples, verb=True)
+        assert np.allclose(embed_ks, expected_ks)
+        assert np.allclose(embed_vm, expected_vm)
+        assert np.isclose(
+            map_after_mapping.embed(samples, ks=True), np.sum(expected_ks)
+        )
+        assert np.isclose(map_after_mapping.embed(samples), np.sum(expected_vm))
+    assert np.isclose(np.sum(embed_vm), 1.0)
+
+    # the tests can run on a sample of the data
+    assert map_after_mapping.embed_vm(data, verb=True, sample_size=200).shape == (
+        data_dims[1],
+    )
+
+
+def test_topo(map_after_mapping: Lattice):
+    print("Testing the topographic accuracy of the lattice", flush=True)
+    acc_v = map_after_mapping.topo(data, k=data_dims[0], verb=True)
+    bmu = map_after_mapping.best_match(map_after_mapping.lattice, data, full=True)
+    best, second = bmu[:, 0].astype(np.int64), bmu[:, 1].astype(np.int64)
+    neighbors = (np.abs(best % xdim - second % xdim) <= 1) & (
+        np.abs(best // xdim - second // xdim) <= 1
+    )
+    assert bmu.dtype.kind == "u"  # the coordinates must not wrap around
+    assert np.array_equal(acc_v, neighbors)
+
+    # on a lattice that is a regular grid, the two best nodes of a point are always adjacent
+    grid = Lattice(12, 10)
+    grid.lattice = np.array(
+        [[x, y] for y in range(10) for x in range(12)], dtype=np.float64
+    )
+    points = np.random.default_rng(1).uniform([0, 0], [11, 9], (500, 2))
+    assert grid.topo(points, k=500, interval=False) == 1.0
+
+    # the bootstrap does not depend on the number of threads
+    topo = map_after_mapping.topo(data, k=100, workers=1)
+    assert topo["lo"] <= topo["val"] <= topo["hi"]
+    assert map_after_mapping.topo(data, k=100, workers=4) == topo
+
+    convergence = map_after_mapping.convergence(data, k=100, verb=True)
+    assert convergence["topo"] == topo["val"]
+    assert np.isclose(
+        map_after_mapping.convergence(data, k=100),
+        0.5 * convergence["embed"] + 0.5 * convergence["topo"],
+    )
+
+
+def test_label(map_after_mapping: Lattice):
+    print("Testing fused labeling", flush=True)
+    expected = map_after_mapping.assign_cluster_to_data(
+        map_after_mapping.projection_2d, map_after_mapping.lattice_assigned_clusters
+    )
+    labels = map_after_mapping.label(data)
+    assert labels.dtype == map_after_mapping.lattice_assigned_clusters.dtype
+    assert np.array_equal(labels, expected)
+
+    labels, projection_2d = map_after_mapping.label(data, projection=True)
+    assert np.array_equal(labels, expected)
+    assert np.array_equal(projection_2d, map_after_mapping.projection_2d)
+
+    map_after_mapping.bmu_search = "index"
+    assert np.array_equal(map_after_mapping.label(data), expected)
+
+
+def test_label_ensemble(map_after_mapping: Lattice):
+    print("Testing single-pass ensemble labeling", flush=True)
+    other_lattice = np.random.rand(xdim * ydim, data_dims[1]).astype(np.float32)
+    other_clusters = np.random.randint(0, 5, (xdim, ydim)).astype(np.uint8)
+    ensemble = [map_after_mapping, (other_lattice, other_clusters)]
+
+    labels = label_ensemble(ensemble, data, chunk_size=128)
+    assert labels.shape == (data_dims[0], 2)
+    assert np.array_equal(labels[:, 0], map_after_mapping.label(data))
+    other_nodes = map_after_mapping.best_match(other_lattice, data)[:, 0]
+    assert np.array_equal(labels[:, 1], other_clusters.T.ravel()[other_nodes])
+
+    output = np.zeros_like(labels)
+    assert label_ensemble(ensemble, data, labels=output) is output
+    assert np.array_equal(output, labels)
+
+
 def test_assign_cluster_to_lattice(map_after_mapping: Lattice):
     print("Testing assigning cluster ids to lattice", flush=True)
     number_of_clusters = np.max(map_after_mapping.lattice_assigned_clusters) + 1
@@ -113,6 +506,133 @@ def test_assign_cluster_to_lattice(map_after_mapping: Lattice):
     assert number_of_clusters_merge <= number_of_clusters
 
 
+def test_merge_similar_centroids(map_after_mapping: Lattice):
+    print("Testing merging of centroids", flush=True)
+    from scipy.ndimage import map_coordinates
+
+    centroids = map_after_mapping.compute_centroids()
+    unique_centroids = map_after_mapping.get_unique_centroids(centroids)
+    positions = list(
+        zip(unique_centroids["position_x"], unique_centroids["position_y"])
+    )
+
+    # batched path costs are the same as interpolating each path on its own
+    first, second, cost = map_after_mapping.centroid_path_costs(positions)
+    assert len(cost) == len(positions) * (len(positions) - 1) // 2
+    for i, j, c in zip(first, second, cost):
+        a, b = positions[i], positions[j]
+        num_sample = 5 * int(np.sqrt((b[0] - a[0]) ** 2 + (b[1] - a[1]) ** 2))
+        x, y = np.linspace(a[0], b[0], num_sample), np.linspace(a[1], b[1], num_sample)
+        expected = np.sum(map_coordinates(map_after_mapping.umat**2, np.vstack((x, y))))
+        assert np.isclose(c, expected)
+
+    # merged centroids are a subset of the original ones, and the input is left untouched
+    naive_x = centroids["centroid_x"].copy()
+    merged = map_after_mapping.merge_similar_centroids(centroids, threshold=1.1)
+    assert np.array_equal(centroids["centroid_x"], naive_x)
+    assert len(map_after_mapping.nodes_count) == 1
+    assert set(map_after_mapping.unique_ids(merged)) <= set(positions)
+    assert sum(map_after_mapping.nodes_count.values()) == xdim * ydim
+
+
+def test_merge_hierarchy(map_after_mapping: Lattice):
+    print("Testing the merge hierarchy of the centroids", flush=True)
+    map_after_mapping.merge_hierarchy = None
+    hierarchy = map_after_mapping.build_merge_hierarchy()
+    positions = hierarchy["positions"]
+    assert len(hierarchy["cost"]) == len(positions) - 1
+    assert np.all(hierarchy["cost"] <= 1.0)
+
+    # the hierarchy is reused until the Umatrix changes
+    map_after_mapping.assign_cluster_to_lattice(merge_cost=0.2)
+    assert map_after_mapping.build_merge_hierarchy() is hierarchy
+
+    # cutting the hierarchy is the same as replaying its merges up to the threshold
+    for threshold in (0.0, 0.1, 0.3, 0.6, 1.1):
+        cut = map_after_mapping.cut_merge_hierarchy(hierarchy, threshold)
+        expected = {
+            key: value.copy() for key, value in hierarchy["naive_centroids"].items()
+        }
+        for kept, removed, cost in zip(
+            hierarchy["kept"], hierarchy["removed"], hierarchy["cost"]
+        ):
+            if cost >= threshold:
+                break
+            expected = map_after_mapping.replace_value(
+                expected, positions[removed], positions[kept]
+            )
+        assert np.array_equal(cut["centroid_x"], expected["centroid_x"])
+        assert np.array_equal(cut["centroid_y"], expected["centroid_y"])
+
+    umat = map_after_mapping.umat
+    map_after_mapping.umat = umat + 1.0
+    assert map_after_mapping.build_merge_hierarchy() is not hierarchy
+    map_after_mapping.umat = umat
+
+
+def test_merge_hierarchy_centroids(map_after_mapping: Lattice):
+    print("Testing the merge hierarchy cache with other centroids", flush=True)
+    map_after_mapping.merge_hierarchy = None
+    expected = map_after_mapping.assign_cluster_to_lattice(merge_cost=0.2)
+
+    # a hierarchy built from other centroids (as plot_heat(explicit=True, merge=True) does) is not reused
+    explicit_centroids = map_after_mapping.compute_centroids(True)
+    assert not np.array_equal(
+        explicit_centroids["centroid_x"],
+        map_after_mapping.compute_centroids(False)["centroid_x"],
+    )
+    map_after_mapping.merge_similar_centroids(explicit_centroids, 0.2)
+    clusters = map_after_mapping.assign_cluster_to_lattice(merge_cost=0.2)
+    assert np.array_equal(clusters, expected)
+
+
+def recursive_merge(som: Lattice, centroids: dict, threshold: float) -> dict:
+    # the merge of earlier versions: recompute every path cost and merge the cheapest pair, until the threshold
+    from scipy.ndimage import map_coordinates
+
+    while True:
+        unique_centroids = som.get_unique_centroids(centroids)
+        positions = list(
+            zip(unique_centroids["position_x"], unique_centroids["position_y"])
+        )
+        costs = []
+        for i in range(len(positions) - 1):
+            for j in range(i + 1, len(positions)):
+                a, b = positions[i], positions[j]
+                num_sample = 5 * int(np.sqrt((b[0] - a[0]) ** 2 + (b[1] - a[1]) ** 2))
+                x = np.linspace(a[0], b[0], num_sample)
+                y = np.linspace(a[1], b[1], num_sample)
+                costs.append(
+                    [a, b, np.sum(map_coordinates(som.umat**2, np.vstack((x, y))))]
+                )
+        if not costs:
+            return centroids
+        costs = sorted(costs, key=lambda x: x[2])
+        a, b, cost = costs[0]
+        if cost / costs[-1][2] >= threshold:
+            return centroids
+        if som.nodes_count[a] < som.nodes_count[b]:
+            centroids = som.replace_value(centroids, a, b)
+        else:
+            centroids = som.replace_value(centroids, b, a)
+
+
+def test_merge_parity():
+    print("Testing the merge hierarchy against the recursive merge", flush=True)
+    # seeds 4 and 34 give other clusters if the order of the centroids in each pair is not followed
+    for seed in [0, 1, 2, 3, 4, 34]:
+        rng = np.random.default_rng(seed)
+        som = Lattice(12, 10)
+        som.lattice = rng.random((120, 3))
+        som.umat = som.compute_umat()
+        naive_centroids = som.compute_centroids(False)
+        for threshold in (0.2, 0.5, 0.8):
+            merged = som.merge_similar_centroids(naive_centroids, threshold)
+            expected = recursive_merge(som, naive_centroids, threshold)
+            assert np.array_equal(merged["centroid_x"], expected["centroid_x"])
+            assert np.array_equal(merged["centroid_y"], expected["centroid_y"])
+
+
 def test_assign_cluster_to_data(map_after_mapping: Lattice):
     print("Testing assigning cluster ids to data", flush=True)
     som_labels = map_after_mapping.assign_cluster_to_data(
@@ -137,6 +657,45 @@ def test_best_match(map_after_mapping: Lattice):
         assert best_match_node == node_index
 
 
+def test_best_match_full(map_after_mapping: Lattice):
+    print("Testing blocked best match with top-2 selection", flush=True)
+    lattice = map_after_mapping.lattice
+    for number_obs in [3, 256, 1000]:  # fewer than 10, exactly one tile, several tiles
+        obs = np.random.rand(number_obs, data_dims[1])
+        best_match_node = map_after_mapping.best_match(lattice, obs, full=True)
+        distances = np.sum((obs[:, None, :] - lattice[None, :, :]) ** 2, axis=2)
+        expected = np.argsort(distances, axis=1, kind="stable")[:, :2]
+        assert best_match_node.shape == (number_obs, 2)
+        assert np.array_equal(best_match_node, expected)
+
+        best_match_node = map_after_mapping.best_match(
+            lattice, obs, full=True, method="index"
+        )
+        assert np.array_equal(best_match_node, expected)
+
+
+def test_bmu_search_buffers(map_after_mapping: Lattice, monkeypatch):
+    print("Testing the size and reuse of the BMU search buffers", flush=True)
+    lattice = map_after_mapping.lattice
+    buffers = bmu_search_buffers(lattice)
+    assert buffers[1].shape[1:] == (256, xdim * ydim)
+    assert bmu_search_buffers(lattice) is buffers  # reused by the next call
+
+    # a smaller budget shortens the tiles, without changing the best matches
+    obs = np.random.rand(1000, data_dims[1])
+    expected = map_after_mapping.best_match(lattice, obs, full=True)
+    monkeypatch.setattr("aweSOM.som.bmu_tile_bytes", 7 * xdim * ydim * 8)
+    assert bmu_search_buffers(lattice)[1].shape[1] == 7
+    assert np.array_equal(
+        map_after_mapping.best_match(lattice, obs, full=True), expected
+    )
+    monkeypatch.setattr("aweSOM.som.bmu_tile_bytes", 1)
+    assert bmu_search_buffers(lattice)[1].shape[1] == 1
+    assert np.array_equal(
+        map_after_mapping.best_match(lattice, obs, full=True), expected
+    )
+
+
 def test_compute_centroids(map_after_mapping: Lattice):
     print("Testing computing centroids", flush=True)
     centroids = map_after_mapping.compute_centroids()
@@ -146,6 +705,27 @@ def test_compute_centroids(map_after_mapping: Lattice):
     assert centroids["centroid_y"].shape == (xdim, ydim)
 
 
+def test_compute_centroids_descent():
+    print("Testing steepest descent of the centroids", flush=True)
+    # a single valley along a long zigzag path, which is deeper than the recursion limit
+    big_map = Lattice(300, 300)
+    ix, iy = np.indices((300, 300))
+    big_map.umat = np.where(iy % 2 == 0, ix, 299 - ix) + 300.0 * iy
+    centroids = big_map.compute_centroids()
+    assert np.all(centroids["centroid_x"] == 0)
+    assert np.all(centroids["centroid_y"] == 0)
+
+    # explicit: each node points to its lowest neighbor, and ties keep the first one in the search order
+    small_map = Lattice(3, 3)
+    small_map.umat = np.array([[1.0, 0.0, 1.0], [2.0, 2.0, 2.0], [0.0, 2.0, 0.0]])
+    centroids = small_map.compute_centroids(explicit=True)
+    assert (centroids["centroid_x"][1, 1], centroids["centroid_y"][1, 1]) == (2, 0)
+    assert (centroids["centroid_x"][1, 0], centroids["centroid_y"][1, 0]) == (2, 0)
+    assert (centroids["centroid_x"][2, 1], centroids["centroid_y"][2, 1]) == (2, 0)
+    assert (centroids["centroid_x"][0, 0], centroids["centroid_y"][0, 0]) == (0, 1)
+    assert (centroids["centroid_x"][2, 2], centroids["centroid_y"][2, 2]) == (2, 2)
+
+
 def test_get_unique_centroids(map_after_mapping: Lattice):
     print("Testing unique centroids", flush=True)
     centroids = map_after_mapping.compute_centroids()
@@ -160,6 +740,47 @@ def test_get_unique_centroids(map_after_mapping: Lattice):
     assert sum(list(map_after_mapping.nodes_count.values())) == xdim * ydim
 
 
+def test_compute_umat_stencil(map_after_mapping: Lattice):
+    print("Testing the neighbor-only U-matrix against compute_heat", flush=True)
+    for dtype in [np.float64, np.float32]:
+        for dims in [(xdim, ydim), (2, 2), (3, 5)]:
+            map_after_mapping.xdim, map_after_mapping.ydim = dims
+            lattice = np.random.rand(dims[0] * dims[1], data_dims[1]).astype(dtype)
+            map_after_mapping.lattice = lattice
+            # same distances as the stencil, so that the two are bit for bit identical
+            d = np.sqrt(
+                np.sum((lattice[:, None, :] - lattice[None, :, :]) ** 2, axis=-1)
+            )
+            expected = map_after_mapping.compute_heat(d / (dims[0] * dims[1]))
+            umat = map_after_mapping.compute_umat()
+            assert umat.dtype == dtype
+            assert np.array_equal(umat, expected)
+
+
+def test_smooth_2d():
+    print("Testing the kernel smoothing of a heat map", flush=True)
+    som = Lattice(7, 4)
+    heat = np.random.rand(7, 4)
+    for theta in [None, 0.7, 3.0]:
+        # normalized sum of the exponential covariance weights over the whole grid
+        length = 2 if theta is None else theta
+        x, y = np.meshgrid(np.arange(7), np.arange(4), indexing="ij")
+        weights = np.exp(
+            -((x[:, :, None, None] - x) ** 2 + (y[:, :, None, None] - y) ** 2)
+            / length**2
+        )
+        expected = np.sum(weights * heat, axis=(2, 3)) / np.sum(weights, axis=(2, 3))
+        smoothed = som.smooth_2d(heat, nrow=7, ncol=4, surface=False, theta=theta)
+        assert np.allclose(smoothed, expected)
+    assert len(som.smoothing_cache) == 3
+
+    # smoothing again with the same length reuses the cached weights
+    assert np.allclose(
+        som.smooth_heat(heat, 0.7), som.smooth_2d(heat, nrow=7, ncol=4, theta=0.7)
+    )
+    assert len(som.smoothing_cache) == 3
+
+
 def test_compute_umat(map_after_mapping: Lattice):
     print("Testing U-matrix computation", flush=True)
     umat = (